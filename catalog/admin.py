@@ -1,14 +1,108 @@
 from django.contrib import admin
+from django.contrib.admin.utils import unquote
+from django.contrib.auth.admin import UserAdmin
+from django.contrib.auth.models import User
+from django.core.exceptions import PermissionDenied
+from django.db.models import Case, Value, When
+from django.http import Http404
+from django.template.response import TemplateResponse
+from django.urls import path, reverse
 from .models import Book, BookInstance, Language, Author, Genre
-
-
-class BookInline(admin.TabularInline):
-    model = Book
-    extra = 0
+from .lookups import prefix_search
+from .search import search_book_ids
+
+# the most books the autocomplete of a book field offers, the best matches first
+BOOK_AUTOCOMPLETE_LIMIT = 100
+
+
+def is_autocomplete(request):
+    return request.resolver_match is not None and request.resolver_match.url_name == 'autocomplete'
+
+
+class PaginatedRelatedMixin:
+    """
+    Lists the related rows of the object on its change page, a page at a
+    time. The page is fetched by the browser once the form has loaded, from
+    an admin view reading one slice of the foreign key index, so the change
+    page costs the same however many rows are related. The rows are edited
+    on their own change pages. The list is shown to the staff who may view
+    the related model in its own admin only.
+    """
+    change_form_template = 'admin/catalog/change_form_related.html'
+    related_model = None
+    # the foreign key of related_model pointing at the object
+    related_field = None
+    related_ordering = ('pk',)
+    related_columns = ()
+    related_per_page = 20
+
+    def get_urls(self):
+        info = self.opts.app_label, self.opts.model_name
+        return [
+            path(
+                '<path:object_id>/related/',
+                self.admin_site.admin_view(self.related_view),
+                name='%s_%s_related' % info,
+            ),
+        ] + super().get_urls()
+
+    def has_related_view_permission(self, request):
+        related_admin = self.admin_site._registry.get(self.related_model)
+        return related_admin is not None and related_admin.has_view_permission(request)
+
+    def change_view(self, request, object_id, form_url='', extra_context=None):
+        extra_context = {**(extra_context or {}), 'show_related_list': self.has_related_view_permission(request)}
+        return super().change_view(request, object_id, form_url, extra_context)
+
+    def get_related_queryset(self, obj):
+        return self.related_model._default_manager.filter(**{self.related_field: obj}).order_by(
+            *self.related_ordering
+        )
+
+    def related_view(self, request, object_id):
+        obj = self.get_object(request, unquote(object_id))
+        if obj is None or not self.has_view_or_change_permission(request, obj):
+            raise Http404
+        if not self.has_related_view_permission(request):
+            raise PermissionDenied
+        try:
+            page = max(int(request.GET.get('page', 1)), 1)
+        except ValueError:
+            page = 1
+
+        # one row more tells whether there is a next page, without a COUNT
+        start = (page - 1) * self.related_per_page
+        rows = list(self.get_related_queryset(obj)[start:start + self.related_per_page + 1])
+        related_opts = self.related_model._meta
+        info = related_opts.app_label, related_opts.model_name
+        context = {
+            'headers': [related_opts.get_field(name).verbose_name for name in self.related_columns],
+            'rows': [
+                (
+                    reverse('admin:%s_%s_change' % info, args=[row.pk], current_app=self.admin_site.name),
+                    [self.related_value(row, name) for name in self.related_columns],
+                )
+                for row in rows[:self.related_per_page]
+            ],
+            'page': page,
+            'has_previous': page > 1,
+            'has_next': len(rows) > self.related_per_page,
+            'add_url': '{}?{}={}'.format(
+                reverse('admin:%s_%s_add' % info, current_app=self.admin_site.name), self.related_field, obj.pk,
+            ),
+            'verbose_name_plural': related_opts.verbose_name_plural,
+        }
+        return TemplateResponse(request, 'admin/catalog/related_list.html', context)
+
+    @staticmethod
+    def related_value(row, name):
+        display = getattr(row, f'get_{name}_display', None)
+        value = display() if display else getattr(row, name)
+        return '-' if value is None else value
 
 
 @admin.register(Author)
-class AuthorAdmin(admin.ModelAdmin):
+class AuthorAdmin(PaginatedRelatedMixin, admin.ModelAdmin):
     # the order of demonstration attributes in the admin site
     list_display = (
         'last_name',
@@ -16,6 +110,7 @@ class AuthorAdmin(admin.ModelAdmin):
         'date_of_birth',
         'date_of_death'
     )
+    search_fields = ('last_name', 'first_name')
 
     fields = [
         'first_name',
@@ -23,22 +118,33 @@ class AuthorAdmin(admin.ModelAdmin):
         ('date_of_birth', 'date_of_death'),
         'biography'
     ]
-    inlines = [BookInline]  # TODO check this feature
+    # the books of the author, a page at a time
+    related_model = Book
+    related_field = 'author'
+    related_ordering = ('title', 'id')
+    related_columns = ('title', 'isbn', 'copies_available', 'copies_total')
 
-
-class BooksInstanceInline(admin.TabularInline):
-    model = BookInstance
-    extra = 0
+    def get_search_results(self, request, queryset, search_term):
+        if is_autocomplete(request) and search_term.strip():
+            # a prefix of the last name, served by the author name index
+            return queryset.filter(prefix_search('last_name', search_term.strip())), False
+        return super().get_search_results(request, queryset, search_term)
 
 
 @admin.register(Book)
-class BookAdmin(admin.ModelAdmin):
+class BookAdmin(PaginatedRelatedMixin, admin.ModelAdmin):
     list_display = (
         'title',
         'author',
         'display_genre',
         'language'
     )
+    # a page of 100 rows takes the same few queries as a page of one:
+    # the author and the language are joined, the genres prefetched
+    list_per_page = 100
+    list_select_related = ('author', 'language')
+    search_fields = ('title',)
+    autocomplete_fields = ('author',)
     fieldsets = (
         ('General information', {
             'fields': ('title', 'author')
@@ -53,7 +159,28 @@ class BookAdmin(admin.ModelAdmin):
             }
          )
     )
-    inlines = [BooksInstanceInline]
+    # the copies of the book, a page at a time
+    related_model = BookInstance
+    related_field = 'book'
+    related_ordering = ('status', 'due_back', 'id')
+    related_columns = ('id', 'imprint', 'status', 'due_back', 'borrower')
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).prefetch_related('genre')
+
+    def get_related_queryset(self, obj):
+        return super().get_related_queryset(obj).select_related('borrower')
+
+    def get_search_results(self, request, queryset, search_term):
+        if is_autocomplete(request) and search_term.strip():
+            # the full-text index instead of a scan with LIKE '%term%'
+            ids = search_book_ids(search_term, BOOK_AUTOCOMPLETE_LIMIT)
+            if not ids:
+                return queryset.none(), False
+            # the best matches first, as the index ranked them
+            rank = Case(*[When(pk=pk, then=Value(position)) for position, pk in enumerate(ids)])
+            return queryset.filter(pk__in=ids).order_by(rank), False
+        return super().get_search_results(request, queryset, search_term)
 
 
 @admin.register(BookInstance)
@@ -67,6 +194,11 @@ class BookInstanceAdmin(admin.ModelAdmin):
 
     )
     list_filter = ('status', 'due_back')
+    list_per_page = 100
+    # the book (its title is the label of the copy) and the borrower of every row
+    list_select_related = ('book', 'borrower')
+    # searched on demand instead of a <select> of every book and every user
+    autocomplete_fields = ('book', 'borrower')
 
     fieldsets = (
         (None, {
@@ -88,4 +220,16 @@ class GenreAdmin(admin.ModelAdmin):
     pass
 
 
+admin.site.unregister(User)
+
+
+@admin.register(User)
+class ReaderAdmin(UserAdmin):
+    def get_search_results(self, request, queryset, search_term):
+        if is_autocomplete(request) and search_term.strip():
+            # a prefix of the username, served by its unique index
+            return queryset.filter(prefix_search('username', search_term.strip())), False
+        return super().get_search_results(request, queryset, search_term)
+
+
 # Register your models here.
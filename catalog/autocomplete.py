@@ -0,0 +1,222 @@
+"""
+Autocomplete over the book titles and the author names.
+
+Every worker keeps its own PrefixIndex in memory: a sorted list of the
+normalized keys with a parallel list of the packed object references,
+so a prefix lookup is a bisect plus a short forward scan. It is built
+lazily on the first lookup. Every change of a title or a name is
+published to the shared cache as a numbered delta: the signal handlers
+increment the version counter and store the change under the new number.
+A worker behind the counter fetches the deltas it has missed in one
+round-trip and applies them to its copy; it rebuilds the copy only when a
+delta has expired, is too far behind, or the bulk writes asked for it.
+"""
+import random
+import threading
+from array import array
+from bisect import bisect_left
+
+from django.core.cache import cache
+from django.urls import reverse
+
+from .models import Author, Book
+
+VERSION_CACHE_KEY = 'catalog:autocomplete:version'
+DELTA_CACHE_KEY = 'catalog:autocomplete:delta:{}'
+# a worker this far behind rebuilds its copy rather than replaying the deltas
+MAX_DELTAS = 1000
+DELTA_TIMEOUT = 60 * 60
+
+ADD, REMOVE, REBUILD = 'add', 'remove', 'rebuild'
+
+BOOK, AUTHOR = 0, 1
+KINDS = {BOOK: 'book', AUTHOR: 'author'}
+URL_NAMES = {BOOK: 'book-detail', AUTHOR: 'author-detail'}
+
+
+def normalize(text):
+    return ' '.join(text.casefold().split())
+
+
+def pack(kind, pk):
+    """the kind lives in the lowest bit, so a reference is a single int"""
+    return pk << 1 | kind
+
+
+def unpack(ref):
+    return ref & 1, ref >> 1
+
+
+def book_entry(pk, title):
+    return pack(BOOK, pk), title, [title]
+
+
+def author_entry(pk, first_name, last_name):
+    # authors are found by any of their names
+    return (
+        pack(AUTHOR, pk),
+        f'{last_name}, {first_name}',
+        [f'{last_name} {first_name}', f'{first_name} {last_name}'],
+    )
+
+
+class PrefixIndex:
+    """
+    Sorted-array prefix index: the (key, ref) pairs are kept in a sorted list
+    of the keys and a parallel array of the 64-bit references, which is a
+    fraction of the memory a node-per-character trie takes in Python.
+    """
+
+    def __init__(self):
+        self._keys = []
+        self._refs = array('q')
+        # the label shown for a reference and the keys it was indexed under
+        self._entries = {}
+
+    def __len__(self):
+        return len(self._keys)
+
+    @classmethod
+    def from_entries(cls, entries):
+        """Builds the index in one go: a single sort instead of n inserts."""
+        index = cls()
+        pairs = []
+        for ref, label, keys in entries:
+            keys = tuple(normalize(key) for key in keys)
+            index._entries[ref] = (label, keys)
+            pairs.extend((key, ref) for key in keys)
+        pairs.sort()
+        index._keys = [key for key, _ in pairs]
+        index._refs = array('q', (ref for _, ref in pairs))
+        return index
+
+    def add(self, ref, label, keys):
+        self.remove(ref)
+        keys = tuple(normalize(key) for key in keys)
+        self._entries[ref] = (label, keys)
+        for key in keys:
+            position = bisect_left(self._keys, key)
+            # keep the equal keys ordered by the reference
+            while position < len(self._keys) and self._keys[position] == key \
+                    and self._refs[position] < ref:
+                position += 1
+            self._keys.insert(position, key)
+            self._refs.insert(position, ref)
+
+    def remove(self, ref):
+        _, keys = self._entries.pop(ref, (None, ()))
+        for key in keys:
+            position = bisect_left(self._keys, key)
+            while position < len(self._keys) and self._keys[position] == key:
+                if self._refs[position] == ref:
+                    del self._keys[position]
+                    del self._refs[position]
+                    break
+                position += 1
+
+    def lookup(self, prefix, limit=10):
+        """Returns up to limit (ref, label) pairs whose key starts with the prefix."""
+        prefix = normalize(prefix)
+        found = {}
+        position = bisect_left(self._keys, prefix)
+        while position < len(self._keys) and len(found) < limit:
+            if not self._keys[position].startswith(prefix):
+                break
+            ref = self._refs[position]
+            found.setdefault(ref, self._entries[ref][0])
+            position += 1
+        return list(found.items())
+
+
+class CatalogAutocomplete:
+    """The per-process index of the catalog, kept up with the shared deltas."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._index = None
+        self._version = None
+
+    @staticmethod
+    def _start_version():
+        # a random start, so an evicted and recreated counter can't
+        # match a version some worker has already built its copy at
+        cache.add(VERSION_CACHE_KEY, random.getrandbits(48), None)
+
+    def shared_version(self):
+        version = cache.get(VERSION_CACHE_KEY)
+        if version is None:
+            self._start_version()
+            version = cache.get(VERSION_CACHE_KEY)
+        return version
+
+    @staticmethod
+    def load_entries():
+        for pk, title in Book.objects.values_list('pk', 'title').iterator(chunk_size=5000):
+            yield book_entry(pk, title)
+        for pk, first_name, last_name in (
+            Author.objects.values_list('pk', 'first_name', 'last_name').iterator(chunk_size=5000)
+        ):
+            yield author_entry(pk, first_name, last_name)
+
+    def _catch_up(self, version):
+        """Applies the deltas up to the version, returns False when they can't be replayed."""
+        if self._index is None or self._version is None or not 0 < version - self._version <= MAX_DELTAS:
+            return False
+        keys = [DELTA_CACHE_KEY.format(number) for number in range(self._version + 1, version + 1)]
+        deltas = cache.get_many(keys)
+        if len(deltas) != len(keys) or any(deltas[key][0] == REBUILD for key in keys):
+            return False
+        for key in keys:
+            action, *args = deltas[key]
+            if action == ADD:
+                self._index.add(*args)
+            else:
+                self._index.remove(*args)
+        self._version = version
+        return True
+
+    def get_index(self):
+        version = self.shared_version()
+        if self._index is None or self._version != version:
+            with self._lock:
+                if self._index is None or self._version != version:
+                    if not self._catch_up(version):
+                        self._index = PrefixIndex.from_entries(self.load_entries())
+                        self._version = version
+        return self._index
+
+    def lookup(self, prefix, limit=10):
+        results = []
+        for ref, label in self.get_index().lookup(prefix, limit):
+            kind, pk = unpack(ref)
+            results.append({
+                'type': KINDS[kind],
+                'id': pk,
+                'label': label,
+                'url': reverse(URL_NAMES[kind], args=[pk]),
+            })
+        return results
+
+    def _publish(self, delta):
+        """the delta under the next version, every worker applies it on its next lookup"""
+        self.shared_version()
+        try:
+            version = cache.incr(VERSION_CACHE_KEY)
+        except ValueError:
+            # the key has just been evicted, the workers rebuild anyway
+            self._start_version()
+            return
+        cache.set(DELTA_CACHE_KEY.format(version), delta, DELTA_TIMEOUT)
+
+    def invalidate(self):
+        """after the bulk writes which bypass the signals: every worker rebuilds"""
+        self._publish((REBUILD,))
+
+    def update(self, entry):
+        self._publish((ADD, *entry))
+
+    def remove(self, ref):
+        self._publish((REMOVE, ref))
+
+
+catalog_autocomplete = CatalogAutocomplete()
@@ -0,0 +1,88 @@
+"""
+The cached values which are costly to compute, safe from the stampede of
+the gunicorn workers when they expire.
+
+get_or_compute keeps the value with the time it stays fresh until and the
+time its computation took, then:
+
+* stale while revalidate: the value outlives its freshness in the cache by
+  stale_timeout. Once it is stale, one caller recomputes it and the others
+  are served the stale value meanwhile, without waiting,
+* probabilistic early recomputation (the XFetch rule of Vattani et al.):
+  a caller recomputes a fresh value early with a probability growing as
+  its expiry comes closer, the costlier the computation the earlier, so a
+  busy key is usually renewed before it goes stale at all,
+* single flight: the recomputation is taken by the caller which adds the
+  lock key. When there is no value at all, after an invalidation or a
+  flush, the others wait for it instead of computing it again. A caller
+  which fails or dies gives the lock up, or it expires after lock_timeout.
+
+The lock is the atomic cache.add() of the shared cache (Redis in the
+deployment), so one recomputation runs across all the workers.
+"""
+import math
+import random
+import time
+
+from django.core.cache import cache
+
+LOCK_CACHE_KEY = '{}:lock'
+
+# longer than any computation is expected to take
+LOCK_TIMEOUT = 10
+# how often the waiting callers look for the value
+WAIT_INTERVAL = 0.05
+# > 1 recomputes earlier, < 1 later
+BETA = 1.0
+
+
+def _store(key, value, delta, timeout, stale_timeout):
+    cache.set(key, (value, time.time() + timeout, delta), timeout + stale_timeout)
+
+
+def _compute(key, compute, timeout, stale_timeout, cacheable):
+    """Computes and stores the value, the caller holds the lock."""
+    lock = LOCK_CACHE_KEY.format(key)
+    try:
+        start = time.monotonic()
+        value = compute()
+        if cacheable is None or cacheable(value):
+            _store(key, value, time.monotonic() - start, timeout, stale_timeout)
+        return value
+    finally:
+        cache.delete(lock)
+
+
+def get_or_compute(
+    key, compute, timeout, stale_timeout=None, lock_timeout=LOCK_TIMEOUT, beta=BETA, cacheable=None,
+):
+    """
+    The value under the key, compute() is called when it has expired, by
+    one caller at a time. The value stays fresh for timeout seconds and is
+    served stale for stale_timeout seconds more (timeout by default) while
+    it is recomputed. A value failing cacheable(value) is returned to its
+    caller only, the waiting callers then compute their own.
+    """
+    if stale_timeout is None:
+        stale_timeout = timeout
+    lock = LOCK_CACHE_KEY.format(key)
+
+    entry = cache.get(key)
+    if entry is not None:
+        value, fresh_until, delta = entry
+        # 1 - random() is in (0, 1], its logarithm is <= 0
+        if time.time() - delta * beta * math.log(1 - random.random()) < fresh_until:
+            return value
+        if cache.add(lock, True, lock_timeout):
+            return _compute(key, compute, timeout, stale_timeout, cacheable)
+        # somebody is recomputing it already
+        return value
+
+    while True:
+        if cache.add(lock, True, lock_timeout):
+            return _compute(key, compute, timeout, stale_timeout, cacheable)
+        # wait for the caller holding the lock, its lock expires at the latest
+        time.sleep(WAIT_INTERVAL)
+        entry = cache.get(key)
+        if entry is not None:
+            return entry[0]
@@ -0,0 +1,78 @@
+"""
+The copy counters of the books: Book.copies_total, copies_available and
+copies_on_loan, so the book lists show and sort by availability without
+a join or an aggregate over the copies.
+"""
+from django.db.models import Count, F, IntegerField, OuterRef, Q, Subquery, Value
+from django.db.models.functions import Coalesce
+
+from .models import Book, BookInstance
+
+# the books are repaired in the chunks of this size
+REPAIR_CHUNK_SIZE = 1000
+
+
+def copy_deltas(status, sign=1):
+    """the counter deltas of adding (1) or removing (-1) a copy with the status"""
+    return {
+        'copies_total': sign,
+        'copies_available': sign * int(status == 'a'),
+        'copies_on_loan': sign * int(status == 'o'),
+    }
+
+
+def update_book_copies(book_id, **deltas):
+    """Applies the deltas to the counters of the book in one UPDATE ... SET x = x + 1."""
+    deltas = {name: delta for name, delta in deltas.items() if delta}
+    if book_id is None or not deltas:
+        return
+    Book.objects.filter(pk=book_id).update(**{name: F(name) + delta for name, delta in deltas.items()})
+
+
+def move_copy(old_book_id, old_status, new_book_id, new_status):
+    """Counts a copy which has changed its status or its book."""
+    if old_book_id == new_book_id:
+        old, new = copy_deltas(old_status, -1), copy_deltas(new_status)
+        update_book_copies(new_book_id, **{name: old[name] + new[name] for name in old})
+    else:
+        update_book_copies(old_book_id, **copy_deltas(old_status, -1))
+        update_book_copies(new_book_id, **copy_deltas(new_status))
+
+
+def _count(condition=Q()):
+    copies = (
+        BookInstance.objects.filter(condition, book=OuterRef('pk'))
+        .order_by().values('book').annotate(count=Count('*')).values('count')
+    )
+    return Coalesce(Subquery(copies, output_field=IntegerField()), Value(0))
+
+
+def counted_copies():
+    """the correlated subqueries recounting the copy counters of a book"""
+    return {
+        'copies_total': _count(),
+        'copies_available': _count(Q(status='a')),
+        'copies_on_loan': _count(Q(status='o')),
+    }
+
+
+def drifted_books():
+    """The books whose stored counters differ from a recount, a full scan: keep it off the request path."""
+    counted = {f'counted_{name}': expression for name, expression in counted_copies().items()}
+    return (
+        Book.objects.annotate(**counted)
+        .exclude(
+            copies_total=F('counted_copies_total'),
+            copies_available=F('counted_copies_available'),
+            copies_on_loan=F('counted_copies_on_loan'),
+        )
+        .order_by('pk')
+        .values_list('pk', *Book.COPIES, *counted)
+    )
+
+
+def repair_book_copies(book_ids):
+    """Recounts the counters of the given books, one UPDATE per chunk."""
+    book_ids = list(book_ids)
+    for start in range(0, len(book_ids), REPAIR_CHUNK_SIZE):
+        Book.objects.filter(pk__in=book_ids[start:start + REPAIR_CHUNK_SIZE]).update(**counted_copies())
@@ -0,0 +1,96 @@
+import csv
+import zlib
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+from .history import EVENT_FIELDS
+from .models import Author, Book, BookInstance, Genre, LoanEvent
+
+# the dataset name -> the queryset and the exported columns
+DATASETS = {
+    'books': (Book.objects.all(), ('id', 'title', 'author_id', 'summary', 'isbn', 'language_id')),
+    'book_genres': (Book.genre.through.objects.all(), ('book_id', 'genre_id')),
+    'authors': (
+        Author.objects.all(),
+        ('id', 'first_name', 'last_name', 'date_of_birth', 'date_of_death', 'biography'),
+    ),
+    'genres': (Genre.objects.all(), ('id', 'name')),
+    'book_instances': (
+        BookInstance.objects.all(),
+        ('id', 'book_id', 'imprint', 'due_back', 'status', 'borrower_id'),
+    ),
+    # the events not archived yet, see archive_loan_events
+    'loan_events': (LoanEvent.objects.all(), EVENT_FIELDS),
+}
+
+FORMATS = ('csv', 'jsonl')
+
+CONTENT_TYPES = {
+    'csv': 'text/csv',
+    'jsonl': 'application/x-ndjson',
+}
+
+DEFAULT_CHUNK_SIZE = 2000
+
+# the lines are glued into blocks of about this size before they are sent
+BLOCK_SIZE = 64 * 1024
+
+
+class Echo:
+    """A pseudo-buffer for csv.writer: the line is returned instead of stored."""
+
+    def write(self, value):
+        return value
+
+
+def export_rows(dataset, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Streams the rows of the dataset as tuples. values_list() + iterator()
+    never builds model instances nor keeps the whole result in memory.
+    """
+    queryset, fields = DATASETS[dataset]
+    return fields, queryset.order_by('pk').values_list(*fields).iterator(chunk_size=chunk_size)
+
+
+def csv_lines(fields, rows):
+    writer = csv.writer(Echo())
+    yield writer.writerow(fields)
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def jsonl_lines(fields, rows):
+    encoder = DjangoJSONEncoder(ensure_ascii=False)
+    for row in rows:
+        yield encoder.encode(dict(zip(fields, row))) + '\n'
+
+
+def blocks(lines, size=BLOCK_SIZE):
+    """Glues the short lines into blocks of bytes, one write per block."""
+    block, length = [], 0
+    for line in lines:
+        block.append(line)
+        length += len(line)
+        if length >= size:
+            yield ''.join(block).encode()
+            block, length = [], 0
+    if block:
+        yield ''.join(block).encode()
+
+
+def gzipped(chunks):
+    """Compresses a stream of bytes into a gzip stream on the fly."""
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export_stream(dataset, export_format, compress=False, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Returns an iterator of bytes with the whole dataset in the format."""
+    fields, rows = export_rows(dataset, chunk_size)
+    lines = csv_lines(fields, rows) if export_format == 'csv' else jsonl_lines(fields, rows)
+    stream = blocks(lines)
+    return gzipped(stream) if compress else stream
@@ -0,0 +1,121 @@
+from collections import Counter
+
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F
+from django.db.models.functions import Substr, Upper
+
+from .computed import get_or_compute
+from .models import Author, Book, FacetCount, Genre, Language
+
+# the key under which the facet counts live in the shared cache
+FACETS_CACHE_KEY = 'catalog:facets'
+FACETS_CACHE_TIMEOUT = 60
+
+
+def author_initial(last_name):
+    return last_name[:1].upper() if last_name else ''
+
+
+def author_initials(author_ids):
+    """Maps the given author ids to the initials of their last names."""
+    author_ids = [pk for pk in author_ids if pk is not None]
+    if not author_ids:
+        return {}
+    return {
+        pk: author_initial(last_name)
+        for pk, last_name in Author.objects.filter(pk__in=author_ids).values_list('pk', 'last_name')
+    }
+
+
+def update_facet_counts(deltas):
+    """
+    Applies a Counter of {(facet, value): delta} with F() increments,
+    creating the missing rows on the way.
+    """
+    changed = False
+    for (facet, value), delta in deltas.items():
+        if not delta or value in (None, ''):
+            continue
+        changed = True
+        value = str(value)
+        rows = FacetCount.objects.filter(facet=facet, value=value)
+        if rows.update(count=F('count') + delta):
+            continue
+        try:
+            with transaction.atomic():
+                FacetCount.objects.create(facet=facet, value=value, count=delta)
+        except IntegrityError:
+            # a concurrent writer has just created it
+            rows.update(count=F('count') + delta)
+    if changed:
+        invalidate_facets()
+
+
+def delete_facet(facet, value):
+    FacetCount.objects.filter(facet=facet, value=str(value)).delete()
+    invalidate_facets()
+
+
+def count_facets():
+    """Recounts all the facets with GROUP BY queries. Full scans, keep them off the request path."""
+    counts = Counter()
+    for genre_id, count in (
+        Book.genre.through.objects.values_list('genre_id').annotate(count=Count('*')).order_by()
+    ):
+        counts[FacetCount.GENRE, str(genre_id)] = count
+    for language_id, count in (
+        Book.objects.filter(language__isnull=False)
+        .values_list('language_id').annotate(count=Count('*')).order_by()
+    ):
+        counts[FacetCount.LANGUAGE, str(language_id)] = count
+    for initial, count in (
+        Book.objects.filter(author__isnull=False)
+        .annotate(initial=Upper(Substr('author__last_name', 1, 1)))
+        .values_list('initial').annotate(count=Count('*')).order_by()
+    ):
+        if initial:
+            counts[FacetCount.INITIAL, initial] += count
+    return counts
+
+
+def stored_facets():
+    return Counter({
+        (facet, value): count
+        for facet, value, count in FacetCount.objects.values_list('facet', 'value', 'count')
+    })
+
+
+def read_facets():
+    """The non-empty facets with their labels, ready for the book list."""
+    stored = stored_facets()
+    by_facet = {facet: {} for facet, _ in FacetCount.FACETS}
+    for (facet, value), count in stored.items():
+        if count > 0:
+            by_facet[facet][value] = count
+
+    genres = Genre.objects.in_bulk([int(pk) for pk in by_facet[FacetCount.GENRE]])
+    languages = Language.objects.in_bulk([int(pk) for pk in by_facet[FacetCount.LANGUAGE]])
+    return {
+        'genre': sorted(
+            (str(genres[int(pk)]), pk, count)
+            for pk, count in by_facet[FacetCount.GENRE].items() if int(pk) in genres
+        ),
+        'language': sorted(
+            (str(languages[int(pk)]), pk, count)
+            for pk, count in by_facet[FacetCount.LANGUAGE].items() if int(pk) in languages
+        ),
+        'initial': sorted(
+            (initial, initial, count) for initial, count in by_facet[FacetCount.INITIAL].items()
+        ),
+    }
+
+
+def get_facets():
+    """Returns the facets of the book list, from the cache when it is warm."""
+    return get_or_compute(FACETS_CACHE_KEY, read_facets, FACETS_CACHE_TIMEOUT)
+
+
+def invalidate_facets():
+    cache.delete(FACETS_CACHE_KEY)
+    transaction.on_commit(lambda: cache.delete(FACETS_CACHE_KEY))
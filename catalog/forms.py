@@ -2,6 +2,10 @@ from django import forms
 import datetime
 from django.core.exceptions import ValidationError
 from django.utils.translation import gettext_lazy as _
+from django.contrib.auth.models import User
+from django.urls import reverse
+
+from .models import Book
 
 
 class RenewBookForm(forms.Form):
@@ -27,3 +31,90 @@ class RenewBookForm(forms.Form):
 
         # Remember to always return the cleaned data.
         return data 
+
+
+class CheckoutForm(forms.Form):
+    """This form allows the librarians to lend a copy of a book to a reader"""
+    borrower = forms.CharField(
+        max_length=150,
+        help_text="Enter the username of the reader."
+    )
+    due_back = forms.DateField(
+        help_text="Enter a date between now and 4 weeks (default 3)."
+    )
+
+    def clean_borrower(self):
+        username = self.cleaned_data['borrower']
+        try:
+            return User.objects.get(username=username)
+        except User.DoesNotExist:
+            raise ValidationError(_('Unknown reader'))
+
+    def clean_due_back(self):
+        data = self.cleaned_data['due_back']
+        if not datetime.date.today() <= data <= datetime.date.today() + datetime.timedelta(weeks=4):
+            raise ValidationError(
+                _('Invalid date - has to be between now and 4 weeks ahead')
+            )
+        return data
+
+
+class LookupSelect(forms.Select):
+    """
+    A select which renders the chosen options only, lookup.js fetches the
+    others from the JSON lookup as the reader types. The form page costs
+    the same however big the table, and the field checks the submitted
+    keys with one query, a get() or an IN.
+    """
+    def __init__(self, lookup, attrs=None):
+        self.lookup = lookup
+        super().__init__(attrs)
+
+    class Media:
+        js = ['js/lookup.js']
+
+    def build_attrs(self, base_attrs, extra_attrs=None):
+        attrs = super().build_attrs(base_attrs, extra_attrs)
+        attrs['data-lookup-url'] = reverse('lookup', args=[self.lookup])
+        return attrs
+
+    def chosen(self, value):
+        """the chosen objects, the values which are not keys are left out"""
+        queryset = self.choices.queryset
+        keys = []
+        for key in value:
+            if key in (None, ''):
+                continue
+            try:
+                keys.append(queryset.model._meta.pk.to_python(key))
+            except ValidationError:
+                pass
+        return list(queryset.filter(pk__in=keys)) if keys else []
+
+    def optgroups(self, name, value, attrs=None):
+        options = []
+        if not self.allow_multiple_selected and not self.is_required:
+            options.append(('', self.choices.field.empty_label or '', not any(value)))
+        options.extend(
+            (obj.pk, self.choices.field.label_from_instance(obj), True) for obj in self.chosen(value)
+        )
+        return [
+            (None, [self.create_option(name, key, label, selected, index, attrs=attrs)], index)
+            for index, (key, label, selected) in enumerate(options)
+        ]
+
+
+class LookupSelectMultiple(LookupSelect, forms.SelectMultiple):
+    pass
+
+
+class BookForm(forms.ModelForm):
+    """The book form with lookups for the author, the genres and the language."""
+    class Meta:
+        model = Book
+        fields = ['title', 'author', 'summary', 'isbn', 'genre', 'language']
+        widgets = {
+            'author': LookupSelect('authors'),
+            'genre': LookupSelectMultiple('genres'),
+            'language': LookupSelect('languages'),
+        }
@@ -0,0 +1,102 @@
+"""
+The versions of the cached fragments of the book and author pages.
+
+Every book and author has a version stamp in the shared cache, the
+{% cache %} fragments of its page vary on it. The signal handlers and the
+loan service put a new stamp on every change of the object, its copies or
+its genres: the old fragments are never read again and expire on their
+own. A global stamp, part of every version, retires all the fragments at
+once after the bulk writes which bypass the signals.
+
+Every new stamp is also a new catalog version, which the cached pages of
+the lists vary on: any change of a book or an author changes them.
+
+A stamp is the time it was made followed by random digits, a stamp evicted
+from the cache is replaced by a new one, never by an older value that an
+outdated fragment could match. Its time tells when the object changed at
+the latest, the Last-Modified of the page.
+"""
+import datetime
+import time
+import uuid
+
+from django.core.cache import cache
+from django.db import transaction
+
+BOOK = 'book'
+AUTHOR = 'author'
+
+VERSION_CACHE_KEY = 'catalog:fragment:{}:{}'
+GLOBAL_VERSION_CACHE_KEY = 'catalog:fragment:all'
+CATALOG_VERSION_CACHE_KEY = 'catalog:version'
+
+# a fragment outlives its version only this long
+FRAGMENT_TIMEOUT = 60 * 60 * 24
+
+
+def _stamp():
+    # the microseconds in 13 hex digits keep the stamps sortable
+    return f'{time.time_ns() // 1000:013x}{uuid.uuid4().hex[:8]}'
+
+
+def stamp_time(version):
+    """The time of the newest stamp of a version."""
+    micros = max(int(stamp[:-8], 16) for stamp in version.split('.'))
+    return datetime.datetime.fromtimestamp(micros / 1_000_000, tz=datetime.timezone.utc)
+
+
+def _versions(keys):
+    versions = cache.get_many(keys)
+    missing = {name: _stamp() for name in keys if name not in versions}
+    # whoever comes first wins, the others read their stamp
+    for name, stamp in missing.items():
+        if not cache.add(name, stamp, None):
+            stamp = cache.get(name) or stamp
+        versions[name] = stamp
+    return [versions[name] for name in keys]
+
+
+def fragment_version(kind, pk):
+    """The version the fragments of the object vary on, one cache round-trip when warm."""
+    return '.'.join(_versions([GLOBAL_VERSION_CACHE_KEY, VERSION_CACHE_KEY.format(kind, pk)]))
+
+
+def catalog_version():
+    """The version of the whole catalog, new on every change of a book or an author."""
+    return _versions([CATALOG_VERSION_CACHE_KEY])[0]
+
+
+def _bump(kind, pks):
+    stamp = _stamp()
+    versions = {VERSION_CACHE_KEY.format(kind, pk): stamp for pk in pks}
+    versions[CATALOG_VERSION_CACHE_KEY] = stamp
+    cache.set_many(versions, None)
+
+
+def _bump_all():
+    stamp = _stamp()
+    cache.set_many({GLOBAL_VERSION_CACHE_KEY: stamp, CATALOG_VERSION_CACHE_KEY: stamp}, None)
+
+
+def invalidate_fragments(kind, pks):
+    """
+    New versions for the objects, now and once more after the commit: a
+    page rendered in between may have cached what the transaction had not
+    committed yet.
+    """
+    pks = {pk for pk in pks if pk is not None}
+    if not pks:
+        return
+    _bump(kind, pks)
+    transaction.on_commit(lambda: _bump(kind, pks))
+
+
+def invalidate_all_fragments():
+    _bump_all()
+    transaction.on_commit(_bump_all)
+
+
+def invalidate_catalog_version():
+    """For the changes shown on the lists only, the genre and language names."""
+    cache.set(CATALOG_VERSION_CACHE_KEY, _stamp(), None)
+    transaction.on_commit(lambda: cache.set(CATALOG_VERSION_CACHE_KEY, _stamp(), None))
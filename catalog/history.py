@@ -0,0 +1,98 @@
+"""
+The loan history: the append-only LoanEvent rows and their monthly rollups.
+
+The loan service logs every checkout, return and renewal. rollup_month()
+recounts the BookCirculation and BorrowerCirculation rows of a month with
+GROUP BY queries over its range of events, the circulation reports only
+read these rollups. The closed months are archived: rolled up, written out
+to a gzipped JSONL file and deleted, so the events table stays small. An
+archived month is recorded in ArchivedLoanMonth and never recounted, its
+events are gone.
+"""
+import datetime
+
+from django.db import transaction
+from django.db.models import Count, Q
+from django.utils import timezone
+
+from .models import ArchivedLoanMonth, BookCirculation, BorrowerCirculation, LoanEvent
+
+# the columns of the archived events
+EVENT_FIELDS = ('id', 'occurred_at', 'kind', 'copy_id', 'book_id', 'borrower_id', 'due_back')
+
+
+class MonthArchived(Exception):
+    """The events of the month are archived, its rollups can't be recounted."""
+
+
+def log_loan_event(kind, copy_id, book_id, borrower_id, due_back=None):
+    LoanEvent.objects.create(
+        kind=kind, copy_id=copy_id, book_id=book_id, borrower_id=borrower_id, due_back=due_back,
+    )
+
+
+def month_start(day):
+    return day.replace(day=1)
+
+
+def next_month(month):
+    return (month + datetime.timedelta(days=32)).replace(day=1)
+
+
+def month_range(month):
+    """the [start, end) datetimes of the month in the current time zone"""
+    return (
+        timezone.make_aware(datetime.datetime.combine(month, datetime.time())),
+        timezone.make_aware(datetime.datetime.combine(next_month(month), datetime.time())),
+    )
+
+
+def month_events(month):
+    start, end = month_range(month)
+    return LoanEvent.objects.filter(occurred_at__gte=start, occurred_at__lt=end)
+
+
+def event_months(before=None):
+    """the months which have events, before the given datetime if any"""
+    events = LoanEvent.objects.all()
+    if before is not None:
+        events = events.filter(occurred_at__lt=before)
+    return list(events.dates('occurred_at', 'month'))
+
+
+def is_archived(month):
+    return ArchivedLoanMonth.objects.filter(month=month).exists()
+
+
+def rollup_month(month):
+    """Recounts the rollups of the month from its events, returns the number of events."""
+    events = month_events(month).order_by()
+    with transaction.atomic():
+        if is_archived(month):
+            raise MonthArchived(f'the loan events of {month:%Y-%m} are archived')
+        BookCirculation.objects.filter(month=month).delete()
+        BorrowerCirculation.objects.filter(month=month).delete()
+
+        books = list(
+            events.filter(book__isnull=False).values('book')
+            .annotate(
+                checkouts=Count('pk', filter=Q(kind=LoanEvent.CHECKOUT)),
+                returns=Count('pk', filter=Q(kind=LoanEvent.RETURN)),
+                renewals=Count('pk', filter=Q(kind=LoanEvent.RENEWAL)),
+            )
+        )
+        BookCirculation.objects.bulk_create(
+            [BookCirculation(month=month, book_id=row.pop('book'), **row) for row in books],
+            batch_size=1000,
+        )
+        BorrowerCirculation.objects.bulk_create(
+            [
+                BorrowerCirculation(month=month, borrower_id=row['borrower'], checkouts=row['checkouts'])
+                for row in (
+                    events.filter(kind=LoanEvent.CHECKOUT, borrower__isnull=False)
+                    .values('borrower').annotate(checkouts=Count('pk'))
+                )
+            ],
+            batch_size=1000,
+        )
+    return sum(row['checkouts'] + row['returns'] + row['renewals'] for row in books)
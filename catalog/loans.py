@@ -0,0 +1,361 @@
+"""
+Checkout, return and renewal of the book copies, and the hold queues.
+
+Every operation is one short transaction around a conditional UPDATE: the
+row changes only while the copy is still in the expected status, so two
+librarians can never hand the same copy to two borrowers. On PostgreSQL
+the available copy is picked with SELECT ... FOR UPDATE SKIP LOCKED, the
+concurrent checkouts of a book grab different copies instead of queueing
+on the same one. SQLite has a single writer: the transactions write first
+to queue for the write lock, and a transaction that loses it is retried.
+
+The holds of a book are served first come, first served. A returned copy
+is set aside ('r') for the head of the queue, found with one seek of the
+partial (book, created_at, id) index. expire_reservations() releases the
+copies which are not picked up in time with set-based UPDATEs.
+"""
+import datetime
+import random
+import time
+from collections import defaultdict
+
+from django.db import IntegrityError, OperationalError, connection, transaction
+from django.db.models import F, OuterRef, Subquery
+from django.utils import timezone
+
+from .copies import repair_book_copies, update_book_copies
+from .fragments import BOOK, invalidate_fragments
+from .history import log_loan_event
+from .models import Book, BookInstance, CatalogStats, LoanEvent, Reservation
+from .stats import STATS_PK, invalidate_catalog_stats, update_catalog_stats
+
+LOAN_PERIOD = datetime.timedelta(weeks=3)
+MAX_RENEWAL = datetime.timedelta(weeks=4)
+
+# how long a copy set aside for a hold waits for its reader
+HOLD_PERIOD = datetime.timedelta(days=3)
+
+# the copies a checkout tries before it gives up, each lost race costs one
+MAX_CLAIMS = 5
+
+# the attempts of a transaction which can't get the SQLite write lock
+LOCK_ATTEMPTS = 10
+
+# the books the expiry job serves per round of queries
+SERVE_CHUNK_SIZE = 500
+
+
+class LoanError(Exception):
+    """The copy is not in the status the operation needs."""
+
+
+class NoCopyAvailable(LoanError):
+    pass
+
+
+def _atomic(operation):
+    for attempt in range(LOCK_ATTEMPTS):
+        try:
+            with transaction.atomic():
+                return operation()
+        except OperationalError as error:
+            # a deferred SQLite transaction which has read a snapshot can't
+            # upgrade to the write lock after another writer committed
+            if (
+                connection.vendor != 'sqlite'
+                or connection.in_atomic_block
+                or 'locked' not in str(error)
+                or attempt == LOCK_ATTEMPTS - 1
+            ):
+                raise
+            time.sleep(random.uniform(0, 0.005 * 2 ** attempt))
+
+
+def _take_write_lock():
+    """
+    SQLite: a write first, the transaction waits for the write lock right
+    away instead of failing to upgrade its read lock after the SELECTs
+    """
+    if connection.vendor == 'sqlite':
+        CatalogStats.objects.filter(pk=STATS_PK).update(num_books=F('num_books'))
+
+
+def _count_available(delta):
+    # .update() sends no post_save, keep the homepage counters right
+    update_catalog_stats(num_instances_available=delta)
+    invalidate_catalog_stats()
+    transaction.on_commit(invalidate_catalog_stats)
+
+
+def _claim_copy(book_id, **changes):
+    """Takes an available copy of the book, returns its id or None."""
+    available = BookInstance.objects.filter(book_id=book_id, status='a').order_by()
+    for _ in range(MAX_CLAIMS):
+        copy_id = available.select_for_update(skip_locked=True).values_list('pk', flat=True).first()
+        if copy_id is None:
+            return None
+        # only if nobody has taken it since the SELECT
+        if BookInstance.objects.filter(pk=copy_id, status='a').update(**changes):
+            return copy_id
+    return None
+
+
+def _hold_for_next(book_id, copy_id):
+    """Sets the copy aside for the oldest waiting hold of the book, if any."""
+    hold = (
+        Reservation.objects.select_for_update()
+        .filter(book_id=book_id, state=Reservation.WAITING)
+        .order_by('created_at', 'id')
+        .values_list('pk', 'patron_id')
+        .first()
+    )
+    if hold is None:
+        return False
+    pk, patron_id = hold
+    expires_at = timezone.now() + HOLD_PERIOD
+    BookInstance.objects.filter(pk=copy_id).update(
+        status='r', borrower_id=patron_id, due_back=timezone.localdate(expires_at),
+    )
+    Reservation.objects.filter(pk=pk).update(state=Reservation.READY, copy_id=copy_id, expires_at=expires_at)
+    return True
+
+
+def checkout(book_id, borrower, due_back=None):
+    """
+    Lends a copy of the book to the borrower, returns the copy id. The copy
+    set aside for the borrower's hold goes first, then any available one.
+    """
+    due_back = due_back or datetime.date.today() + LOAN_PERIOD
+
+    def claim():
+        _take_write_lock()
+        hold = (
+            Reservation.objects.select_for_update()
+            .filter(book_id=book_id, patron=borrower, state=Reservation.READY)
+            .values_list('pk', 'copy_id')
+            .first()
+        )
+        if hold and BookInstance.objects.filter(pk=hold[1], status='r').update(
+            status='o', borrower=borrower, due_back=due_back,
+        ):
+            Reservation.objects.filter(pk=hold[0]).update(state=Reservation.FULFILLED)
+            update_book_copies(book_id, copies_on_loan=1)
+            invalidate_fragments(BOOK, [book_id])
+            log_loan_event(LoanEvent.CHECKOUT, hold[1], book_id, borrower.pk, due_back)
+            return hold[1]
+
+        copy_id = _claim_copy(book_id, status='o', borrower=borrower, due_back=due_back)
+        if copy_id is None:
+            raise NoCopyAvailable(f'No copy of the book {book_id} is available.')
+        # the borrower's place in the queue is not needed any more
+        Reservation.objects.filter(book_id=book_id, patron=borrower, state=Reservation.WAITING).update(
+            state=Reservation.FULFILLED,
+        )
+        _count_available(-1)
+        update_book_copies(book_id, copies_available=-1, copies_on_loan=1)
+        invalidate_fragments(BOOK, [book_id])
+        log_loan_event(LoanEvent.CHECKOUT, copy_id, book_id, borrower.pk, due_back)
+        return copy_id
+
+    return _atomic(claim)
+
+
+def return_copy(copy_id):
+    """Takes the copy back from its borrower, for the next hold or the shelf."""
+    def give_back():
+        _take_write_lock()
+        # the loan as it was, for the history
+        loan = BookInstance.objects.filter(pk=copy_id).values_list('book_id', 'borrower_id', 'due_back').first()
+        if loan is None or not BookInstance.objects.filter(pk=copy_id, status='o').update(
+            status='a', borrower=None, due_back=None,
+        ):
+            raise LoanError(f'The copy {copy_id} is not on loan.')
+        book_id, borrower_id, due_back = loan
+        invalidate_fragments(BOOK, [book_id])
+        log_loan_event(LoanEvent.RETURN, copy_id, book_id, borrower_id, due_back)
+        if _hold_for_next(book_id, copy_id):
+            update_book_copies(book_id, copies_on_loan=-1)
+        else:
+            _count_available(1)
+            update_book_copies(book_id, copies_available=1, copies_on_loan=-1)
+
+    _atomic(give_back)
+
+
+def renew(copy_id, due_back):
+    """Moves the due date of a copy on loan, at most MAX_RENEWAL from today."""
+    today = datetime.date.today()
+    if not today <= due_back <= today + MAX_RENEWAL:
+        raise LoanError(f'The due date has to be between {today} and {today + MAX_RENEWAL}.')
+
+    def extend():
+        _take_write_lock()
+        if not BookInstance.objects.filter(pk=copy_id, status='o').update(due_back=due_back):
+            raise LoanError(f'The copy {copy_id} is not on loan.')
+        book_id, borrower_id = BookInstance.objects.filter(pk=copy_id).values_list('book_id', 'borrower_id').get()
+        invalidate_fragments(BOOK, [book_id])
+        log_loan_event(LoanEvent.RENEWAL, copy_id, book_id, borrower_id, due_back)
+
+    _atomic(extend)
+
+
+def reserve(book_id, patron):
+    """
+    Puts the reader in the queue of the book, returns the hold id. With an
+    empty queue and a copy on the shelf the copy is set aside right away.
+    """
+    def place():
+        _take_write_lock()
+        if BookInstance.objects.filter(book_id=book_id, borrower=patron, status='o').exists():
+            raise LoanError(f'{patron} already has the book {book_id} on loan.')
+        queued = Reservation.objects.filter(book_id=book_id, state=Reservation.WAITING).exists()
+        try:
+            with transaction.atomic():
+                hold = Reservation.objects.create(book_id=book_id, patron=patron)
+        except IntegrityError:
+            raise LoanError(f'{patron} already holds the book {book_id}.')
+        if queued:
+            return hold.pk
+
+        expires_at = timezone.now() + HOLD_PERIOD
+        copy_id = _claim_copy(book_id, status='r', borrower=patron, due_back=timezone.localdate(expires_at))
+        if copy_id is not None:
+            Reservation.objects.filter(pk=hold.pk).update(
+                state=Reservation.READY, copy_id=copy_id, expires_at=expires_at,
+            )
+            _count_available(-1)
+            update_book_copies(book_id, copies_available=-1)
+            invalidate_fragments(BOOK, [book_id])
+        return hold.pk
+
+    return _atomic(place)
+
+
+def cancel_reservation(reservation_id, patron):
+    """Drops the hold, a copy set aside for it goes to the next one in the queue."""
+    def cancel():
+        _take_write_lock()
+        hold = (
+            Reservation.objects.select_for_update()
+            .filter(pk=reservation_id, patron=patron, state__in=[Reservation.WAITING, Reservation.READY])
+            .values_list('book_id', 'copy_id', 'state')
+            .first()
+        )
+        if hold is None:
+            raise LoanError(f'The hold {reservation_id} is not active.')
+        book_id, copy_id, state = hold
+        Reservation.objects.filter(pk=reservation_id).update(state=Reservation.CANCELLED)
+        if state == Reservation.READY and BookInstance.objects.filter(pk=copy_id, status='r').update(
+            status='a', borrower=None, due_back=None,
+        ):
+            invalidate_fragments(BOOK, [book_id])
+            if not _hold_for_next(book_id, copy_id):
+                _count_available(1)
+                update_book_copies(book_id, copies_available=1)
+
+    _atomic(cancel)
+
+
+def _set_aside(pairs, expires_at):
+    """
+    Marks the (hold, copy) pairs ready: one UPDATE with a CASE mapping the
+    holds to their copies, then one UPDATE of the copies which takes the
+    readers from the holds. bulk_update() builds an expression per row and
+    per field, far too slow for tens of thousands of rows.
+    """
+    table = connection.ops.quote_name(Reservation._meta.db_table)
+    copy_field = Reservation._meta.get_field('copy')
+    cases = ' '.join(['WHEN %s THEN %s'] * len(pairs))
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'UPDATE {table} SET state = %s, expires_at = %s, copy_id = CASE id {cases} END '
+            f'WHERE id IN ({", ".join(["%s"] * len(pairs))})',
+            [
+                Reservation.READY,
+                Reservation._meta.get_field('expires_at').get_db_prep_value(expires_at, connection),
+                *(
+                    value for pk, copy_id in pairs
+                    for value in (pk, copy_field.get_db_prep_value(copy_id, connection))
+                ),
+                *(pk for pk, _ in pairs),
+            ],
+        )
+    BookInstance.objects.filter(pk__in=[copy_id for _, copy_id in pairs]).update(
+        status='r',
+        due_back=timezone.localdate(expires_at),
+        borrower_id=Subquery(
+            Reservation.objects.filter(copy_id=OuterRef('pk'), state=Reservation.READY).values('patron_id')[:1]
+        ),
+    )
+
+
+def serve_queues(book_ids):
+    """
+    Sets the available copies of the books aside for their waiting holds,
+    in bulk: per chunk of books one locking SELECT of the copies and one of
+    the holds, matched in memory, and two UPDATEs.
+    Returns the number of the holds served.
+    """
+    book_ids = sorted(book_ids)
+    served = 0
+    expires_at = timezone.now() + HOLD_PERIOD
+    for start in range(0, len(book_ids), SERVE_CHUNK_SIZE):
+        chunk = book_ids[start:start + SERVE_CHUNK_SIZE]
+        shelves = defaultdict(list)
+        for copy_id, book_id in (
+            BookInstance.objects.select_for_update(skip_locked=True)
+            .filter(book_id__in=chunk, status='a')
+            .order_by('book_id', 'pk')
+            .values_list('pk', 'book_id')
+        ):
+            shelves[book_id].append(copy_id)
+        if not shelves:
+            continue
+
+        pairs = []
+        for pk, book_id in (
+            Reservation.objects.select_for_update()
+            .filter(book_id__in=list(shelves), state=Reservation.WAITING)
+            .order_by('book_id', 'created_at', 'id')
+            .values_list('pk', 'book_id')
+        ):
+            if shelves[book_id]:
+                pairs.append((pk, shelves[book_id].pop(0)))
+        if pairs:
+            _set_aside(pairs, expires_at)
+        served += len(pairs)
+    return served
+
+
+def expire_reservations(now=None):
+    """
+    Expires the ready holds past their pickup deadline and passes their
+    copies on to the queues, set-based: a handful of UPDATE ... WHERE
+    statements no matter how many holds expire.
+    Returns the (expired, served) pair.
+    """
+    now = now or timezone.now()
+
+    def expire():
+        _take_write_lock()
+        overdue = Reservation.objects.filter(state=Reservation.READY, expires_at__lte=now)
+        book_ids = set(overdue.order_by().values_list('book_id', flat=True).distinct())
+        released = BookInstance.objects.filter(
+            pk__in=overdue.order_by().values('copy_id'), status='r',
+        ).update(status='a', borrower=None, due_back=None)
+        expired = overdue.update(state=Reservation.EXPIRED)
+
+        # and the books whose copies came back to the shelf some other way
+        book_ids.update(
+            Book.objects.filter(copies_available__gt=0, reservation__state=Reservation.WAITING)
+            .order_by().values_list('pk', flat=True).distinct()
+        )
+        served = serve_queues(book_ids)
+
+        if released != served:
+            _count_available(released - served)
+        repair_book_copies(book_ids)
+        invalidate_fragments(BOOK, book_ids)
+        return expired, served
+
+    return _atomic(expire)
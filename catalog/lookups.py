@@ -0,0 +1,50 @@
+"""
+The JSON lookups behind the select widgets of the edit forms: the authors,
+genres and languages starting with the typed text, a page at a time. Every
+lookup is a range scan of an index, never a LIKE '%...%' over the table.
+"""
+from django.db.models import Q
+
+from .models import Author, Genre, Language
+
+LOOKUP_PAGE_SIZE = 20
+# the deep pages would cost an OFFSET scan each, the reader types more letters instead
+MAX_LOOKUP_PAGE = 50
+
+# the lookup name -> the model, the searched field and the ordering (its index)
+LOOKUPS = {
+    'authors': (Author, 'last_name', ('last_name', 'first_name', 'id')),
+    'genres': (Genre, 'name', ('name', 'id')),
+    'languages': (Language, 'name', ('name', 'id')),
+}
+
+
+def prefix_search(field, term):
+    """
+    The values of the field starting with the term, as the range
+    term <= value < term + U+10FFFF, which any index of the field serves.
+    The term is tried as typed, in lower case and capitalized.
+    """
+    condition = Q()
+    for variant in {term, term.lower(), term.capitalize()}:
+        condition |= Q(**{f'{field}__gte': variant, f'{field}__lt': variant + '\U0010ffff'})
+    return condition
+
+
+def lookup(name, query, page=1, page_size=LOOKUP_PAGE_SIZE):
+    """
+    Returns ([{'id', 'text'}], more) for the page of the matches. The pages
+    past MAX_LOOKUP_PAGE are empty.
+    """
+    if page > MAX_LOOKUP_PAGE:
+        return [], False
+    model, field, ordering = LOOKUPS[name]
+    queryset = model.objects.order_by(*ordering)
+    query = query.strip()
+    if query:
+        queryset = queryset.filter(prefix_search(field, query))
+    # one row more tells whether there is a next page, without a COUNT
+    start = (page - 1) * page_size
+    rows = list(queryset[start:start + page_size + 1])
+    more = len(rows) > page_size and page < MAX_LOOKUP_PAGE
+    return [{'id': obj.pk, 'text': str(obj)} for obj in rows[:page_size]], more
@@ -0,0 +1,59 @@
+import datetime
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from ...export import blocks, gzipped, jsonl_lines
+from ...history import EVENT_FIELDS, event_months, month_events, month_range, month_start, rollup_month
+from ...models import ArchivedLoanMonth
+
+# python manage.py archive_loan_events --keep-months=3 --output-dir=/var/backups/loans  (monthly, from cron)
+
+
+class Command(BaseCommand):
+    help = (
+        "move the loan events of the closed months out of the database: roll the month up, "
+        "write its events to a gzipped JSONL file and delete them."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--keep-months', type=int, default=3,
+                            help="Months kept in the table, the current one included")
+        parser.add_argument('--output-dir', type=str, default='loan-archive', help="Directory of the archive files")
+        parser.add_argument('--dry-run', action='store_true', help="Only list the months to archive")
+
+    def handle(self, *args, **options):
+        if options['keep_months'] <= 0:
+            raise CommandError('--keep-months has to be a positive number')
+        cutoff = month_start(timezone.localdate())
+        for _ in range(options['keep_months'] - 1):
+            cutoff = month_start(cutoff - datetime.timedelta(days=1))
+
+        months = event_months(before=month_range(cutoff)[0])
+        if not months:
+            self.stdout.write(f'no loan events before {cutoff:%Y-%m}')
+            return
+        if not options['dry_run']:
+            os.makedirs(options['output_dir'], exist_ok=True)
+        for month in months:
+            path = os.path.join(options['output_dir'], f'loan-events-{month:%Y-%m}.jsonl.gz')
+            if options['dry_run']:
+                self.stdout.write(f'{month:%Y-%m}: {month_events(month).count()} event(s) -> {path}')
+                continue
+            self.archive(month, path)
+
+    def archive(self, month, path):
+        events = rollup_month(month)
+        rows = month_events(month).order_by('pk').values_list(*EVENT_FIELDS).iterator(chunk_size=2000)
+        # write and rename, a crash never leaves a half-written archive
+        with open(f'{path}.tmp', 'wb') as archive:
+            for chunk in gzipped(blocks(jsonl_lines(EVENT_FIELDS, rows))):
+                archive.write(chunk)
+        os.replace(f'{path}.tmp', path)
+        with transaction.atomic():
+            deleted, _ = month_events(month).delete()
+            # the rollups of the month are final from now on
+            ArchivedLoanMonth.objects.create(month=month, events=deleted)
+        self.stdout.write(f'{month:%Y-%m}: {events} event(s) rolled up, {deleted} archived to {path}')
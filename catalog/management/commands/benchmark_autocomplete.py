@@ -0,0 +1,58 @@
+import random
+import string
+import time
+import tracemalloc
+
+from django.core.management.base import BaseCommand
+
+from ...autocomplete import PrefixIndex, book_entry
+
+# python manage.py benchmark_autocomplete --titles=100000
+
+
+def fake_title(rng):
+    words = rng.randint(1, 5)
+    return ' '.join(
+        ''.join(rng.choices(string.ascii_lowercase, k=rng.randint(3, 10))).title()
+        for _ in range(words)
+    )
+
+
+class Command(BaseCommand):
+    help = "measure the memory footprint and the lookup speed of the autocomplete index."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--titles', type=int, default=100000, help="Number of titles to index")
+        parser.add_argument('--lookups', type=int, default=10000, help="Number of prefix lookups")
+        parser.add_argument('--seed', type=int, default=0, help="Random seed")
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        titles = [fake_title(rng) for _ in range(options['titles'])]
+
+        tracemalloc.start()
+        started = time.perf_counter()
+        index = PrefixIndex.from_entries(book_entry(pk, title) for pk, title in enumerate(titles, 1))
+        build_time = time.perf_counter() - started
+        footprint, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        prefixes = [title[:rng.randint(1, 6)] for title in rng.choices(titles, k=options['lookups'])]
+        started = time.perf_counter()
+        for prefix in prefixes:
+            index.lookup(prefix)
+        lookup_time = time.perf_counter() - started
+
+        started = time.perf_counter()
+        updates = min(1000, len(titles))
+        for pk in range(1, updates + 1):
+            index.add(*book_entry(pk, fake_title(rng)))
+        update_time = time.perf_counter() - started
+
+        per_100k = footprint * 100000 / max(len(titles), 1)
+        self.stdout.write(f'titles indexed:       {len(titles)}')
+        self.stdout.write(f'build time:           {build_time:.2f} s')
+        self.stdout.write(f'memory footprint:     {footprint / 2 ** 20:.1f} MiB (peak {peak / 2 ** 20:.1f} MiB)')
+        self.stdout.write(f'memory per 100k:      {per_100k / 2 ** 20:.1f} MiB')
+        self.stdout.write(f'lookup:               {lookup_time * 10 ** 6 / len(prefixes):.1f} us')
+        self.stdout.write(f'incremental update:   {update_time * 10 ** 6 / updates:.1f} us')
@@ -0,0 +1,48 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from ...stats import (
+    count_catalog_stats, get_catalog_stats, invalidate_catalog_stats, stats_querysets
+)
+
+# python manage.py benchmark_index --requests=500
+
+
+def legacy_stats():
+    """the way index() used to count: one COUNT(*) round-trip per counter"""
+    return {name: queryset.count() for name, queryset in stats_querysets().items()}
+
+
+class Command(BaseCommand):
+    help = "measure the cost of the homepage counters: six COUNTs vs the cached counters row."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200, help="Number of requests per scenario")
+
+    def handle(self, *args, **options):
+        number = options['requests']
+        scenarios = (
+            ('six COUNT queries', legacy_stats, None),
+            ('one aggregate recount', count_catalog_stats, None),
+            ('counters row, cold cache', get_catalog_stats, invalidate_catalog_stats),
+            ('counters row, warm cache', get_catalog_stats, None),
+        )
+
+        self.stdout.write('{:<28} {:>12} {:>14}'.format('scenario', 'ms/request', 'queries/request'))
+        for title, func, before_each in scenarios:
+            # warm up the connection (and the cache for the last scenario)
+            func()
+            elapsed = 0.0
+            with CaptureQueriesContext(connection) as queries:
+                for _ in range(number):
+                    if before_each:
+                        before_each()
+                    started = time.perf_counter()
+                    func()
+                    elapsed += time.perf_counter() - started
+            self.stdout.write('{:<28} {:>12.3f} {:>14.2f}'.format(
+                title, elapsed * 1000 / number, len(queries) / number
+            ))
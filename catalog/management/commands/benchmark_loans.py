@@ -0,0 +1,119 @@
+import threading
+import time
+from collections import Counter
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from ...loans import NoCopyAvailable, checkout, return_copy
+from ...models import Book, BookInstance, LoanEvent, User
+
+# python manage.py benchmark_loans --threads=16 --copies=10 --operations=500
+
+BENCHMARK_ISBN = '0000000000000'
+BENCHMARK_USER = 'benchmark-loans-{}'
+
+
+class Command(BaseCommand):
+    help = "hammer the loan service from many threads, check for double loans and report transactions/s."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=8, help="Concurrent borrowers")
+        parser.add_argument('--copies', type=int, default=4, help="Copies of the benchmark book")
+        parser.add_argument('--operations', type=int, default=200, help="Checkouts per thread")
+        parser.add_argument('--hold', type=float, default=1, help="Milliseconds a borrower keeps the copy")
+
+    def handle(self, *args, **options):
+        if min(options['threads'], options['copies'], options['operations']) <= 0:
+            raise CommandError('--threads, --copies and --operations have to be positive numbers')
+        if connection.vendor == 'sqlite':
+            # the readers don't block the writer, the journal mode sticks to the file
+            with connection.cursor() as cursor:
+                cursor.execute('PRAGMA journal_mode=WAL')
+                self.stdout.write(f'sqlite journal mode: {cursor.fetchone()[0]}')
+
+        book, users = self.set_up(options['threads'], options['copies'])
+        try:
+            self.run(book, users, options['operations'], options['hold'] / 1000)
+        finally:
+            self.clean_up([book.pk], [user.pk for user in users])
+
+    @staticmethod
+    def clean_up(book_ids, user_ids):
+        """the benchmark data, its loan history included: it would count in the rollups and the similar books"""
+        LoanEvent.objects.filter(book__in=book_ids).delete()
+        LoanEvent.objects.filter(borrower__in=user_ids).delete()
+        BookInstance.objects.filter(book__in=book_ids).delete()
+        Book.objects.filter(pk__in=book_ids).delete()
+        User.objects.filter(pk__in=user_ids).delete()
+
+    def set_up(self, threads, copies):
+        # the leftovers of an interrupted run
+        self.clean_up(
+            list(Book.objects.filter(isbn=BENCHMARK_ISBN).values_list('pk', flat=True)),
+            list(User.objects.filter(username__startswith=BENCHMARK_USER.format('')).values_list('pk', flat=True)),
+        )
+        book = Book.objects.create(title='Loan benchmark', summary='', isbn=BENCHMARK_ISBN)
+        for _ in range(copies):
+            BookInstance.objects.create(book=book, imprint='benchmark', status='a')
+        users = [
+            User.objects.get_or_create(username=BENCHMARK_USER.format(number))[0]
+            for number in range(threads)
+        ]
+        return book, users
+
+    def run(self, book, users, operations, hold):
+        held = set()
+        lock = threading.Lock()
+        results = Counter()
+
+        def borrower(user):
+            try:
+                for _ in range(operations):
+                    try:
+                        copy_id = checkout(book.pk, user)
+                    except NoCopyAvailable:
+                        with lock:
+                            results['no copy available'] += 1
+                        continue
+                    with lock:
+                        if copy_id in held:
+                            results['double loans'] += 1
+                        held.add(copy_id)
+                        results['checkouts'] += 1
+                    # any other checkout of the copy meanwhile is a double loan
+                    time.sleep(hold)
+                    # forget it before it is available again
+                    with lock:
+                        held.discard(copy_id)
+                    return_copy(copy_id)
+                    with lock:
+                        results['returns'] += 1
+            except Exception as error:
+                with lock:
+                    results[f'errors ({type(error).__name__}: {error})'] += 1
+            finally:
+                if len(users) > 1:
+                    connection.close()
+
+        started = time.perf_counter()
+        if len(users) == 1:
+            borrower(users[0])
+        else:
+            workers = [threading.Thread(target=borrower, args=(user,)) for user in users]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+        elapsed = time.perf_counter() - started
+
+        on_loan = BookInstance.objects.filter(book=book, status='o').count()
+        transactions = results['checkouts'] + results['returns'] + results['no copy available']
+        for name, count in sorted(results.items()):
+            self.stdout.write(f'{name}: {count}')
+        self.stdout.write('{} transactions in {:.2f}s: {:.0f} transactions/s ({})'.format(
+            transactions, elapsed, transactions / elapsed, connection.vendor,
+        ))
+        if results['double loans'] or on_loan:
+            raise CommandError(f'{results["double loans"]} double loan(s), {on_loan} copies left on loan')
+        self.stdout.write(self.style.SUCCESS('no double loans.'))
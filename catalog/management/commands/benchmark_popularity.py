@@ -0,0 +1,67 @@
+import datetime
+import random
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+
+from ...models import Book, BookLoanDay
+from ...popularity import WINDOWS, count_loan, top_books, update_popular_books
+
+# python manage.py benchmark_popularity --books=1000 --events=20000
+
+
+class Command(BaseCommand):
+    help = "measure the cost of counting a checkout in the popular books windows, and of reading and recounting them."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--books', type=int, default=500, help="Books the checkouts are spread over")
+        parser.add_argument('--events', type=int, default=10000, help="Checkouts to count")
+        parser.add_argument('--days', type=int, default=365, help="Days the checkouts are spread over")
+
+    def handle(self, *args, **options):
+        if min(options['books'], options['events'], options['days']) <= 0:
+            raise CommandError('--books, --events and --days have to be positive numbers')
+        # everything is rolled back at the end, the catalog stays as it was
+        with transaction.atomic():
+            self.run(options['books'], options['events'], options['days'])
+            transaction.set_rollback(True)
+
+    def run(self, books, events, days):
+        book_ids = [
+            book.pk for book in Book.objects.bulk_create(
+                [Book(title=f'Popularity benchmark {number}', summary='', isbn=f'P{number:012}')
+                 for number in range(books)]
+            )
+        ]
+        today = timezone.localdate()
+        # a few books take most of the loans, as in a real library
+        weights = [1 / (rank + 1) for rank in range(books)]
+        loans = [
+            (book_id, today - datetime.timedelta(days=random.randrange(days)))
+            for book_id in random.choices(book_ids, weights, k=events)
+        ]
+
+        started = time.perf_counter()
+        for book_id, day in loans:
+            # a savepoint per checkout, like the transaction of a loan
+            with transaction.atomic():
+                count_loan(book_id, day)
+        elapsed = time.perf_counter() - started
+        self.stdout.write('{} checkouts counted in {:.2f}s: {:.0f} µs per checkout ({})'.format(
+            events, elapsed, elapsed / events * 1e6, connection.vendor,
+        ))
+
+        started = time.perf_counter()
+        for window in WINDOWS:
+            top_books(window)
+        self.stdout.write('top books of {} windows read in {:.2f} ms'.format(
+            len(WINDOWS), (time.perf_counter() - started) * 1000,
+        ))
+
+        started = time.perf_counter()
+        recounted = update_popular_books(today)
+        self.stdout.write('{} books recounted from {} daily buckets in {:.2f}s'.format(
+            recounted, BookLoanDay.objects.count(), time.perf_counter() - started,
+        ))
@@ -0,0 +1,27 @@
+import importlib.util
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...similarity import NEIGHBOURS, compute_similar_books
+
+# python manage.py compute_similar_books --neighbours=10  (from cron, e.g. nightly; needs numpy and scipy)
+
+
+class Command(BaseCommand):
+    help = "precompute the similar books of every book from the shared genres, authors, languages and readers."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--neighbours', type=int, default=NEIGHBOURS, help="Similar books kept per book")
+        parser.add_argument('--batch-size', type=int, default=None,
+                            help="Books compared against the catalog at a time (default: by the catalog size)")
+
+    def handle(self, *args, **options):
+        if options['neighbours'] <= 0 or (options['batch_size'] is not None and options['batch_size'] <= 0):
+            raise CommandError('--neighbours and --batch-size have to be positive numbers')
+        if not all(importlib.util.find_spec(name) for name in ('numpy', 'scipy')):
+            raise CommandError('compute_similar_books needs numpy and scipy: pip install -r requirements.txt')
+
+        started = time.perf_counter()
+        stored = compute_similar_books(options['neighbours'], options['batch_size'])
+        self.stdout.write(f'{stored} similar book(s) stored in {time.perf_counter() - started:.2f}s')
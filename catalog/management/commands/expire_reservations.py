@@ -0,0 +1,18 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from ...loans import expire_reservations
+
+# python manage.py expire_reservations  (from cron, e.g. every 10 minutes)
+
+
+class Command(BaseCommand):
+    help = "expire the holds not picked up in time and pass their copies on to the next readers."
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        expired, served = expire_reservations()
+        self.stdout.write('{} hold(s) expired, {} hold(s) served in {:.2f}s'.format(
+            expired, served, time.perf_counter() - started,
+        ))
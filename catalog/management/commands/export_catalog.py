@@ -0,0 +1,35 @@
+import sys
+
+from django.core.management.base import BaseCommand
+
+from ...export import DATASETS, DEFAULT_CHUNK_SIZE, FORMATS, export_stream
+
+# python manage.py export_catalog book_instances --format=jsonl --gzip --output=copies.jsonl.gz
+
+
+class Command(BaseCommand):
+    help = "stream a catalog table as CSV or JSONL, the memory use doesn't depend on its size."
+
+    def add_arguments(self, parser):
+        parser.add_argument('dataset', choices=sorted(DATASETS), help="What to export")
+        parser.add_argument('--format', choices=FORMATS, default='csv', help="Output format")
+        parser.add_argument('--gzip', action='store_true', help="Compress the output with gzip")
+        parser.add_argument('--output', type=str, default='-', help="Output file, stdout by default")
+        parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE, help="Rows per database fetch")
+
+    def handle(self, *args, **options):
+        stream = export_stream(
+            options['dataset'],
+            options['format'],
+            compress=options['gzip'],
+            chunk_size=options['chunk_size'],
+        )
+        if options['output'] == '-':
+            output = sys.stdout.buffer
+            for chunk in stream:
+                output.write(chunk)
+            output.flush()
+        else:
+            with open(options['output'], 'wb') as output:
+                for chunk in stream:
+                    output.write(chunk)
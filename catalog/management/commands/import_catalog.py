@@ -0,0 +1,358 @@
+import csv
+import gzip
+import json
+import os
+import re
+import time
+from collections import Counter
+from itertools import islice
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from ...autocomplete import catalog_autocomplete
+from ...fragments import invalidate_all_fragments
+from ...models import Author, Book, Genre, Language
+from ...search import index_books
+
+# python manage.py import_catalog partner.jsonl.gz --chunk-size=2000 --update
+
+FORMATS = ('csv', 'jsonl', 'marc')
+
+# the most characters of a title and a summary, as the book form allows
+TITLE_LENGTH = Book._meta.get_field('title').max_length
+SUMMARY_LENGTH = Book._meta.get_field('summary').max_length
+
+# the fields of a book that --update overwrites
+UPDATE_FIELDS = ('title', 'summary', 'author', 'language')
+
+
+def normalize_isbn(value):
+    isbn = re.sub(r'[\s-]', '', value or '').upper()
+    if re.fullmatch(r'\d{13}|\d{9}[\dX]', isbn):
+        return isbn
+    return None
+
+
+def split_author(name):
+    """'Herbert, Frank' or 'Frank Herbert' -> ('Frank', 'Herbert')"""
+    name = (name or '').strip().rstrip(',.').strip()
+    if not name:
+        return None
+    if ',' in name:
+        last_name, first_name = (part.strip() for part in name.split(',', 1))
+    else:
+        first_name, _, last_name = name.rpartition(' ')
+    return first_name.strip(), last_name.strip()
+
+
+def split_genres(value):
+    if isinstance(value, list):
+        names = [text(name) for name in value]
+    else:
+        names = re.split(r'[|;]', text(value))
+    return [name.strip() for name in names if name and name.strip()]
+
+
+def text(value):
+    """a JSONL value keeps its JSON type, a number ISBN or title is read as its text"""
+    return '' if value is None else str(value)
+
+
+def book_record(row):
+    """
+    A CSV/JSONL row -> the import record. The author is either 'author'
+    ('Last, First') or 'author_first_name' and 'author_last_name', the
+    genres are a list or a '|' / ';' separated string.
+    """
+    if text(row.get('author_last_name')).strip():
+        author = (text(row.get('author_first_name')).strip(), text(row['author_last_name']).strip())
+    else:
+        author = split_author(text(row.get('author')))
+    return {
+        'isbn': text(row.get('isbn')),
+        'title': text(row.get('title')),
+        'summary': text(row.get('summary')),
+        'author': author,
+        'genres': split_genres(row.get('genres') or row.get('genre')),
+        'language': text(row.get('language')).strip() or None,
+    }
+
+
+def csv_records(lines):
+    for row in csv.DictReader(lines):
+        yield book_record(row)
+
+
+def jsonl_records(lines):
+    """a line which is no JSON object gives None, it is counted as invalid"""
+    for line in lines:
+        if line.strip():
+            try:
+                yield book_record(json.loads(line))
+            except (ValueError, TypeError, AttributeError):
+                yield None
+
+
+def _marc_record(fields):
+    def subfield(tag, code):
+        return [value for field in fields.get(tag, ()) for key, value in field if key == code]
+
+    def first(tag, code):
+        values = subfield(tag, code)
+        return values[0].strip() if values else ''
+
+    title = ' '.join(part for part in (first('245', 'a'), first('245', 'b')) if part)
+    isbn = first('020', 'a').split(' ')[0]
+    return {
+        'isbn': isbn,
+        'title': title.rstrip(' /:;,.'),
+        'summary': first('520', 'a'),
+        'author': split_author(first('100', 'a')),
+        'genres': [name.rstrip(' .') for name in subfield('650', 'a') + subfield('655', 'a')],
+        'language': first('546', 'a').rstrip(' .') or None,
+    }
+
+
+def marc_records(lines):
+    """
+    MARC in the mnemonic text form, one '=TAG  II$aValue$bValue' line per
+    field and a blank line or '=LDR' between the records. Reads 020 $a (ISBN),
+    100 $a (author), 245 $a $b (title), 520 $a (summary), 546 $a (language)
+    and 650 / 655 $a (genres).
+    """
+    fields = {}
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if not line.strip() or line.startswith('=LDR'):
+            if fields:
+                yield _marc_record(fields)
+            fields = {}
+            continue
+        match = re.match(r'=(\d{3})  (.*)', line)
+        if not match or match.group(1) < '010':
+            continue
+        tag, data = match.groups()
+        subfields = [(part[:1], part[1:]) for part in data[2:].split('$') if part]
+        fields.setdefault(tag, []).append(subfields)
+    if fields:
+        yield _marc_record(fields)
+
+
+READERS = {
+    'csv': csv_records,
+    'jsonl': jsonl_records,
+    'marc': marc_records,
+}
+
+
+def detect_format(path):
+    name = path[:-3] if path.endswith('.gz') else path
+    extension = os.path.splitext(name)[1].lstrip('.').lower()
+    if extension in ('mrk', 'marc'):
+        return 'marc'
+    if extension in ('json', 'jsonl', 'ndjson'):
+        return 'jsonl'
+    return 'csv'
+
+
+class Command(BaseCommand):
+    help = "import books in bulk from CSV, JSONL or MARC text dumps, resumable from a checkpoint."
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', type=str, help="The input file, may be gzipped (.gz)")
+        parser.add_argument('--format', choices=FORMATS, default=None, help="Input format (default: by extension)")
+        parser.add_argument('--chunk-size', type=int, default=1000, help="Records per transaction")
+        parser.add_argument('--update', action='store_true', help="Overwrite the books whose ISBN exists")
+        parser.add_argument('--checkpoint', type=str, default=None, help="Checkpoint file (default: <path>.checkpoint)")
+        parser.add_argument('--restart', action='store_true', help="Ignore the checkpoint, start from the beginning")
+
+    def handle(self, *args, **options):
+        path = options['path']
+        if not os.path.exists(path):
+            raise CommandError(f'{path} does not exist')
+        if options['chunk_size'] <= 0:
+            raise CommandError('--chunk-size has to be a positive number')
+
+        self.update = options['update']
+        self.checkpoint = options['checkpoint'] or f'{path}.checkpoint'
+        reader = READERS[options['format'] or detect_format(path)]
+
+        position, self.totals = 0, Counter()
+        if not options['restart'] and os.path.exists(self.checkpoint):
+            with open(self.checkpoint) as checkpoint:
+                state = json.load(checkpoint)
+            position, self.totals = state['position'], Counter(state['totals'])
+            self.stdout.write(f'resuming after record {position}')
+
+        # the lookup maps: name -> pk, the authors are loaded chunk by chunk
+        self.genres = self.name_map(Genre)
+        self.languages = self.name_map(Language)
+        self.authors = {}
+
+        opener = gzip.open if path.endswith('.gz') else open
+        started = time.perf_counter()
+        with opener(path, 'rt', encoding='utf-8', newline='') as lines:
+            records = islice(reader(lines), position, None)
+            while True:
+                chunk = list(islice(records, options['chunk_size']))
+                if not chunk:
+                    break
+                with transaction.atomic():
+                    self.import_chunk(chunk)
+                position += len(chunk)
+                self.save_checkpoint(position)
+                self.report(position, time.perf_counter() - started)
+
+        if os.path.exists(self.checkpoint):
+            os.remove(self.checkpoint)
+
+        # bulk writes bypass the signals, bring the derived data up to date
+        call_command('reconcile_catalog_stats', stdout=self.stdout)
+        catalog_autocomplete.invalidate()
+        invalidate_all_fragments()
+        self.stdout.write(self.style.SUCCESS(
+            'imported {} records in {:.1f}s: {}'.format(
+                position, time.perf_counter() - started,
+                ', '.join(f'{name} {count}' for name, count in sorted(self.totals.items())),
+            )
+        ))
+
+    @staticmethod
+    def name_map(model):
+        """name -> pk of a small lookup table, the oldest row wins"""
+        names = {}
+        for pk, name in model.objects.order_by('pk').values_list('pk', 'name').iterator():
+            names.setdefault(name.casefold(), pk)
+        return names
+
+    def save_checkpoint(self, position):
+        # write and rename, a crash never leaves a half-written checkpoint
+        with open(f'{self.checkpoint}.tmp', 'w') as checkpoint:
+            json.dump({'position': position, 'totals': self.totals}, checkpoint)
+        os.replace(f'{self.checkpoint}.tmp', self.checkpoint)
+
+    def report(self, position, elapsed):
+        self.stdout.write('{} records: {} created, {} updated, {} skipped, {} invalid ({:.0f} records/s)'.format(
+            position, self.totals['created'], self.totals['updated'], self.totals['skipped'],
+            self.totals['invalid'], position / elapsed if elapsed else 0,
+        ))
+
+    def resolve_names(self, model, names, label):
+        """Adds the missing genres or languages in one bulk_create."""
+        lookup = self.genres if model is Genre else self.languages
+        missing = {}
+        for name in names:
+            missing.setdefault(name.casefold(), name)
+        for key in lookup:
+            missing.pop(key, None)
+        if not missing:
+            return
+        created = model.objects.bulk_create([model(name=name[:model._meta.get_field('name').max_length])
+                                             for name in missing.values()])
+        for key, obj in zip(missing, created):
+            lookup[key] = obj.pk
+        self.totals[label] += len(created)
+
+    def resolve_authors(self, names):
+        """Finds the authors of the chunk in one query and creates the missing ones in bulk."""
+        missing = {name for name in names if name not in self.authors}
+        if missing:
+            for pk, first_name, last_name in (
+                Author.objects.filter(last_name__in={last_name for _, last_name in missing})
+                .order_by('pk').values_list('pk', 'first_name', 'last_name')
+            ):
+                self.authors.setdefault((first_name, last_name), pk)
+            missing = [name for name in missing if name not in self.authors]
+        if missing:
+            created = Author.objects.bulk_create(
+                [Author(first_name=first_name, last_name=last_name) for first_name, last_name in missing]
+            )
+            for name, author in zip(missing, created):
+                self.authors[name] = author.pk
+            self.totals['authors'] += len(created)
+
+    def clean(self, record):
+        if record is None:
+            return None
+        isbn = normalize_isbn(record['isbn'])
+        title = (record['title'] or '').strip()
+        if not isbn or not title:
+            return None
+        author = record['author']
+        if author:
+            author = (author[0][:100], author[1][:100])
+        return dict(
+            record,
+            isbn=isbn,
+            title=title[:TITLE_LENGTH],
+            summary=(record['summary'] or '').strip()[:SUMMARY_LENGTH],
+            author=author if author and author[1] else None,
+        )
+
+    def import_chunk(self, chunk):
+        records = {}
+        for record in chunk:
+            record = self.clean(record)
+            if record is None:
+                self.totals['invalid'] += 1
+                continue
+            if record['isbn'] in records:
+                self.totals['duplicates'] += 1
+            # the last record of an ISBN wins
+            records[record['isbn']] = record
+        if not records:
+            return
+
+        # one existence query for the whole chunk
+        existing = dict(Book.objects.filter(isbn__in=records).values_list('isbn', 'pk'))
+        if not self.update:
+            self.totals['skipped'] += len(existing)
+            records = {isbn: record for isbn, record in records.items() if isbn not in existing}
+            existing = {}
+        if not records:
+            return
+
+        self.resolve_authors({record['author'] for record in records.values() if record['author']})
+        self.resolve_names(Genre, [name for record in records.values() for name in record['genres']], 'genres')
+        self.resolve_names(Language, [record['language'] for record in records.values() if record['language']],
+                           'languages')
+
+        books = {
+            isbn: Book(
+                pk=existing.get(isbn),
+                isbn=isbn,
+                title=record['title'],
+                summary=record['summary'],
+                author_id=self.authors[record['author']] if record['author'] else None,
+                language_id=self.languages[record['language'].casefold()] if record['language'] else None,
+            )
+            for isbn, record in records.items()
+        }
+        new = [book for isbn, book in books.items() if isbn not in existing]
+        old = [book for isbn, book in books.items() if isbn in existing]
+
+        Book.objects.bulk_create(new)
+        if any(book.pk is None for book in new):
+            # the backend gives no ids back, find them by the unique ISBN
+            ids = dict(Book.objects.filter(isbn__in=[book.isbn for book in new]).values_list('isbn', 'pk'))
+            for book in new:
+                book.pk = ids[book.isbn]
+        if old:
+            Book.objects.bulk_update(old, UPDATE_FIELDS)
+            # the genres of the updated books are replaced
+            Book.genre.through.objects.filter(book_id__in=[book.pk for book in old]).delete()
+
+        Book.genre.through.objects.bulk_create(
+            [
+                Book.genre.through(book_id=books[isbn].pk, genre_id=genre_id)
+                for isbn, record in records.items()
+                for genre_id in {self.genres[name.casefold()] for name in record['genres']}
+            ],
+            ignore_conflicts=True,
+        )
+        index_books([book.pk for book in books.values()])
+
+        self.totals['created'] += len(new)
+        self.totals['updated'] += len(old)
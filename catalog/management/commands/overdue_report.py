@@ -0,0 +1,36 @@
+import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...reports import overdue_report
+
+# python manage.py overdue_report --limit=50 --today=2024-01-31
+
+
+class Command(BaseCommand):
+    help = "report the overdue loans by their age and by the borrower."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=20, help="Number of borrowers to list")
+        parser.add_argument('--today', type=str, default=None, help="Report as of this date (YYYY-MM-DD)")
+
+    def handle(self, *args, **options):
+        today = None
+        if options['today']:
+            try:
+                today = datetime.date.fromisoformat(options['today'])
+            except ValueError:
+                raise CommandError('--today has to be a YYYY-MM-DD date')
+
+        report = overdue_report(today, options['limit'])
+        self.stdout.write(f"{report['total']} overdue loan(s) on {report['today']}")
+
+        self.stdout.write('\n{:<14} {:>8} {:>10} {:>8}'.format('age', 'loans', 'borrowers', 'oldest'))
+        for label, loans, borrowers, oldest in report['by_age']:
+            self.stdout.write('{:<14} {:>8} {:>10} {:>8}'.format(label, loans, borrowers, oldest or '-'))
+
+        self.stdout.write('\n{:<24} {:>8} {:>8} {:>10}'.format('borrower', 'loans', 'oldest', 'total days'))
+        for row in report['by_borrower']:
+            self.stdout.write('{:<24} {:>8} {:>8} {:>10}'.format(
+                row['borrower__username'] or '(undefined)', row['loans'], row['oldest'], row['total_days'],
+            ))
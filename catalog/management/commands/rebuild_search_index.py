@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from ...models import Book
+from ...search import INDEX_CHUNK_SIZE, has_search_index, index_books, prune_search_index
+
+# python manage.py rebuild_search_index
+
+
+class Command(BaseCommand):
+    help = "rebuild the full-text search documents of all the books."
+
+    def handle(self, *args, **options):
+        if not has_search_index():
+            self.stdout.write(self.style.WARNING('this database has no full-text index.'))
+            return
+
+        prune_search_index()
+        indexed = 0
+        book_ids = Book.objects.order_by('pk').values_list('pk', flat=True)
+        chunk = []
+        for book_id in book_ids.iterator(chunk_size=INDEX_CHUNK_SIZE):
+            chunk.append(book_id)
+            if len(chunk) == INDEX_CHUNK_SIZE:
+                with transaction.atomic():
+                    index_books(chunk)
+                indexed += len(chunk)
+                chunk = []
+        with transaction.atomic():
+            index_books(chunk)
+        indexed += len(chunk)
+        self.stdout.write(self.style.SUCCESS(f'{indexed} book(s) indexed.'))
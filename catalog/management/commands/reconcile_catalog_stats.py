@@ -0,0 +1,110 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from ...copies import REPAIR_CHUNK_SIZE, drifted_books, repair_book_copies
+from ...facets import count_facets, invalidate_facets, stored_facets
+from ...fragments import invalidate_all_fragments
+from ...models import Book, CatalogStats, FacetCount
+from ...stats import STATS_PK, count_catalog_stats, invalidate_catalog_stats
+
+# python manage.py reconcile_catalog_stats --dry-run
+
+# the drifted books listed one by one, the rest is only counted
+MAX_REPORTED_BOOKS = 20
+
+
+class Command(BaseCommand):
+    help = "recount the catalog counters, facets and book copies in bulk and report the drift of the incremental ones."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help="Only report the drift, do not fix the counters",
+        )
+
+    def handle(self, *args, **options):
+        drifted = (
+            self.reconcile_counters(options['dry_run'])
+            + self.reconcile_facets(options['dry_run'])
+            + self.reconcile_copies(options['dry_run'])
+        )
+
+        if not drifted:
+            self.stdout.write(self.style.SUCCESS('no drift, the counters are correct.'))
+        elif options['dry_run']:
+            self.stdout.write(self.style.WARNING(f'{drifted} counter(s) drifted, nothing changed.'))
+        else:
+            # the copy counters are shown in the cached book pages
+            invalidate_all_fragments()
+            self.stdout.write(self.style.SUCCESS(f'{drifted} counter(s) fixed.'))
+
+    def reconcile_counters(self, dry_run):
+        with transaction.atomic():
+            # the row lock holds the concurrent F() increments back until
+            # the recount is stored, otherwise they would be overwritten
+            stats, _ = CatalogStats.objects.select_for_update().get_or_create(pk=STATS_PK)
+            actual = count_catalog_stats()
+
+            drift = {
+                name: (getattr(stats, name), value)
+                for name, value in actual.items()
+                if getattr(stats, name) != value
+            }
+            for name, (stored, value) in drift.items():
+                self.stdout.write(f'{name}: stored {stored}, counted {value} ({value - stored:+d})')
+
+            if drift and not dry_run:
+                CatalogStats.objects.filter(pk=STATS_PK).update(**actual)
+                transaction.on_commit(invalidate_catalog_stats)
+        return len(drift)
+
+    def reconcile_facets(self, dry_run):
+        with transaction.atomic():
+            # lock the facet rows just like the counters row above
+            list(FacetCount.objects.select_for_update().values_list('pk'))
+            stored = stored_facets()
+            actual = count_facets()
+
+            drift = {
+                key: (stored.get(key, 0), actual.get(key, 0))
+                for key in set(stored) | set(actual)
+                if stored.get(key, 0) != actual.get(key, 0)
+            }
+            for (facet, value), (was, count) in sorted(drift.items()):
+                self.stdout.write(f'facet {facet}={value}: stored {was}, counted {count} ({count - was:+d})')
+
+            if drift and not dry_run:
+                FacetCount.objects.all().delete()
+                FacetCount.objects.bulk_create(
+                    [
+                        FacetCount(facet=facet, value=value, count=count)
+                        for (facet, value), count in actual.items()
+                    ],
+                    batch_size=1000,
+                )
+                transaction.on_commit(invalidate_facets)
+        return len(drift)
+
+    def reconcile_copies(self, dry_run):
+        names = Book.COPIES
+        with transaction.atomic():
+            drifted = []
+            for pk, *values in drifted_books().iterator(chunk_size=REPAIR_CHUNK_SIZE):
+                drifted.append(pk)
+                if len(drifted) > MAX_REPORTED_BOOKS:
+                    continue
+                stored, counted = values[:len(names)], values[len(names):]
+                changes = ', '.join(
+                    f'{name}: stored {was}, counted {count}'
+                    for name, was, count in zip(names, stored, counted) if was != count
+                )
+                self.stdout.write(f'book {pk}: {changes}')
+            if len(drifted) > MAX_REPORTED_BOOKS:
+                self.stdout.write(f'... and {len(drifted) - MAX_REPORTED_BOOKS} more books')
+
+            if drifted and not dry_run:
+                # the recount is a part of the UPDATE, the row locks it takes
+                # keep the concurrent increments out until it is stored
+                repair_book_copies(drifted)
+        return len(drifted)
@@ -0,0 +1,32 @@
+import datetime
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from ...history import MonthArchived, month_start, rollup_month
+
+# python manage.py rollup_circulation --months=2  (from cron, e.g. nightly)
+
+
+class Command(BaseCommand):
+    help = "recount the monthly circulation rollups of the last months from the loan history."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--months', type=int, default=2, help="Months to recount, the current one included")
+
+    def handle(self, *args, **options):
+        if options['months'] <= 0:
+            raise CommandError('--months has to be a positive number')
+        month = month_start(timezone.localdate())
+        for _ in range(options['months']):
+            started = time.perf_counter()
+            try:
+                events = rollup_month(month)
+            except MonthArchived:
+                self.stdout.write(f'{month:%Y-%m}: archived, its rollups are kept')
+            else:
+                self.stdout.write('{:%Y-%m}: {} event(s) rolled up in {:.2f}s'.format(
+                    month, events, time.perf_counter() - started,
+                ))
+            month = month_start(month - datetime.timedelta(days=1))
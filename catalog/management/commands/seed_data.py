@@ -1,17 +1,25 @@
-from typing import NoReturn
-
-from django.core.management.base import BaseCommand
-from faker import Faker  # fake the db
-from factory.django import DjangoModelFactory  # extends faker capabilities
-from factory import Sequence  # needed for establishing filling out manner. Acc func
-import random
-from ...models import Author, Book, BookInstance, Language, Genre, User
 import datetime
+import random
+import time
 import uuid
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from types import SimpleNamespace
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections, transaction
+from faker import Faker  # fake the db
+
+from ...autocomplete import catalog_autocomplete
+from ...models import (
+    ArchivedLoanMonth, Author, Book, BookCirculation, BookInstance, BookLoanDay, BookPopularity, BorrowerCirculation,
+    Genre, Language, LoanEvent, Reservation, SimilarBook, User,
+)
+from ...popularity import invalidate_popular_books
 
-# python manage.py seed --mode=refresh
-"""create a faker instance"""
-fake = Faker()
+# python manage.py seed_data --mode=refresh -na 10000 -ng 50 -nl 20 -nb 1000000 -nbi 1000000 --seed 42
 
 """ Clear all data and creates addresses """
 MODE_REFRESH = 'refresh'
@@ -19,205 +27,292 @@ MODE_REFRESH = 'refresh'
 """ Clear all data and do not create any object """
 MODE_CLEAR = 'clear'
 
+LOAN_STATUSES = ('m', 'o', 'a', 'r')
+
+# one Faker per worker process, reseeded for every batch
+_fake = None
+
+
+def _batch_random(seed, batch):
+    """
+    Faker and random seeded by the (seed, batch) pair, so the output doesn't
+    depend on which worker process has got the batch
+    """
+    global _fake
+    if _fake is None:
+        _fake = Faker()
+    batch_seed = None if seed is None else seed * 1000003 + batch
+    _fake.seed_instance(batch_seed)
+    return _fake, random.Random(batch_seed)
+
+
+def _fake_name(fake, rng):
+    return ''.join(fake.random_letters(length=rng.randint(4, 10))).title()
+
+
+def generate_languages(task):
+    seed, batch, start, size, _ = task
+    fake, rng = _batch_random(seed, batch)
+    return [(fake.language_name(),) for _ in range(size)]
+
+
+def generate_genres(task):
+    seed, batch, start, size, _ = task
+    fake, rng = _batch_random(seed, batch)
+    return [(_fake_name(fake, rng),) for _ in range(size)]
+
+
+def generate_authors(task):
+    seed, batch, start, size, _ = task
+    fake, rng = _batch_random(seed, batch)
+    rows = []
+    for _ in range(size):
+        # faking birthdate and furthermore death date based on the date of birth
+        birth = fake.date_object()
+        death = birth + datetime.timedelta(weeks=52 * rng.randint(20, 80))
+        rows.append((
+            fake.first_name(),
+            fake.last_name(),
+            birth,
+            death if rng.random() < 0.5 else None,
+            fake.text(),
+        ))
+    return rows
+
+
+def isbn13(number):
+    """a valid ISBN-13 from the 979 prefix and the sequence number"""
+    digits = f'979{number % 10 ** 9:09d}'
+    check = (10 - sum(int(digit) * (3 if index % 2 else 1) for index, digit in enumerate(digits)) % 10) % 10
+    return f'{digits}{check}'
+
+
+def next_isbn_number():
+    """the sequence goes on after the largest 979 ISBN, the rows deleted or imported in between included"""
+    last = (
+        Book.objects.filter(isbn__regex=r'^979[0-9]{10}$')
+        .order_by('-isbn').values_list('isbn', flat=True).first()
+    )
+    return 0 if last is None else int(last[3:12]) + 1
+
+
+def generate_books(task):
+    seed, batch, start, size, (first_number, authors, genres, languages) = task
+    fake, rng = _batch_random(seed, batch)
+    # the foreign keys are indices into the id arrays of the main process
+    return [
+        (
+            _fake_name(fake, rng),
+            fake.text(),
+            isbn13(first_number + start + offset),
+            rng.randrange(authors) if authors else None,
+            rng.randrange(languages) if languages else None,
+            rng.randrange(genres) if genres else None,
+        )
+        for offset in range(size)
+    ]
+
+
+def generate_book_instances(task):
+    seed, batch, start, size, (books, borrowers) = task
+    fake, rng = _batch_random(seed, batch)
+    today = datetime.date.today()
+    rows = []
+    for _ in range(size):
+        status = rng.choice(LOAN_STATUSES)
+        on_loan = status == 'o'
+        rows.append((
+            uuid.UUID(int=rng.getrandbits(128), version=4),
+            rng.randrange(books),
+            fake.text(),
+            status,
+            # borrower and due back depends on whether the book is on loan or not
+            today + datetime.timedelta(days=rng.randint(7, 31)) if on_loan else None,
+            rng.randrange(borrowers) if on_loan and borrowers else None,
+        ))
+    return rows
+
 
 class Command(BaseCommand):
     help = "seed database for testing and development."
 
     def add_arguments(self, parser):
-        parser.add_argument('--mode', type=str, help="Mode")
-        parser.add_argument('-na', type=str, help="Number of seed authors")
-        parser.add_argument('-ng', type=str, help="Number of seed genres")
-        parser.add_argument('-nl', type=str, help="Number of seed languages")
-        parser.add_argument('-nb', type=str, help="Number of seed books")
-        parser.add_argument('-nbi', type=str, help="Number of seed book instances")
+        parser.add_argument('--mode', type=str, help="Mode: refresh (clear, then seed) or clear")
+        parser.add_argument('-na', type=int, default=0, help="Number of seed authors")
+        parser.add_argument('-ng', type=int, default=0, help="Number of seed genres")
+        parser.add_argument('-nl', type=int, default=0, help="Number of seed languages")
+        parser.add_argument('-nb', type=int, default=0, help="Number of seed books")
+        parser.add_argument('-nbi', type=int, default=0, help="Number of seed book instances")
+        parser.add_argument('--batch-size', type=int, default=5000, help="Rows per bulk_create")
+        parser.add_argument('--workers', type=int, default=None, help="Faker processes (default: CPU count)")
+        parser.add_argument('--seed', type=int, default=None, help="Random seed for a reproducible output")
 
     def handle(self, *args, **options):
-        numbers = [
-            options['na'],
-            options['ng'],
-            options['nl'],
-            options['nb'],
-            options['nbi']
-        ]
+        for name in ('na', 'ng', 'nl', 'nb', 'nbi', 'batch_size'):
+            if options[name] < 0 or (name == 'batch_size' and options[name] == 0):
+                raise CommandError(f'-{name} has to be a positive number')
 
-        # validate the numbers as valid integers
-        for index, input_item in enumerate(numbers):
-            num = self.to_int(input_item)
-            if num == -1:
-                print(
-                    'You inserted an invalid number so the default is set as 0 (nothing will be seeded)'
-                )
-                break
-            numbers[index] = num
+        self.seed = options['seed']
+        self.batch_size = options['batch_size']
+        self.workers = options['workers']
 
-        else:
+        if options['mode'] in (MODE_CLEAR, MODE_REFRESH):
+            self.clear_data()
+        if options['mode'] != MODE_CLEAR:
             self.stdout.write('seeding data...')
-            authors_num, genres_num, languages_num, books_num, book_inst_num = tuple(numbers)
             self.run_seed(
-                options['mode'],
-                authors_serve=(self.create_author, authors_num),
-                genres_serve=(self.create_genre, genres_num),
-                languages_serve=(self.create_language, languages_num),
-                books_serve=(self.create_book, books_num),
-                book_inst_serve=(self.create_book_instance, book_inst_num)
-                )
-            self.stdout.write('done.')
+                authors=options['na'],
+                genres=options['ng'],
+                languages=options['nl'],
+                books=options['nb'],
+                book_instances=options['nbi'],
+            )
 
-    @staticmethod
-    def clear_data():
-        """Deletes all the table data"""
-        print("Delete All DB")
-        Author.objects.all().delete()
-        Genre.objects.all().delete()
-        Language.objects.all().delete()
-        BookInstance.objects.all().delete()
-        Book.objects.all().delete()
+        # bulk writes bypass the signals, bring the derived data up to date
+        call_command('reconcile_catalog_stats', stdout=self.stdout)
+        call_command('rebuild_search_index', stdout=self.stdout)
+        catalog_autocomplete.invalidate()
+        self.stdout.write('done.')
 
-    @staticmethod
-    def create_language():
-        """Creates genre object using Faker instance and langcodes to look real in the stdout"""
-        print("Creating a fake language")
-        language = Language(
-            name=fake.language_name()
-        )
-        language.save()
-        print("The {} language created.".format(language.name))
-        return language
+    def clear_data(self):
+        """
+        Deletes all the table data, in bulk and without the per-row signals.
+        The tables referring to the books, copies and authors go first. The
+        loan history and its rollups go too, they count the deleted books.
+        """
+        self.stdout.write('Delete All DB')
+        tables = [
+            Reservation._meta.db_table,
+            SimilarBook._meta.db_table,
+            BookPopularity._meta.db_table,
+            BookLoanDay._meta.db_table,
+            LoanEvent._meta.db_table,
+            BookCirculation._meta.db_table,
+            BorrowerCirculation._meta.db_table,
+            ArchivedLoanMonth._meta.db_table,
+            BookInstance._meta.db_table,
+            Book.genre.through._meta.db_table,
+            Book._meta.db_table,
+            Author._meta.db_table,
+            Genre._meta.db_table,
+            Language._meta.db_table,
+        ]
+        with transaction.atomic(), connection.cursor() as cursor:
+            for table in tables:
+                cursor.execute(f'DELETE FROM {connection.ops.quote_name(table)}')
+        invalidate_popular_books()
 
-    @staticmethod
-    def create_genre():
-        """Creates genre object using Faker instance"""
-        print("Creating a fake genre of who knows what letters")
-        genre = Genre(
-            name=''.join(
-                fake.random_letters(
-                    length=random.randint(4, 10)
-                )
-            )
-            .title()
-        )
-        genre.save()
-        print("The {} genre created.".format(genre.name))
-        return genre
+    def tasks(self, total, payload):
+        """splits the total into batches for the generator processes"""
+        for batch, start in enumerate(range(0, total, self.batch_size)):
+            yield self.seed, batch, start, min(self.batch_size, total - start), payload
+
+    def insert(self, label, total, generator, payload, save_batch):
+        """
+        Generates the rows in the process pool and saves them batch by batch,
+        save_batch returns the rows it inserted.
+        """
+        if not total:
+            return
+        started = last_report = time.perf_counter()
+        done = inserted = 0
+        if self.workers == 1:
+            # no pool at all, handy for the debugging and the tests
+            pool = nullcontext(SimpleNamespace(map=map))
+        else:
+            # the connection must not be shared with the forked workers
+            connections.close_all()
+            pool = ProcessPoolExecutor(max_workers=self.workers)
+        with pool as executor:
+            for rows in executor.map(generator, self.tasks(total, payload)):
+                with transaction.atomic():
+                    inserted += len(save_batch(rows))
+                done += len(rows)
+                now = time.perf_counter()
+                if now - last_report >= 1 or done == total:
+                    last_report = now
+                    self.stdout.write('{}: {}/{} ({:.0f} rows/s){}'.format(
+                        label, inserted, total, inserted / (now - started),
+                        f', {done - inserted} skipped' if done > inserted else '',
+                    ))
 
     @staticmethod
-    def create_author():
-        """create a fake author"""
-        print("Creating a fake author")
-        # faking birthdate and furthermore death date based on the date of birth
-        fake_birth = datetime.datetime.strptime(fake.date(), '%Y-%m-%d')
-        fake_death = fake_birth + datetime.timedelta(
-            weeks=52 * random.randint(
-                20, 80
-            )
-        )
-        is_fake_death = random.choice([True, False])
-
-        author = Author(
-            first_name=fake.first_name(),
-            last_name=fake.last_name(),
-            date_of_birth=fake_birth.strftime('%Y-%m-%d'),
-            date_of_death=fake_death.strftime('%Y-%m-%d') if is_fake_death else None,
-            biography=fake.text()
-        )
+    def ids(model):
+        """the primary keys of the model as a compact array, for the sampling"""
+        return array('q', model.objects.order_by('pk').values_list('pk', flat=True).iterator(chunk_size=10000))
 
-        author.save()
-        print("The author {} {}, born {}, died {}, bio {} created.".format(
-            author.first_name,
-            author.last_name,
-            author.date_of_birth,
-            author.date_of_death,
-            author.biography
+    def run_seed(self, authors, genres, languages, books, book_instances):
+        """ Seed database in bulk, the foreign keys are sampled from the id arrays """
+        self.insert('languages', languages, generate_languages, None, lambda rows: Language.objects.bulk_create(
+            [Language(name=name) for name, in rows]
         ))
-        return author
-
-    @staticmethod
-    def create_book():
-        """create a book using all the models above"""
-        author = random.choice(Author.objects.all())
-        genre = random.choice(Genre.objects.all())
-        language = random.choice(Language.objects.all())
-        book = Book(
-            author=author,
-            title=''.join(
-                fake.random_letters(
-                    length=random.randint(4, 10)
+        self.insert('genres', genres, generate_genres, None, lambda rows: Genre.objects.bulk_create(
+            [Genre(name=name) for name, in rows]
+        ))
+        self.insert('authors', authors, generate_authors, None, lambda rows: Author.objects.bulk_create(
+            [
+                Author(
+                    first_name=first_name,
+                    last_name=last_name,
+                    date_of_birth=birth,
+                    date_of_death=death,
+                    biography=biography,
                 )
-            )
-            .title(),
-            summary=fake.text(),
-            isbn=fake.isbn13().replace('-', ''),
-            language=language
-
-        )
-        book.save()
-        book.genre.add(genre)
-        book.save()
-        print("The book {} written by {} created.".format(
-            book.title,
-            f'{book.author.first_name} {book.author.last_name}'
+                for first_name, last_name, birth, death, biography in rows
+            ]
         ))
 
-        return book
-        # TODO can be int
+        author_ids, genre_ids, language_ids = self.ids(Author), self.ids(Genre), self.ids(Language)
+        first_number = next_isbn_number()
 
-    @staticmethod
-    def create_book_instance():
-        """create a book using all the models above"""
-        book_inst = BookInstance(
-            id=uuid.uuid4(),
-            book=random.choice(Book.objects.all()),
-            imprint=fake.text(),
-            status=random.choice(
-                (
-                    'm',
-                    'o',
-                    'a',
-                    'r',
-                )
+        def save_books(rows):
+            isbns = [row[2] for row in rows]
+            existing = set(Book.objects.filter(isbn__in=isbns).values_list('isbn', flat=True))
+            Book.objects.bulk_create(
+                [
+                    Book(
+                        title=title,
+                        summary=summary,
+                        isbn=isbn,
+                        author_id=None if author is None else author_ids[author],
+                        language_id=None if language is None else language_ids[language],
+                    )
+                    for title, summary, isbn, author, language, _ in rows
+                ],
+                ignore_conflicts=True,
             )
-        )
-        book_inst.save()
-        # borrower and due back depends on whether the book is on loan or not
-        if book_inst.status == 'o':
-            book_inst.due_back = (datetime.datetime.now() + datetime.timedelta(
-                days=random.randint(7, 31)
-            )).strftime("%Y-%m-%d")
-            book_inst.borrower = random.choice(User.objects.all())
-            book_inst.save()
-
-        print("The book instance {} written by {} created.".format(
-            book_inst.book.title,
-            f'{book_inst.book.author.first_name} {book_inst.book.author.last_name}'
-        ))
+            # ignore_conflicts gives no ids back, find the new ones by the unique ISBN
+            book_ids = dict(
+                Book.objects.filter(isbn__in=isbns).exclude(isbn__in=existing).values_list('isbn', 'pk')
+            )
+            Book.genre.through.objects.bulk_create(
+                [
+                    Book.genre.through(book_id=book_ids[isbn], genre_id=genre_ids[genre])
+                    for _, _, isbn, _, _, genre in rows
+                    if genre is not None and isbn in book_ids
+                ],
+                ignore_conflicts=True,
+            )
+            return book_ids
 
-    def run_seed(self, mode: str, **kwargs):
-        """ Seed database based on mode
-        :self: the class inst
-        :param mode: refresh / clear
-        :return:
-        """
-        # Clear data from tables
-        if mode == MODE_CLEAR:
-            self.clear_data()
+        self.insert('books', books, generate_books,
+                    (first_number, len(author_ids), len(genre_ids), len(language_ids)), save_books)
 
-        # Creating the set number of objects to create
-        for i_struct in kwargs.values():
-            func, value = i_struct
-            for _ in range(value):
-                func()
+        if not book_instances:
+            return
+        book_ids, user_ids = self.ids(Book), self.ids(User)
+        if not book_ids:
+            raise CommandError('There are no books to seed the book instances for')
 
-    @staticmethod
-    def to_int(item: str) -> int or NoReturn:
-        """
-        method takes the item and checks if it is a valid integer.
-        Limited to 1000 seeds
-        """
-        try:
-            item = int(item)
-        except ValueError:
-            raise NotImplementedError('The {item} is not an int! Cannot prepare for seed!'.format(
-                item=item
-            ))
-        else:
-            return item if 0 < item <= 1000 else -1
+        self.insert('book instances', book_instances, generate_book_instances, (len(book_ids), len(user_ids)),
+                    lambda rows: BookInstance.objects.bulk_create([
+                        BookInstance(
+                            id=pk,
+                            book_id=book_ids[book],
+                            imprint=imprint,
+                            status=status,
+                            due_back=due_back,
+                            borrower_id=None if borrower is None else user_ids[borrower],
+                        )
+                        for pk, book, imprint, status, due_back, borrower in rows
+                    ]))
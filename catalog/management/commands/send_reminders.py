@@ -0,0 +1,105 @@
+import datetime
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby, islice
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Exists, OuterRef
+from django.template.loader import render_to_string
+from django.utils import timezone
+
+from ...models import BookInstance, ReminderLog
+
+# python manage.py send_reminders --batch-size=500 --workers=4  (daily, from cron)
+
+SUBJECTS = {
+    ReminderLog.DUE: 'Your library books are due tomorrow',
+    ReminderLog.OVERDUE: 'Your library books are overdue',
+}
+
+TEMPLATES = {
+    ReminderLog.DUE: 'catalog/email/reminder_due.txt',
+    ReminderLog.OVERDUE: 'catalog/email/reminder_overdue.txt',
+}
+
+
+def reminder_loans(kind, today):
+    """the loans to remind of, of the readers not reminded today yet, ordered by the reader"""
+    loans = BookInstance.objects.on_loan().filter(borrower__isnull=False).exclude(borrower__email='')
+    if kind == ReminderLog.DUE:
+        loans = loans.filter(due_back=today + datetime.timedelta(days=1))
+    else:
+        loans = loans.overdue(today)
+    return (
+        loans.filter(~Exists(ReminderLog.objects.filter(user=OuterRef('borrower'), kind=kind, sent_on=today)))
+        .order_by('borrower_id', 'due_back', 'pk')
+        .values_list('borrower_id', 'borrower__email', 'borrower__first_name', 'borrower__username',
+                     'book__title', 'due_back')
+    )
+
+
+def group_by_reader(rows):
+    """(user id, e-mail, name, [(title, due back)]) per reader, the rows come ordered by the reader"""
+    for user_id, loans in groupby(rows, key=lambda row: row[0]):
+        loans = list(loans)
+        _, email, first_name, username, _, _ = loans[0]
+        yield user_id, email, first_name or username, [(title, due_back) for *_, title, due_back in loans]
+
+
+class Command(BaseCommand):
+    help = "e-mail the readers about their loans due tomorrow and overdue, once a day."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help="Messages per send_messages() call")
+        parser.add_argument('--chunk-size', type=int, default=2000, help="Loans per database fetch")
+        parser.add_argument('--workers', type=int, default=4, help="Threads rendering the messages")
+        parser.add_argument('--today', type=str, default=None, help="Send as of this date (YYYY-MM-DD)")
+
+    def handle(self, *args, **options):
+        if min(options['batch_size'], options['chunk_size'], options['workers']) <= 0:
+            raise CommandError('--batch-size, --chunk-size and --workers have to be positive numbers')
+        today = timezone.localdate()
+        if options['today']:
+            try:
+                today = datetime.date.fromisoformat(options['today'])
+            except ValueError:
+                raise CommandError('--today has to be a YYYY-MM-DD date')
+
+        started = time.perf_counter()
+        # one SMTP session for all the messages, one thread pool for all the rendering
+        with get_connection() as connection, ThreadPoolExecutor(options['workers']) as executor:
+            for kind, label in ReminderLog.KINDS:
+                sent = self.send(kind, today, connection, executor, options)
+                self.stdout.write(f'{label}: {sent} message(s) sent')
+        self.stdout.write('done in {:.1f}s'.format(time.perf_counter() - started))
+
+    def send(self, kind, today, connection, executor, options):
+        def render(reader):
+            user_id, email, name, loans = reader
+            body = render_to_string(TEMPLATES[kind], {
+                'name': name,
+                'loans': loans,
+                'due_back': today + datetime.timedelta(days=1),
+            })
+            return EmailMessage(SUBJECTS[kind], body, settings.DEFAULT_FROM_EMAIL, [email], connection=connection)
+
+        readers = group_by_reader(reminder_loans(kind, today).iterator(chunk_size=options['chunk_size']))
+        sent = 0
+        while True:
+            # at most a batch of readers in memory at a time
+            batch = list(islice(readers, options['batch_size']))
+            if not batch:
+                return sent
+            messages = list(executor.map(render, batch))
+            connection.send_messages(messages)
+            # logged right after the batch is out: a rerun sends the rest only
+            ReminderLog.objects.bulk_create(
+                [
+                    ReminderLog(user_id=user_id, kind=kind, sent_on=today, loans=len(loans))
+                    for user_id, _, _, loans in batch
+                ],
+                ignore_conflicts=True,
+            )
+            sent += len(messages)
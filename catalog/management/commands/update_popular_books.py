@@ -0,0 +1,22 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from ...popularity import rebuild_loan_days, update_popular_books
+
+# python manage.py update_popular_books  (from cron, once a day after midnight)
+
+
+class Command(BaseCommand):
+    help = "recount the popular books windows from the daily buckets, dropping the days which have fallen out."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from-history', action='store_true',
+                            help="Refill the daily buckets from the loan events first")
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        if options['from_history']:
+            rebuild_loan_days()
+        books = update_popular_books()
+        self.stdout.write(f'{books} popular book(s) recounted in {time.perf_counter() - started:.2f}s')
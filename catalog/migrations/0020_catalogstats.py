@@ -0,0 +1,47 @@
+# Generated by Django 4.2.4 on 2026-10-17 07:39
+
+from django.db import migrations, models
+
+
+def count_existing_rows(apps, schema_editor):
+    """fill the counters row once, later the signals keep it up to date"""
+    Book = apps.get_model('catalog', 'Book')
+    BookInstance = apps.get_model('catalog', 'BookInstance')
+    Author = apps.get_model('catalog', 'Author')
+    Genre = apps.get_model('catalog', 'Genre')
+    CatalogStats = apps.get_model('catalog', 'CatalogStats')
+    CatalogStats.objects.create(
+        pk=1,
+        num_books=Book.objects.count(),
+        num_instances=BookInstance.objects.count(),
+        num_instances_available=BookInstance.objects.filter(status__exact='a').count(),
+        num_authors=Author.objects.count(),
+        num_genres=Genre.objects.count(),
+        num_books_with_and=Book.objects.filter(title__contains='and').count(),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0019_alter_book_options'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CatalogStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('num_books', models.BigIntegerField(default=0)),
+                ('num_instances', models.BigIntegerField(default=0)),
+                ('num_instances_available', models.BigIntegerField(default=0)),
+                ('num_authors', models.BigIntegerField(default=0)),
+                ('num_genres', models.BigIntegerField(default=0)),
+                ('num_books_with_and', models.BigIntegerField(default=0)),
+            ],
+            options={
+                'verbose_name_plural': 'catalog stats',
+            },
+        ),
+        migrations.RunPython(count_existing_rows, migrations.RunPython.noop),
+    ]
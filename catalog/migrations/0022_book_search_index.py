@@ -0,0 +1,75 @@
+from django.db import migrations
+
+SQLITE_FORWARD = [
+    """
+    CREATE VIRTUAL TABLE catalog_book_search USING fts5(
+        title, summary, authors, genres,
+        tokenize = 'porter unicode61 remove_diacritics 2'
+    )
+    """,
+    """
+    INSERT INTO catalog_book_search (rowid, title, summary, authors, genres)
+    SELECT
+        b.id,
+        b.title,
+        b.summary,
+        COALESCE(TRIM(a.first_name || ' ' || a.last_name), ''),
+        COALESCE((
+            SELECT GROUP_CONCAT(g.name, ' ')
+            FROM catalog_book_genre bg JOIN catalog_genre g ON g.id = bg.genre_id
+            WHERE bg.book_id = b.id
+        ), '')
+    FROM catalog_book b LEFT JOIN catalog_author a ON a.id = b.author_id
+    """,
+]
+
+POSTGRES_FORWARD = [
+    """
+    CREATE TABLE catalog_book_search (
+        book_id bigint PRIMARY KEY REFERENCES catalog_book (id) ON DELETE CASCADE
+            DEFERRABLE INITIALLY DEFERRED,
+        document tsvector NOT NULL
+    )
+    """,
+    "CREATE INDEX catalog_book_search_document_idx ON catalog_book_search USING GIN (document)",
+    """
+    INSERT INTO catalog_book_search (book_id, document)
+    SELECT
+        b.id,
+        setweight(to_tsvector('english', b.title), 'A')
+        || setweight(to_tsvector('english', b.summary), 'D')
+        || setweight(to_tsvector('english', CONCAT_WS(' ', a.first_name, a.last_name)), 'B')
+        || setweight(to_tsvector('english', COALESCE((
+            SELECT STRING_AGG(g.name, ' ')
+            FROM catalog_book_genre bg JOIN catalog_genre g ON g.id = bg.genre_id
+            WHERE bg.book_id = b.id
+        ), '')), 'C')
+    FROM catalog_book b LEFT JOIN catalog_author a ON a.id = b.author_id
+    """,
+]
+
+
+def create_search_index(apps, schema_editor):
+    """FTS5 on SQLite, tsvector + GIN on PostgreSQL, nothing elsewhere"""
+    statements = {
+        'sqlite': SQLITE_FORWARD,
+        'postgresql': POSTGRES_FORWARD,
+    }.get(schema_editor.connection.vendor, [])
+    for statement in statements:
+        schema_editor.execute(statement)
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor in ('sqlite', 'postgresql'):
+        schema_editor.execute('DROP TABLE catalog_book_search')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0021_loan_and_catalog_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,59 @@
+# Generated by Django 4.2.4 on 2026-10-17 07:46
+
+from django.db import migrations, models
+from django.db.models import Count
+from django.db.models.functions import Substr, Upper
+
+
+def count_existing_books(apps, schema_editor):
+    """fill the facets once, later the signals keep them up to date"""
+    Book = apps.get_model('catalog', 'Book')
+    FacetCount = apps.get_model('catalog', 'FacetCount')
+    rows = []
+    for genre_id, count in (
+        Book.genre.through.objects.values_list('genre_id').annotate(count=Count('*')).order_by()
+    ):
+        rows.append(FacetCount(facet='g', value=str(genre_id), count=count))
+    for language_id, count in (
+        Book.objects.filter(language__isnull=False)
+        .values_list('language_id').annotate(count=Count('*')).order_by()
+    ):
+        rows.append(FacetCount(facet='l', value=str(language_id), count=count))
+    initials = {}
+    for initial, count in (
+        Book.objects.filter(author__isnull=False)
+        .annotate(initial=Upper(Substr('author__last_name', 1, 1)))
+        .values_list('initial').annotate(count=Count('*')).order_by()
+    ):
+        if initial:
+            initials[initial] = initials.get(initial, 0) + count
+    rows.extend(FacetCount(facet='i', value=initial, count=count) for initial, count in initials.items())
+    FacetCount.objects.bulk_create(rows, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0022_book_search_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FacetCount',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('facet', models.CharField(choices=[('g', 'Genre'), ('l', 'Language'), ('i', 'Author initial')], max_length=1)),
+                ('value', models.CharField(max_length=100)),
+                ('count', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='book',
+            index=models.Index(fields=['language', 'title', 'id'], name='book_language_title_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='facetcount',
+            constraint=models.UniqueConstraint(fields=('facet', 'value'), name='facet_value_unique'),
+        ),
+        migrations.RunPython(count_existing_books, migrations.RunPython.noop),
+    ]
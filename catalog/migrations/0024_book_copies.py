@@ -0,0 +1,54 @@
+# Generated by Django 4.2.4 on 2026-10-17 08:01
+
+from django.db import migrations, models
+from django.db.models import Count, IntegerField, OuterRef, Q, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def count_existing_copies(apps, schema_editor):
+    """fill the counters once, later the signals and the loan service keep them up to date"""
+    Book = apps.get_model('catalog', 'Book')
+    BookInstance = apps.get_model('catalog', 'BookInstance')
+
+    def count(condition=Q()):
+        copies = (
+            BookInstance.objects.filter(condition, book=OuterRef('pk'))
+            .order_by().values('book').annotate(count=Count('*')).values('count')
+        )
+        return Coalesce(Subquery(copies, output_field=IntegerField()), Value(0))
+
+    Book.objects.update(
+        copies_total=count(),
+        copies_available=count(Q(status='a')),
+        copies_on_loan=count(Q(status='o')),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0023_facetcount'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='copies_available',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='copies_on_loan',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='copies_total',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='book',
+            index=models.Index(fields=['-copies_available', 'title', 'id'], name='book_available_idx'),
+        ),
+        migrations.RunPython(count_existing_copies, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 4.2.4 on 2026-10-17 08:17
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0028_loan_history'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BookPopularity',
+            fields=[
+                ('book', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='popularity', serialize=False, to='catalog.book')),
+                ('loans_week', models.PositiveIntegerField(default=0)),
+                ('loans_month', models.PositiveIntegerField(default=0)),
+                ('loans_year', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'verbose_name_plural': 'book popularity',
+                'indexes': [models.Index(fields=['-loans_week', 'book'], name='popularity_week_idx'), models.Index(fields=['-loans_month', 'book'], name='popularity_month_idx'), models.Index(fields=['-loans_year', 'book'], name='popularity_year_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='BookLoanDay',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('loans', models.PositiveIntegerField(default=0)),
+                ('book', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='catalog.book')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='bookloanday',
+            constraint=models.UniqueConstraint(fields=('day', 'book'), name='bookloanday_unique'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.4 on 2026-10-17 08:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0030_similar_book'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='genre',
+            name='name',
+            field=models.CharField(db_index=True, help_text='Enter a book genre (e.g. Science Fiction)', max_length=200),
+        ),
+        migrations.AlterField(
+            model_name='language',
+            name='name',
+            field=models.CharField(db_index=True, help_text='Enter a book language (e.g. English)', max_length=100, verbose_name='Language'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.4 on 2026-10-17 08:51
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0032_book_author_updated_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedLoanMonth',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField(help_text='The first day of the month', unique=True)),
+                ('events', models.PositiveIntegerField(default=0)),
+                ('archived_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+    ]
@@ -4,6 +4,7 @@ import uuid  # Required for unique book instances
 from django.contrib.auth.models import User  # import a user instance to test
 # against book borrowing facilitation feature
 from datetime import date
+from django.utils import timezone
 
 
 # Create your models here.
@@ -11,7 +12,9 @@ class Genre(models.Model):
     """Model representing a book genre."""
     name = models.CharField(
         max_length=200,
-        help_text='Enter a book genre (e.g. Science Fiction)'
+        help_text='Enter a book genre (e.g. Science Fiction)',
+        # the lookup of the book form searches the names by prefix
+        db_index=True,
     )
 
     def __str__(self):
@@ -24,7 +27,8 @@ class Language(models.Model):
     name = models.CharField(
         verbose_name='Language',
         max_length=100,
-        help_text='Enter a book language (e.g. English)'
+        help_text='Enter a book language (e.g. English)',
+        db_index=True,
     )
 
     def __str__(self):
@@ -41,11 +45,18 @@ class Author(models.Model):
 
     biography = models.TextField(max_length=1000, null=True, blank=True)
 
+    # the Last-Modified of the author page
+    updated_at = models.DateTimeField(auto_now=True)
+
     class Meta:
         ordering = ['last_name', 'first_name']
         permissions = (
             ('can_affect_authors', 'Can affect authors'),
         )
+        indexes = [
+            # the author list pages by (last_name, first_name, id)
+            models.Index(fields=['last_name', 'first_name', 'id'], name='author_name_idx'),
+        ]
 
     def get_absolute_url(self):
         """Returns the URL to access a particular author instance."""
@@ -63,6 +74,13 @@ class Author(models.Model):
         """String for representing the Model object."""
         return f'{self.last_name}, {self.first_name}'
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # remember the stored last name, the initials facet needs the old one
+        instance._loaded_last_name = instance.__dict__.get('last_name')
+        return instance
+
 
 class Book(models.Model):
     """Model representing a book (but not a specific copy of a book)."""
@@ -95,6 +113,18 @@ class Book(models.Model):
     # add language attr
     language = models.ForeignKey(Language, on_delete=models.SET_NULL, null=True)
 
+    # the copies of the book, the signals and the loan service keep them up
+    # to date with F() increments, reconcile_catalog_stats repairs the drift
+    copies_total = models.IntegerField(default=0, editable=False)
+    copies_available = models.IntegerField(default=0, editable=False)
+    copies_on_loan = models.IntegerField(default=0, editable=False)
+
+    COPIES = ('copies_total', 'copies_available', 'copies_on_loan')
+
+    # the Last-Modified of the book page, the copies changing it are told by
+    # the fragment versions
+    updated_at = models.DateTimeField(auto_now=True)
+
     def __str__(self):
         """String for representing the Model object."""
         return self.title
@@ -125,6 +155,34 @@ class Book(models.Model):
             ('can_affect_books', 'Can affect books'),
             ('can_mark_returned', 'Set book as returned'),
         )
+        indexes = [
+            # the book list pages by (title, id)
+            models.Index(fields=['title', 'id'], name='book_title_idx'),
+            # the book list filtered by the language facet
+            models.Index(fields=['language', 'title', 'id'], name='book_language_title_idx'),
+            # the book list sorted by availability
+            models.Index(fields=['-copies_available', 'title', 'id'], name='book_available_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        # an update never writes the copy counters back: the loaded values may
+        # be stale by now and would overwrite the concurrent increments
+        if not self._state.adding and kwargs.get('update_fields') is None and not kwargs.get('force_insert'):
+            deferred = self.get_deferred_fields()
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in self.COPIES and field.attname not in deferred
+            ]
+        super().save(*args, **kwargs)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # remember the stored values, the catalog counters need the old ones
+        instance._loaded_title = instance.__dict__.get('title')
+        instance._loaded_language_id = instance.__dict__.get('language_id')
+        instance._loaded_author_id = instance.__dict__.get('author_id')
+        return instance
 
     def display_genre(self):
         """Create a string for the Genre. This is required to display genre in Admin."""
@@ -133,6 +191,47 @@ class Book(models.Model):
     display_genre.short_description = 'Genre'
 
 
+class DaysBetween(models.Func):
+    """The whole days from the start date to the end date, computed by the database."""
+    output_field = models.IntegerField()
+    arity = 2
+
+    def __init__(self, end, start, **extra):
+        super().__init__(end, start, **extra)
+
+    def as_sql(self, compiler, connection, **extra_context):
+        # MySQL and the others
+        return super().as_sql(compiler, connection, function='DATEDIFF', **extra_context)
+
+    def as_sqlite(self, compiler, connection, **extra_context):
+        return super().as_sql(
+            compiler, connection,
+            template='CAST(julianday(%(expressions)s) AS INTEGER)',
+            arg_joiner=') - julianday(',
+            **extra_context,
+        )
+
+    def as_postgresql(self, compiler, connection, **extra_context):
+        return super().as_sql(
+            compiler, connection, template='(%(expressions)s)', arg_joiner='::date - ', **extra_context,
+        )
+
+
+class BookInstanceQuerySet(models.QuerySet):
+    def on_loan(self):
+        return self.filter(status='o')
+
+    def overdue(self, today=None):
+        """the copies on loan past their due date, served by the (status, due_back) index"""
+        return self.on_loan().filter(due_back__lt=today or timezone.localdate())
+
+    def with_days_overdue(self, today=None):
+        """annotates days_overdue, the days past the due date (negative before it) in SQL"""
+        return self.annotate(
+            days_overdue=DaysBetween(models.Value(today or timezone.localdate()), models.F('due_back'))
+        )
+
+
 class BookInstance(models.Model):
     """Model representing a specific copy of a book (i.e. that can be borrowed from the library)."""
     id = models.UUIDField(
@@ -174,17 +273,324 @@ class BookInstance(models.Model):
         blank=True
     )
 
+    objects = BookInstanceQuerySet.as_manager()
+
     class Meta:
         ordering = ['due_back']
         permissions = (
             ("view_all_borrowed", "View all borrowed books"),
             ("can_mark_returned", "Can mark returned"),
         )
+        indexes = [
+            # all the borrowed copies by the due date, and the overdue ones
+            models.Index(fields=['status', 'due_back'], name='bookinst_status_due_idx'),
+            # the copies borrowed by a user by the due date
+            models.Index(
+                fields=['borrower', 'status', 'due_back'],
+                name='bookinst_borrower_due_idx',
+            ),
+        ]
 
     def __str__(self):
         """String for representing the Model object."""
         return f'{self.id} ({self.book.title})'
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # remember the stored status to catch the transitions into and out of 'a'
+        instance._loaded_status = instance.__dict__.get('status')
+        instance._loaded_book_id = instance.__dict__.get('book_id')
+        instance._loaded_borrower_id = instance.__dict__.get('borrower_id')
+        instance._loaded_due_back = instance.__dict__.get('due_back')
+        return instance
+
     def is_overdue(self) -> bool:
         """This method returns a boolean indicating whether the model is borrowed and overdue"""
+        # the lists annotate it in SQL, see BookInstanceQuerySet.with_days_overdue()
+        if getattr(self, 'days_overdue', None) is not None:
+            return self.days_overdue > 0
         return bool(self.due_back and date.today() > self.due_back)
+
+
+class Reservation(models.Model):
+    """
+    Model representing a hold of a reader on a book. The holds of a book are
+    served first come, first served: a returned copy is set aside ('r') for
+    the oldest waiting one, the expire_reservations job releases the copies
+    which are not picked up in time.
+    """
+    WAITING = 'w'
+    READY = 'r'
+    FULFILLED = 'f'
+    EXPIRED = 'e'
+    CANCELLED = 'c'
+    STATES = (
+        (WAITING, 'Waiting'),
+        (READY, 'Ready for pickup'),
+        (FULFILLED, 'Fulfilled'),
+        (EXPIRED, 'Expired'),
+        (CANCELLED, 'Cancelled'),
+    )
+
+    book = models.ForeignKey(Book, on_delete=models.CASCADE)
+    patron = models.ForeignKey(User, on_delete=models.CASCADE)
+    # the copy set aside for the patron, while the hold is ready
+    copy = models.ForeignKey(BookInstance, on_delete=models.SET_NULL, null=True, blank=True)
+    state = models.CharField(max_length=1, choices=STATES, default=WAITING)
+    created_at = models.DateTimeField(default=timezone.now)
+    expires_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['created_at', 'id']
+        indexes = [
+            # the head of the queue of a book is one index seek
+            models.Index(
+                fields=['book', 'created_at', 'id'],
+                condition=models.Q(state='w'),
+                name='reservation_queue_idx',
+            ),
+            # the ready holds by the pickup deadline, for the expiry job
+            models.Index(
+                fields=['expires_at'],
+                condition=models.Q(state='r'),
+                name='reservation_expiry_idx',
+            ),
+            models.Index(fields=['patron', 'state'], name='reservation_patron_idx'),
+        ]
+        constraints = [
+            # one active hold per reader and book
+            models.UniqueConstraint(
+                fields=['book', 'patron'],
+                condition=models.Q(state__in=['w', 'r']),
+                name='reservation_active_unique',
+            ),
+        ]
+
+    def __str__(self):
+        """String for representing the Model object."""
+        return f'{self.patron} - {self.book} ({self.get_state_display()})'
+
+
+class ReminderLog(models.Model):
+    """
+    Model representing the reminder e-mails sent to a reader, one row per
+    kind and day: a rerun of send_reminders skips the readers logged here.
+    """
+    DUE = 'd'
+    OVERDUE = 'o'
+    KINDS = (
+        (DUE, 'Due tomorrow'),
+        (OVERDUE, 'Overdue'),
+    )
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    kind = models.CharField(max_length=1, choices=KINDS)
+    sent_on = models.DateField()
+    loans = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'kind', 'sent_on'], name='reminder_log_unique'),
+        ]
+
+    def __str__(self):
+        """String for representing the Model object."""
+        return f'{self.user} - {self.get_kind_display()} ({self.sent_on})'
+
+
+class LoanEvent(models.Model):
+    """
+    Model representing one step of the history of a loan, append-only. The
+    references are plain ids without constraints, the history outlives the
+    copies, books and readers. archive_loan_events moves the closed months
+    out to files, the reports read the monthly rollups below.
+    """
+    CHECKOUT = 'c'
+    RETURN = 'r'
+    RENEWAL = 'n'
+    KINDS = (
+        (CHECKOUT, 'Checkout'),
+        (RETURN, 'Return'),
+        (RENEWAL, 'Renewal'),
+    )
+
+    occurred_at = models.DateTimeField(default=timezone.now)
+    kind = models.CharField(max_length=1, choices=KINDS)
+    copy = models.ForeignKey(
+        BookInstance, on_delete=models.DO_NOTHING, db_constraint=False, null=True, related_name='+'
+    )
+    book = models.ForeignKey(Book, on_delete=models.DO_NOTHING, db_constraint=False, null=True, related_name='+')
+    borrower = models.ForeignKey(
+        User, on_delete=models.DO_NOTHING, db_constraint=False, null=True, related_name='+'
+    )
+    due_back = models.DateField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # the months are rolled up and archived by ranges of the time
+            models.Index(fields=['occurred_at'], name='loanevent_occurred_idx'),
+        ]
+
+    def __str__(self):
+        """String for representing the Model object."""
+        return f'{self.get_kind_display()} of {self.copy_id} ({self.occurred_at})'
+
+
+class BookCirculation(models.Model):
+    """Monthly rollup of the loan events of a book."""
+    month = models.DateField(help_text='The first day of the month')
+    book = models.ForeignKey(Book, on_delete=models.DO_NOTHING, db_constraint=False, related_name='+')
+    checkouts = models.PositiveIntegerField(default=0)
+    returns = models.PositiveIntegerField(default=0)
+    renewals = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['month', 'book'], name='bookcirculation_unique'),
+        ]
+
+
+class BorrowerCirculation(models.Model):
+    """Monthly rollup of the checkouts of a reader."""
+    month = models.DateField(help_text='The first day of the month')
+    borrower = models.ForeignKey(User, on_delete=models.DO_NOTHING, db_constraint=False, related_name='+')
+    checkouts = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['month', 'borrower'], name='borrowercirculation_unique'),
+        ]
+
+
+class ArchivedLoanMonth(models.Model):
+    """A month whose loan events are archived, its rollups are final."""
+    month = models.DateField(unique=True, help_text='The first day of the month')
+    events = models.PositiveIntegerField(default=0)
+    archived_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        """String for representing the Model object."""
+        return f'{self.month:%Y-%m}'
+
+
+class BookLoanDay(models.Model):
+    """The checkouts of a book in a day, the buckets of the popular books windows."""
+    day = models.DateField()
+    book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='+')
+    loans = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'book'], name='bookloanday_unique'),
+        ]
+
+
+class BookPopularity(models.Model):
+    """
+    The checkouts of a book in the rolling windows of the popular books.
+    A checkout adds one to every window, update_popular_books recounts
+    them from the daily buckets as the old days fall out of the windows.
+    """
+    book = models.OneToOneField(Book, on_delete=models.CASCADE, primary_key=True, related_name='popularity')
+    loans_week = models.PositiveIntegerField(default=0)
+    loans_month = models.PositiveIntegerField(default=0)
+    loans_year = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        verbose_name_plural = 'book popularity'
+        indexes = [
+            # the top of a window is read straight from its index
+            models.Index(fields=['-loans_week', 'book'], name='popularity_week_idx'),
+            models.Index(fields=['-loans_month', 'book'], name='popularity_month_idx'),
+            models.Index(fields=['-loans_year', 'book'], name='popularity_year_idx'),
+        ]
+
+    def __str__(self):
+        """String for representing the Model object."""
+        return f'{self.book_id}: {self.loans_week}/{self.loans_month}/{self.loans_year}'
+
+
+class SimilarBook(models.Model):
+    """
+    A precomputed neighbour of a book, by the genres, the author, the
+    language and the readers they share. compute_similar_books refills it.
+    """
+    book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='similar_books')
+    similar = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='+')
+    rank = models.PositiveSmallIntegerField()
+    score = models.FloatField()
+
+    class Meta:
+        ordering = ['book', 'rank']
+        constraints = [
+            # the neighbours of a book are read in the order of this index
+            models.UniqueConstraint(fields=['book', 'rank'], name='similarbook_rank_unique'),
+        ]
+
+    def __str__(self):
+        """String for representing the Model object."""
+        return f'{self.book_id} -> {self.similar_id} ({self.score:.3f})'
+
+
+class CatalogStats(models.Model):
+    """
+    Single-row table with the totals shown on the homepage.
+    The signal handlers keep it up to date with F() increments,
+    the reconcile_catalog_stats command recounts it from scratch.
+    """
+    num_books = models.BigIntegerField(default=0)
+    num_instances = models.BigIntegerField(default=0)
+    num_instances_available = models.BigIntegerField(default=0)
+    num_authors = models.BigIntegerField(default=0)
+    num_genres = models.BigIntegerField(default=0)
+    num_books_with_and = models.BigIntegerField(default=0)
+
+    COUNTERS = (
+        'num_books',
+        'num_instances',
+        'num_instances_available',
+        'num_authors',
+        'num_genres',
+        'num_books_with_and',
+    )
+
+    class Meta:
+        verbose_name_plural = 'catalog stats'
+
+    def __str__(self):
+        """String for representing the Model object."""
+        return ', '.join(f'{name}={getattr(self, name)}' for name in self.COUNTERS)
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.COUNTERS}
+
+
+class FacetCount(models.Model):
+    """
+    Number of the books per genre, per language and per author initial.
+    Kept up to date by the signal handlers, so the book list never
+    groups the whole catalog just to show the facets.
+    """
+    GENRE = 'g'
+    LANGUAGE = 'l'
+    INITIAL = 'i'
+    FACETS = (
+        (GENRE, 'Genre'),
+        (LANGUAGE, 'Language'),
+        (INITIAL, 'Author initial'),
+    )
+
+    facet = models.CharField(max_length=1, choices=FACETS)
+    # the primary key of the genre or the language, or the initial itself
+    value = models.CharField(max_length=100)
+    count = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['facet', 'value'], name='facet_value_unique'),
+        ]
+
+    def __str__(self):
+        """String for representing the Model object."""
+        return f'{self.get_facet_display()} {self.value}: {self.count}'
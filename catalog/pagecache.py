@@ -0,0 +1,110 @@
+"""
+The cached pages of the catalog for the anonymous readers.
+
+A read view wrapped by cache_anonymous_page answers an anonymous GET in
+three ways, the cheapest first:
+
+* 304 Not Modified, when the ETag or the Last-Modified of the request is
+  still current (django.views.decorators.http.condition),
+* the response cached under the URL and the ETag, rendered by an earlier
+  request,
+* a fresh rendering, which is cached for the next ones. The workers asking
+  for the same new page at once wait for one rendering (see computed).
+
+The ETag is a version the signals renew on every change of what the page
+shows (see fragments), so a cached page is never served once it is out of
+date: it is not found any more, and expires. The readers who are logged in
+see their own links and forms and always get a fresh rendering.
+"""
+import hashlib
+from functools import wraps
+
+from django.contrib.messages.storage.cookie import CookieStorage
+from django.utils.cache import patch_cache_control
+from django.views.decorators.http import condition
+
+from .computed import get_or_compute
+from .fragments import AUTHOR, BOOK, catalog_version, fragment_version, stamp_time
+from .models import Author, Book
+
+PAGE_CACHE_KEY = 'catalog:page:{}:{}'
+
+# the popular books of the lists are cached this long too
+PAGE_CACHE_TIMEOUT = 60 * 5
+
+
+def catalog_validators(request, *args, **kwargs):
+    """The lists show books and authors, they change with the catalog version."""
+    version = catalog_version()
+    return version, stamp_time(version)
+
+
+def _object_validators(model, kind):
+    def validators(request, pk, **kwargs):
+        updated_at = model.objects.filter(pk=pk).values_list('updated_at', flat=True).first()
+        if updated_at is None:
+            # no such object, the view answers 404
+            return None, None
+        version = fragment_version(kind, pk)
+        # the version covers the copies and the genres, updated_at the object itself
+        return f'{version}.{updated_at.timestamp():.6f}', max(updated_at, stamp_time(version))
+    return validators
+
+
+book_validators = _object_validators(Book, BOOK)
+author_validators = _object_validators(Author, AUTHOR)
+
+
+def is_cacheable(response):
+    """the complete pages only, the redirects and the errors are answered again"""
+    return response.status_code == 200 and not response.streaming
+
+
+def cache_anonymous_page(validators, timeout=PAGE_CACHE_TIMEOUT):
+    """
+    The decorator of a read view. validators(request, *args, **kwargs)
+    returns the (ETag, Last-Modified) of the page, or (None, None).
+    """
+    def get_validators(request, *args, **kwargs):
+        # condition() asks for the ETag and the Last-Modified apart
+        if not hasattr(request, '_page_validators'):
+            request._page_validators = validators(request, *args, **kwargs)
+        return request._page_validators
+
+    def decorator(view):
+        def cached_view(request, *args, **kwargs):
+            etag = get_validators(request, *args, **kwargs)[0]
+            if etag is None:
+                return view(request, *args, **kwargs)
+            key = PAGE_CACHE_KEY.format(etag, hashlib.md5(request.get_full_path().encode()).hexdigest())
+
+            def render():
+                response = view(request, *args, **kwargs)
+                if callable(getattr(response, 'render', None)):
+                    response.render()
+                return response
+
+            # a new version is rendered by one worker, the others wait for it
+            return get_or_compute(key, render, timeout, cacheable=is_cacheable)
+
+        conditional_view = condition(
+            etag_func=lambda request, *args, **kwargs: get_validators(request, *args, **kwargs)[0],
+            last_modified_func=lambda request, *args, **kwargs: get_validators(request, *args, **kwargs)[1],
+        )(cached_view)
+
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if (
+                request.method not in ('GET', 'HEAD')
+                or request.user.is_authenticated
+                # the messages are shown once, to their reader only
+                or CookieStorage.cookie_name in request.COOKIES
+            ):
+                return view(request, *args, **kwargs)
+            response = conditional_view(request, *args, **kwargs)
+            if response.status_code in (200, 304):
+                # the browsers and the CDN keep the page, and ask whether it is still current
+                patch_cache_control(response, public=True, no_cache=True)
+            return response
+        return wrapper
+    return decorator
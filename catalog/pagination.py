@@ -0,0 +1,226 @@
+import base64
+import binascii
+import json
+from functools import reduce
+from urllib.parse import urlencode
+from operator import or_
+
+from django.db.models import Q
+from django.http import Http404
+from django.utils.translation import gettext as _
+
+
+class InvalidPage(Exception):
+    """Raised when a page number or a cursor is out of range or broken."""
+
+
+class KeysetPage:
+    """
+    A single page produced by the KeysetPaginator.
+    Quacks like django.core.paginator.Page for the templates,
+    but it knows nothing about the total count of the rows.
+    """
+
+    def __init__(self, object_list, paginator, number=None,
+                 has_next=False, has_previous=False, boundary=None):
+        self.object_list = object_list
+        self.paginator = paginator
+        # number is only known for the shallow ?page=N pages
+        self.number = number
+        self._has_next = has_next
+        self._has_previous = has_previous
+        # the key values of the requested cursor, the links of an empty page
+        # (a stale or past-the-end cursor) start from there, the boundary row
+        # included
+        self.boundary = boundary
+
+    def __repr__(self):
+        return '<KeysetPage {}>'.format(self.number or 'cursor')
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self._has_previous
+
+    def has_other_pages(self):
+        return self._has_next or self._has_previous
+
+    @property
+    def next_cursor(self):
+        """opaque cursor pointing right after the last row of the page"""
+        if not self._has_next:
+            return None
+        if not self.object_list:
+            return None if self.boundary is None else self.paginator.encode_key(self.boundary, forward=True, inclusive=True)
+        return self.paginator.encode_cursor(self.object_list[-1], forward=True)
+
+    @property
+    def previous_cursor(self):
+        """opaque cursor pointing right before the first row of the page"""
+        if not self._has_previous:
+            return None
+        if not self.object_list:
+            return None if self.boundary is None else self.paginator.encode_key(self.boundary, forward=False, inclusive=True)
+        return self.paginator.encode_cursor(self.object_list[0], forward=False)
+
+
+class KeysetPaginator:
+    """
+    Seek (keyset) paginator. Instead of OFFSET + COUNT(*) it remembers the
+    sort key of the boundary row and asks for the rows after (or before) it,
+    so page 5000 costs as much as the page 1 does.
+    The ordering fields have to be non-nullable, the primary key is
+    always appended as a tie-breaker to make the ordering total.
+    """
+
+    def __init__(self, queryset, per_page, ordering, max_offset_page=50):
+        self.per_page = int(per_page)
+        self.max_offset_page = max_offset_page
+        ordering = list(ordering)
+        if not any(field.lstrip('-') in ('pk', 'id') for field in ordering):
+            ordering.append('pk')
+        self.ordering = ordering
+        self.queryset = queryset.order_by(*ordering)
+
+    @staticmethod
+    def _split(field):
+        """returns the (field name, is descending) pair"""
+        return field.lstrip('-'), field.startswith('-')
+
+    def _key(self, obj):
+        return [getattr(obj, self._split(field)[0]) for field in self.ordering]
+
+    def encode_cursor(self, obj, forward=True):
+        return self.encode_key(self._key(obj), forward)
+
+    @staticmethod
+    def encode_key(values, forward=True, inclusive=False):
+        cursor = {'k': values, 'd': 'n' if forward else 'p'}
+        if inclusive:
+            cursor['i'] = 1
+        payload = json.dumps(cursor, default=str, separators=(',', ':'))
+        return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+    def decode_cursor(self, cursor):
+        """returns the (key values, is forward, is inclusive) triple"""
+        try:
+            padded = cursor + '=' * (-len(cursor) % 4)
+            payload = json.loads(base64.urlsafe_b64decode(padded.encode()))
+            values, direction, inclusive = payload['k'], payload['d'], payload.get('i') == 1
+        except (binascii.Error, ValueError, TypeError, KeyError, UnicodeDecodeError):
+            raise InvalidPage(cursor)
+        if not isinstance(values, list) or len(values) != len(self.ordering) \
+                or direction not in ('n', 'p'):
+            raise InvalidPage(cursor)
+        return values, direction == 'n', inclusive
+
+    def _seek_filter(self, values, forward, inclusive=False):
+        """
+        Build (a > x) OR (a = x AND b > y) OR ... for the given boundary.
+        The comparison is flipped for the descending fields and for the
+        backward direction. An inclusive seek adds the boundary row itself.
+        """
+        clauses = []
+        for position, field in enumerate(self.ordering):
+            name, descending = self._split(field)
+            lookup = 'lt' if descending == forward else 'gt'
+            conditions = {
+                self._split(previous)[0]: values[index]
+                for index, previous in enumerate(self.ordering[:position])
+            }
+            conditions['{}__{}'.format(name, lookup)] = values[position]
+            clauses.append(Q(**conditions))
+        if inclusive:
+            clauses.append(Q(**{self._split(field)[0]: value for field, value in zip(self.ordering, values)}))
+        return reduce(or_, clauses)
+
+    def page(self, number=None, cursor=None):
+        """Returns a page either by the opaque cursor or by the shallow number."""
+        if cursor:
+            return self._page_by_cursor(cursor)
+        return self._page_by_number(number or 1)
+
+    def _page_by_number(self, number):
+        number = int(number)
+        if number < 1 or number > self.max_offset_page:
+            raise InvalidPage(number)
+        offset = (number - 1) * self.per_page
+        rows = list(self.queryset[offset:offset + self.per_page + 1])
+        if not rows and number > 1:
+            raise InvalidPage(number)
+        return KeysetPage(
+            rows[:self.per_page], self, number=number,
+            has_next=len(rows) > self.per_page,
+            has_previous=number > 1,
+        )
+
+    def cursor_queryset(self, cursor):
+        """the rows of the page after or before the cursor, and one more to tell whether there are others"""
+        values, forward, inclusive = self.decode_cursor(cursor)
+        queryset = self.queryset.filter(self._seek_filter(values, forward, inclusive))
+        if not forward:
+            queryset = queryset.reverse()
+        return queryset[:self.per_page + 1]
+
+    def _page_by_cursor(self, cursor):
+        values, forward, _ = self.decode_cursor(cursor)
+        rows = list(self.cursor_queryset(cursor))
+        has_more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        if forward:
+            return KeysetPage(rows, self, has_next=has_more, has_previous=True, boundary=values)
+        rows.reverse()
+        return KeysetPage(rows, self, has_next=True, has_previous=has_more, boundary=values)
+
+
+class KeysetPaginationMixin:
+    """
+    ListView mixin replacing the offset paginator with the KeysetPaginator.
+    ?cursor=... is used for navigation, ?page=N keeps working for the first
+    max_offset_page pages (the old links), deeper numbers give 404.
+    """
+    cursor_kwarg = 'cursor'
+    max_offset_page = 50
+
+    def get_keyset_ordering(self):
+        ordering = self.get_ordering() or self.model._meta.ordering
+        if isinstance(ordering, str):
+            ordering = (ordering,)
+        return ordering
+
+    def paginate_queryset(self, queryset, page_size):
+        paginator = KeysetPaginator(
+            queryset,
+            page_size,
+            self.get_keyset_ordering(),
+            max_offset_page=self.max_offset_page,
+        )
+        cursor = self.request.GET.get(self.cursor_kwarg)
+        number = self.kwargs.get(self.page_kwarg) or self.request.GET.get(self.page_kwarg) or 1
+        try:
+            page = paginator.page(number=number, cursor=cursor)
+        except (InvalidPage, ValueError):
+            raise Http404(_('Invalid page or cursor.'))
+        return paginator, page, page.object_list, page.has_other_pages()
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        # the other query parameters (e.g. the filters) survive the page links
+        params = [
+            (key, value)
+            for key, values in self.request.GET.lists()
+            if key not in (self.cursor_kwarg, self.page_kwarg)
+            for value in values
+        ]
+        context['pagination_params'] = urlencode(params) + '&' if params else ''
+        return context
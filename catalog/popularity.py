@@ -0,0 +1,143 @@
+"""
+The popular books: the most borrowed books of the last week, month and year.
+
+Every checkout adds one to the daily bucket of its book and to the window
+counters of BookPopularity, two O(1) UPDATEs. The top of a window is read
+from the index of its counter, O(k), and cached for a few minutes. Once a
+day update_popular_books() recounts the windows from the daily buckets, so
+the days which have fallen out of a window stop counting, and drops the
+buckets older than the longest window. Between two recounts a window holds
+up to a day more than its length.
+"""
+import datetime
+
+from django.core.cache import cache
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Count, F, Q, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from .computed import get_or_compute
+from .fragments import invalidate_catalog_version
+from .models import BookLoanDay, BookPopularity, LoanEvent
+
+# the window name -> its length in days
+WINDOWS = {
+    'week': 7,
+    'month': 30,
+    'year': 365,
+}
+
+POPULAR_CACHE_KEY = 'catalog:popular'
+# the leaderboard is not invalidated by every checkout, it may lag this much
+POPULAR_CACHE_TIMEOUT = 300
+
+DEFAULT_LIMIT = 5
+
+
+def _upsert(model, lookup, **increments):
+    """UPDATE ... SET x = x + n, or INSERT the row when there is none yet."""
+    if model.objects.filter(**lookup).update(**{name: F(name) + n for name, n in increments.items()}):
+        return
+    try:
+        with transaction.atomic():
+            model.objects.create(**lookup, **increments)
+    except IntegrityError:
+        # somebody else has just created it
+        model.objects.filter(**lookup).update(**{name: F(name) + n for name, n in increments.items()})
+
+
+def count_loan(book_id, day=None):
+    """Counts a checkout of the book in its daily bucket and in every window."""
+    if book_id is None:
+        return
+    _upsert(BookLoanDay, {'day': day or timezone.localdate(), 'book_id': book_id}, loans=1)
+    _upsert(BookPopularity, {'book_id': book_id}, **{f'loans_{name}': 1 for name in WINDOWS})
+
+
+def window_starts(today=None):
+    """the window name -> its first day"""
+    today = today or timezone.localdate()
+    return {name: today - datetime.timedelta(days=days - 1) for name, days in WINDOWS.items()}
+
+
+def update_popular_books(today=None):
+    """
+    Recounts the windows from the daily buckets with one GROUP BY and drops
+    the buckets which no window needs any more. Returns the number of books.
+    The rows are upserted and only the books left without a bucket are
+    deleted, so a reader never sees the leaderboard empty.
+
+    The checkouts wait for the recount with their window counters: on
+    PostgreSQL an increment committed between the GROUP BY and the upsert
+    would be overwritten. SQLite serializes the writers anyway, the
+    DELETE takes the write lock first.
+    """
+    starts = window_starts(today)
+    oldest = min(starts.values())
+    counters = [f'loans_{name}' for name in starts]
+    with transaction.atomic():
+        if connection.vendor == 'postgresql':
+            # blocks the UPDATEs and INSERTs of count_loan, not the readers
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f'LOCK TABLE {connection.ops.quote_name(BookPopularity._meta.db_table)} IN EXCLUSIVE MODE'
+                )
+        BookLoanDay.objects.filter(day__lt=oldest).delete()
+        rows = (
+            BookLoanDay.objects.values('book')
+            .annotate(**{f'loans_{name}': Sum('loans', filter=Q(day__gte=start)) for name, start in starts.items()})
+            .order_by()
+        )
+        popularity = [
+            BookPopularity(book_id=row.pop('book'), **{name: count or 0 for name, count in row.items()})
+            for row in rows
+        ]
+        BookPopularity.objects.bulk_create(
+            popularity, batch_size=1000, update_conflicts=True, unique_fields=['book'], update_fields=counters,
+        )
+        BookPopularity.objects.exclude(book__in=BookLoanDay.objects.values('book')).delete()
+    invalidate_popular_books()
+    return len(popularity)
+
+
+def rebuild_loan_days(today=None):
+    """Refills the daily buckets from the checkouts in the loan history, to start the windows off."""
+    since = min(window_starts(today).values())
+    start = timezone.make_aware(datetime.datetime.combine(since, datetime.time()))
+    with transaction.atomic():
+        BookLoanDay.objects.filter(day__gte=since).delete()
+        BookLoanDay.objects.bulk_create(
+            [
+                BookLoanDay(**row)
+                for row in (
+                    LoanEvent.objects.filter(kind=LoanEvent.CHECKOUT, occurred_at__gte=start, book__isnull=False)
+                    .annotate(day=TruncDate('occurred_at')).values('day', 'book_id')
+                    .annotate(loans=Count('pk')).order_by()
+                )
+            ],
+            batch_size=1000,
+        )
+
+
+def top_books(window, limit=DEFAULT_LIMIT):
+    """[(book id, title, loans)] of the window, one seek of its index"""
+    counter = f'loans_{window}'
+    return list(
+        BookPopularity.objects.filter(**{f'{counter}__gt': 0})
+        .order_by(f'-{counter}', 'book')
+        .values_list('book', 'book__title', counter)[:limit]
+    )
+
+
+def get_popular_books():
+    """the window name -> its top books, from the cache when it is warm"""
+    return get_or_compute(
+        POPULAR_CACHE_KEY, lambda: {name: top_books(name) for name in WINDOWS}, POPULAR_CACHE_TIMEOUT,
+    )
+
+
+def invalidate_popular_books():
+    cache.delete(POPULAR_CACHE_KEY)
+    # the cached list pages show them
+    invalidate_catalog_version()
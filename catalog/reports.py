@@ -0,0 +1,126 @@
+"""
+The overdue report: the overdue loans bucketed by their age and grouped
+by the borrower. Everything is counted by GROUP BY aggregates over the
+(status, due_back) index, no loan is loaded into Python.
+
+The circulation report: the loans per month, book, genre and borrower.
+It sums the monthly rollups of the loan history (see history.py), never
+the raw events, so its cost grows with the months, not with the loans.
+"""
+import datetime
+
+from django.db.models import Case, Count, IntegerField, Max, Min, Sum, Value, When
+from django.utils import timezone
+
+from .history import month_start
+from .models import BookCirculation, BookInstance, BorrowerCirculation
+
+# (the bucket, its label, the most days overdue in it or None)
+AGE_BUCKETS = (
+    (1, '1-7 days', 7),
+    (2, '8-14 days', 14),
+    (3, '15-30 days', 30),
+    (4, '31-90 days', 90),
+    (5, 'over 90 days', None),
+)
+
+
+def overdue_loans(today=None):
+    return BookInstance.objects.overdue(today).with_days_overdue(today).order_by()
+
+
+def overdue_by_age(today=None):
+    """[(label, loans, borrowers, oldest days overdue)] for every bucket, the empty ones too"""
+    bucket = Case(
+        *[When(days_overdue__lte=most, then=Value(number)) for number, _, most in AGE_BUCKETS if most],
+        default=Value(AGE_BUCKETS[-1][0]),
+        output_field=IntegerField(),
+    )
+    rows = {
+        row['bucket']: row
+        for row in (
+            overdue_loans(today).annotate(bucket=bucket).values('bucket')
+            .annotate(loans=Count('*'), borrowers=Count('borrower', distinct=True), oldest=Max('days_overdue'))
+        )
+    }
+    return [
+        (label, rows.get(number, {}).get('loans', 0), rows.get(number, {}).get('borrowers', 0),
+         rows.get(number, {}).get('oldest'))
+        for number, label, _ in AGE_BUCKETS
+    ]
+
+
+def overdue_by_borrower(today=None, limit=20):
+    """the borrowers with the most overdue loans first"""
+    return list(
+        overdue_loans(today).values('borrower', 'borrower__username')
+        .annotate(
+            loans=Count('*'),
+            oldest=Max('days_overdue'),
+            newest=Min('days_overdue'),
+            total_days=Sum('days_overdue'),
+        )
+        .order_by('-loans', '-oldest', 'borrower')[:limit]
+    )
+
+
+def overdue_report(today=None, limit=20):
+    today = today or timezone.localdate()
+    by_age = overdue_by_age(today)
+    return {
+        'today': today,
+        'by_age': by_age,
+        'total': sum(loans for _, loans, _, _ in by_age),
+        'by_borrower': overdue_by_borrower(today, limit),
+    }
+
+
+def circulation_by_month(since):
+    """[{month, checkouts, returns, renewals}] from the month since on"""
+    return list(
+        BookCirculation.objects.filter(month__gte=since).values('month')
+        .annotate(checkouts=Sum('checkouts'), returns=Sum('returns'), renewals=Sum('renewals'))
+        .order_by('month')
+    )
+
+
+def top_books(since, limit=20):
+    return list(
+        BookCirculation.objects.filter(month__gte=since).values('book', 'book__title')
+        .annotate(checkouts=Sum('checkouts'), renewals=Sum('renewals'))
+        .order_by('-checkouts', 'book')[:limit]
+    )
+
+
+def circulation_by_genre(since):
+    """the checkouts per genre, a book of several genres counts in each"""
+    return list(
+        BookCirculation.objects.filter(month__gte=since, book__genre__isnull=False)
+        .values('book__genre__name')
+        .annotate(checkouts=Sum('checkouts'))
+        .order_by('-checkouts', 'book__genre__name')
+    )
+
+
+def top_borrowers(since, limit=20):
+    return list(
+        BorrowerCirculation.objects.filter(month__gte=since).values('borrower', 'borrower__username')
+        .annotate(checkouts=Sum('checkouts'), months=Count('month'))
+        .order_by('-checkouts', 'borrower')[:limit]
+    )
+
+
+def circulation_report(months=12, limit=20):
+    """the circulation of the last months, the current one included"""
+    since = month_start(timezone.localdate())
+    for _ in range(months - 1):
+        since = month_start(since - datetime.timedelta(days=1))
+    by_month = circulation_by_month(since)
+    return {
+        'since': since,
+        'by_month': by_month,
+        'total': sum(row['checkouts'] for row in by_month),
+        'top_books': top_books(since, limit),
+        'by_genre': circulation_by_genre(since),
+        'top_borrowers': top_borrowers(since, limit),
+    }
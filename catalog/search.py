@@ -0,0 +1,190 @@
+"""
+Full-text search over the books.
+
+Every book has one document in the catalog_book_search table: its title,
+summary, author name and genre names. On SQLite the table is an FTS5
+virtual table ranked by bm25(), on PostgreSQL it is a tsvector column with
+a GIN index ranked by ts_rank_cd(). The signal handlers keep the documents
+in sync, other databases fall back to the icontains lookups.
+"""
+import re
+from collections import defaultdict
+
+from django.db import connection
+from django.db.models import Q
+
+from .models import Book
+
+SEARCH_TABLE = 'catalog_book_search'
+
+# the books are (re)indexed in the chunks of this size
+INDEX_CHUNK_SIZE = 500
+
+# the most words of the query that are taken into account
+MAX_QUERY_TOKENS = 10
+
+# bm25() weights of the title, summary, authors and genres columns
+SQLITE_WEIGHTS = (10.0, 1.0, 5.0, 3.0)
+
+POSTGRES_CONFIG = 'english'
+
+
+def has_search_index():
+    return connection.vendor in ('sqlite', 'postgresql')
+
+
+def query_tokens(query):
+    """Splits the user input into the plain words, all the operators are dropped."""
+    return re.findall(r'[^\W_]+', query.lower())[:MAX_QUERY_TOKENS]
+
+
+def _chunks(items, size=INDEX_CHUNK_SIZE):
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def _placeholders(items):
+    return ', '.join(['%s'] * len(items))
+
+
+def book_documents(book_ids):
+    """Returns (id, title, summary, authors, genres) rows for the given books."""
+    genres = defaultdict(list)
+    for book_id, name in (
+        Book.genre.through.objects
+        .filter(book_id__in=book_ids)
+        .values_list('book_id', 'genre__name')
+    ):
+        genres[book_id].append(name)
+
+    rows = (
+        Book.objects
+        .filter(pk__in=book_ids)
+        .values_list('pk', 'title', 'summary', 'author__first_name', 'author__last_name')
+    )
+    return [
+        (
+            pk,
+            title,
+            summary or '',
+            ' '.join(name for name in (first_name, last_name) if name),
+            ' '.join(genres[pk]),
+        )
+        for pk, title, summary, first_name, last_name in rows
+    ]
+
+
+def remove_books(book_ids):
+    if not has_search_index():
+        return
+    key = 'rowid' if connection.vendor == 'sqlite' else 'book_id'
+    with connection.cursor() as cursor:
+        for chunk in _chunks(book_ids):
+            cursor.execute(
+                f'DELETE FROM {SEARCH_TABLE} WHERE {key} IN ({_placeholders(chunk)})',
+                chunk,
+            )
+
+
+def prune_search_index():
+    """Drops the documents of the books which are gone (e.g. deleted in bulk)."""
+    if not has_search_index():
+        return
+    key = 'rowid' if connection.vendor == 'sqlite' else 'book_id'
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'DELETE FROM {SEARCH_TABLE} WHERE {key} NOT IN (SELECT id FROM {Book._meta.db_table})'
+        )
+
+
+def index_books(book_ids):
+    """(Re)builds the search documents of the given books."""
+    if not has_search_index():
+        return
+    for chunk in _chunks(book_ids):
+        documents = book_documents(chunk)
+        with connection.cursor() as cursor:
+            if connection.vendor == 'sqlite':
+                # FTS5 tables have no upsert
+                cursor.execute(
+                    f'DELETE FROM {SEARCH_TABLE} WHERE rowid IN ({_placeholders(chunk)})',
+                    chunk,
+                )
+                cursor.executemany(
+                    f'INSERT INTO {SEARCH_TABLE} (rowid, title, summary, authors, genres) '
+                    f'VALUES (%s, %s, %s, %s, %s)',
+                    documents,
+                )
+            else:
+                cursor.executemany(
+                    f'INSERT INTO {SEARCH_TABLE} (book_id, document) VALUES (%s, '
+                    f"setweight(to_tsvector('{POSTGRES_CONFIG}', %s), 'A') || "
+                    f"setweight(to_tsvector('{POSTGRES_CONFIG}', %s), 'D') || "
+                    f"setweight(to_tsvector('{POSTGRES_CONFIG}', %s), 'B') || "
+                    f"setweight(to_tsvector('{POSTGRES_CONFIG}', %s), 'C')) "
+                    f'ON CONFLICT (book_id) DO UPDATE SET document = EXCLUDED.document',
+                    documents,
+                )
+
+
+def _ranked_ids(tokens, offset, limit):
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            weights = ', '.join(str(weight) for weight in SQLITE_WEIGHTS)
+            cursor.execute(
+                f'SELECT rowid FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH %s '
+                f'ORDER BY bm25({SEARCH_TABLE}, {weights}), rowid LIMIT %s OFFSET %s',
+                [' '.join(f'"{token}"*' for token in tokens), limit, offset],
+            )
+        else:
+            cursor.execute(
+                f'SELECT book_id FROM {SEARCH_TABLE}, '
+                f"to_tsquery('{POSTGRES_CONFIG}', %s) query WHERE document @@ query "
+                f'ORDER BY ts_rank_cd(document, query) DESC, book_id LIMIT %s OFFSET %s',
+                [' & '.join(f'{token}:*' for token in tokens), limit, offset],
+            )
+        return [row[0] for row in cursor.fetchall()]
+
+
+def _fallback_condition(tokens):
+    condition = Q()
+    for token in tokens:
+        condition &= (
+            Q(title__icontains=token)
+            | Q(summary__icontains=token)
+            | Q(author__first_name__icontains=token)
+            | Q(author__last_name__icontains=token)
+            | Q(genre__name__icontains=token)
+        )
+    return condition
+
+
+def search_book_ids(query, limit=100):
+    """Returns the ids of the best matching books, for the lookups which load the books themselves."""
+    tokens = query_tokens(query)
+    if not tokens:
+        return []
+    if not has_search_index():
+        return list(
+            Book.objects.filter(_fallback_condition(tokens)).distinct()
+            .order_by('title', 'pk').values_list('pk', flat=True)[:limit]
+        )
+    return _ranked_ids(tokens, 0, limit)
+
+
+def search_books(query, offset=0, limit=10):
+    """Returns the books matching all the words of the query, the best first."""
+    tokens = query_tokens(query)
+    if not tokens:
+        return []
+
+    if not has_search_index():
+        return list(
+            Book.objects.filter(_fallback_condition(tokens)).distinct()
+            .select_related('author').order_by('title', 'pk')[offset:offset + limit]
+        )
+
+    ids = _ranked_ids(tokens, offset, limit)
+    books = Book.objects.select_related('author').in_bulk(ids)
+    return [books[pk] for pk in ids if pk in books]
@@ -0,0 +1,349 @@
+from collections import Counter
+
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .autocomplete import AUTHOR, BOOK, author_entry, book_entry, catalog_autocomplete, pack
+from .copies import copy_deltas, move_copy, update_book_copies
+from .facets import author_initial, author_initials, delete_facet, update_facet_counts
+from .fragments import (
+    AUTHOR as AUTHOR_FRAGMENTS, BOOK as BOOK_FRAGMENTS, invalidate_catalog_version, invalidate_fragments,
+)
+from .history import log_loan_event
+from .models import Author, Book, BookInstance, FacetCount, Genre, Language, LoanEvent, SimilarBook
+from .popularity import count_loan
+from .search import index_books, remove_books
+from .stats import invalidate_catalog_stats, title_has_and, update_catalog_stats
+
+
+@receiver(post_save, sender=Book)
+@receiver(post_delete, sender=Book)
+@receiver(post_save, sender=BookInstance)
+@receiver(post_delete, sender=BookInstance)
+@receiver(post_save, sender=Author)
+@receiver(post_delete, sender=Author)
+@receiver(post_save, sender=Genre)
+@receiver(post_delete, sender=Genre)
+def drop_catalog_stats(sender, **kwargs):
+    """Any change of the counted models makes the cached homepage counters stale."""
+    invalidate_catalog_stats()
+    # and once more after the commit, when the new counters become visible
+    transaction.on_commit(invalidate_catalog_stats)
+
+
+# the fragment handlers go first, the ones below move the _loaded_* ids on
+@receiver(pre_delete, sender=Book)
+def remember_similar_of(sender, instance, **kwargs):
+    # the neighbour rows are deleted with the book, before post_delete
+    instance._similar_of = similar_of(instance.pk)
+
+
+def similar_of(pk):
+    """the books showing this one among their similar books"""
+    return list(SimilarBook.objects.filter(similar=pk).values_list('book', flat=True))
+
+
+@receiver(post_save, sender=Book)
+@receiver(post_delete, sender=Book)
+def invalidate_book_fragments(sender, instance, created=False, **kwargs):
+    """
+    the book page, the book lists of its author, the old and the new one,
+    and the pages listing it among their similar books, with its title
+    """
+    invalidate_fragments(BOOK_FRAGMENTS, [instance.pk])
+    invalidate_fragments(AUTHOR_FRAGMENTS, [instance.author_id, getattr(instance, '_loaded_author_id', None)])
+    if hasattr(instance, '_similar_of'):
+        invalidate_fragments(BOOK_FRAGMENTS, instance._similar_of)
+    elif not created and instance.title != getattr(instance, '_loaded_title', None):
+        invalidate_fragments(BOOK_FRAGMENTS, similar_of(instance.pk))
+
+
+@receiver(post_save, sender=BookInstance)
+@receiver(post_delete, sender=BookInstance)
+def invalidate_copy_fragments(sender, instance, **kwargs):
+    invalidate_fragments(BOOK_FRAGMENTS, [instance.book_id, getattr(instance, '_loaded_book_id', None)])
+
+
+@receiver(post_save, sender=Author)
+@receiver(post_delete, sender=Author)
+def invalidate_author_fragments(sender, instance, **kwargs):
+    invalidate_fragments(AUTHOR_FRAGMENTS, [instance.pk])
+
+
+@receiver(post_save, sender=Book)
+def count_saved_book(sender, instance, created, **kwargs):
+    has_and = title_has_and(instance.title)
+    if created:
+        update_catalog_stats(num_books=1, num_books_with_and=int(has_and))
+    elif hasattr(instance, '_loaded_title'):
+        update_catalog_stats(
+            num_books_with_and=int(has_and) - int(title_has_and(instance._loaded_title))
+        )
+    instance._loaded_title = instance.title
+
+
+@receiver(post_delete, sender=Book)
+def count_deleted_book(sender, instance, **kwargs):
+    title = getattr(instance, '_loaded_title', instance.title)
+    update_catalog_stats(num_books=-1, num_books_with_and=-int(title_has_and(title)))
+
+
+@receiver(post_save, sender=BookInstance)
+def count_saved_book_instance(sender, instance, created, **kwargs):
+    available = instance.status == 'a'
+    if created:
+        update_catalog_stats(num_instances=1, num_instances_available=int(available))
+        update_book_copies(instance.book_id, **copy_deltas(instance.status))
+    elif hasattr(instance, '_loaded_status'):
+        # the status transitions into and out of 'a'
+        update_catalog_stats(
+            num_instances_available=int(available) - int(instance._loaded_status == 'a')
+        )
+        move_copy(instance._loaded_book_id, instance._loaded_status, instance.book_id, instance.status)
+        log_saved_loan(instance)
+    instance._loaded_status = instance.status
+    instance._loaded_book_id = instance.book_id
+    instance._loaded_borrower_id = instance.borrower_id
+    instance._loaded_due_back = instance.due_back
+
+
+@receiver(post_save, sender=LoanEvent)
+def count_loan_event(sender, instance, created, **kwargs):
+    """The checkouts feed the popular books windows."""
+    if created and instance.kind == LoanEvent.CHECKOUT:
+        count_loan(instance.book_id, timezone.localdate(instance.occurred_at))
+
+
+def log_saved_loan(instance):
+    """The loans changed with save(), in the admin, go to the history like those of the loan service."""
+    was_on_loan, on_loan = instance._loaded_status == 'o', instance.status == 'o'
+    if was_on_loan and (not on_loan or instance.borrower_id != instance._loaded_borrower_id):
+        log_loan_event(LoanEvent.RETURN, instance.pk, instance._loaded_book_id,
+                       instance._loaded_borrower_id, instance._loaded_due_back)
+        was_on_loan = False
+    if on_loan and not was_on_loan:
+        log_loan_event(LoanEvent.CHECKOUT, instance.pk, instance.book_id, instance.borrower_id, instance.due_back)
+    elif on_loan and instance.due_back != instance._loaded_due_back:
+        log_loan_event(LoanEvent.RENEWAL, instance.pk, instance.book_id, instance.borrower_id, instance.due_back)
+
+
+@receiver(post_delete, sender=BookInstance)
+def count_deleted_book_instance(sender, instance, **kwargs):
+    status = getattr(instance, '_loaded_status', instance.status)
+    update_catalog_stats(num_instances=-1, num_instances_available=-int(status == 'a'))
+    update_book_copies(getattr(instance, '_loaded_book_id', instance.book_id), **copy_deltas(status, -1))
+
+
+def _counter_name(sender):
+    return 'num_authors' if sender is Author else 'num_genres'
+
+
+@receiver(post_save, sender=Author)
+@receiver(post_save, sender=Genre)
+def count_saved_author_or_genre(sender, created, **kwargs):
+    if created:
+        update_catalog_stats(**{_counter_name(sender): 1})
+
+
+@receiver(post_delete, sender=Author)
+@receiver(post_delete, sender=Genre)
+def count_deleted_author_or_genre(sender, **kwargs):
+    update_catalog_stats(**{_counter_name(sender): -1})
+
+
+@receiver(post_save, sender=Book)
+def index_saved_book(sender, instance, **kwargs):
+    index_books([instance.pk])
+
+
+@receiver(post_delete, sender=Book)
+def unindex_deleted_book(sender, instance, **kwargs):
+    remove_books([instance.pk])
+
+
+@receiver(m2m_changed, sender=Book.genre.through)
+def index_book_genres(sender, instance, action, reverse, pk_set, **kwargs):
+    if reverse and action == 'pre_clear':
+        # the books of a genre are about to be unlinked, remember them
+        instance._search_book_ids = list(instance.book_set.values_list('pk', flat=True))
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        index_books([instance.pk])
+    elif action == 'post_clear':
+        index_books(getattr(instance, '_search_book_ids', []))
+    else:
+        index_books(pk_set)
+
+
+@receiver(m2m_changed, sender=Book.genre.through)
+def invalidate_genre_fragments(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        invalidate_fragments(BOOK_FRAGMENTS, [instance.pk])
+    elif action == 'post_clear':
+        # remembered by index_book_genres
+        invalidate_fragments(BOOK_FRAGMENTS, getattr(instance, '_search_book_ids', []))
+    else:
+        invalidate_fragments(BOOK_FRAGMENTS, pk_set)
+
+
+@receiver(post_save, sender=Author)
+@receiver(post_save, sender=Genre)
+def index_renamed_books(sender, instance, created, **kwargs):
+    """the author and the genre names are a part of their books' documents"""
+    if not created:
+        index_books(instance.book_set.values_list('pk', flat=True))
+
+
+@receiver(pre_delete, sender=Author)
+@receiver(pre_delete, sender=Genre)
+@receiver(pre_delete, sender=Language)
+def remember_unlinked_books(sender, instance, **kwargs):
+    instance._search_book_ids = list(instance.book_set.values_list('pk', flat=True))
+
+
+@receiver(post_delete, sender=Author)
+@receiver(post_delete, sender=Genre)
+def index_unlinked_books(sender, instance, **kwargs):
+    index_books(getattr(instance, '_search_book_ids', []))
+
+
+@receiver(post_save, sender=Author)
+@receiver(post_save, sender=Genre)
+@receiver(post_save, sender=Language)
+def invalidate_renamed_fragments(sender, instance, created, **kwargs):
+    """the author, genre and language names are shown on the pages of their books"""
+    if not created:
+        invalidate_fragments(BOOK_FRAGMENTS, instance.book_set.values_list('pk', flat=True))
+
+
+@receiver(post_delete, sender=Author)
+@receiver(post_delete, sender=Genre)
+@receiver(post_delete, sender=Language)
+def invalidate_unlinked_fragments(sender, instance, **kwargs):
+    # remembered by remember_unlinked_books
+    invalidate_fragments(BOOK_FRAGMENTS, getattr(instance, '_search_book_ids', []))
+
+
+@receiver(post_save, sender=Genre)
+@receiver(post_delete, sender=Genre)
+@receiver(post_save, sender=Language)
+@receiver(post_delete, sender=Language)
+def invalidate_catalog_pages(sender, **kwargs):
+    """the genres and the languages are the facets of the book list"""
+    invalidate_catalog_version()
+
+
+@receiver(post_save, sender=Book)
+def autocomplete_saved_book(sender, instance, **kwargs):
+    entry = book_entry(instance.pk, instance.title)
+    transaction.on_commit(lambda: catalog_autocomplete.update(entry))
+
+
+@receiver(post_save, sender=Author)
+def autocomplete_saved_author(sender, instance, **kwargs):
+    entry = author_entry(instance.pk, instance.first_name, instance.last_name)
+    transaction.on_commit(lambda: catalog_autocomplete.update(entry))
+
+
+@receiver(post_delete, sender=Book)
+@receiver(post_delete, sender=Author)
+def autocomplete_deleted(sender, instance, **kwargs):
+    ref = pack(BOOK if sender is Book else AUTHOR, instance.pk)
+    transaction.on_commit(lambda: catalog_autocomplete.remove(ref))
+
+
+@receiver(post_save, sender=Book)
+def facet_saved_book(sender, instance, created, **kwargs):
+    deltas = Counter()
+    if created:
+        deltas[FacetCount.LANGUAGE, instance.language_id] += 1
+        initials = author_initials([instance.author_id])
+        deltas[FacetCount.INITIAL, initials.get(instance.author_id)] += 1
+    elif hasattr(instance, '_loaded_language_id'):
+        if instance._loaded_language_id != instance.language_id:
+            deltas[FacetCount.LANGUAGE, instance._loaded_language_id] -= 1
+            deltas[FacetCount.LANGUAGE, instance.language_id] += 1
+        if instance._loaded_author_id != instance.author_id:
+            initials = author_initials([instance._loaded_author_id, instance.author_id])
+            deltas[FacetCount.INITIAL, initials.get(instance._loaded_author_id)] -= 1
+            deltas[FacetCount.INITIAL, initials.get(instance.author_id)] += 1
+    update_facet_counts(deltas)
+    instance._loaded_language_id = instance.language_id
+    instance._loaded_author_id = instance.author_id
+
+
+@receiver(pre_delete, sender=Book)
+def remember_book_facets(sender, instance, **kwargs):
+    # the genre links and the author are gone by the time of post_delete
+    instance._facet_genre_ids = list(instance.genre.values_list('pk', flat=True))
+    instance._facet_initial = author_initials([instance.author_id]).get(instance.author_id)
+
+
+@receiver(post_delete, sender=Book)
+def facet_deleted_book(sender, instance, **kwargs):
+    deltas = Counter()
+    deltas[FacetCount.LANGUAGE, instance.language_id] -= 1
+    deltas[FacetCount.INITIAL, getattr(instance, '_facet_initial', None)] -= 1
+    for genre_id in getattr(instance, '_facet_genre_ids', ()):
+        deltas[FacetCount.GENRE, genre_id] -= 1
+    update_facet_counts(deltas)
+
+
+@receiver(m2m_changed, sender=Book.genre.through)
+def facet_book_genres(sender, instance, action, reverse, pk_set, **kwargs):
+    if action in ('pre_remove', 'pre_clear'):
+        # only the links that really exist are going to be removed
+        links = sender.objects.filter(**{'genre_id' if reverse else 'book_id': instance.pk})
+        if pk_set is not None:
+            links = links.filter(**{'book_id__in' if reverse else 'genre_id__in': pk_set})
+        instance._facet_unlinked = Counter(links.values_list('genre_id', flat=True))
+    elif action == 'post_add':
+        if reverse:
+            update_facet_counts(Counter({(FacetCount.GENRE, instance.pk): len(pk_set)}))
+        else:
+            update_facet_counts(Counter({(FacetCount.GENRE, pk): 1 for pk in pk_set}))
+    elif action in ('post_remove', 'post_clear'):
+        unlinked = getattr(instance, '_facet_unlinked', Counter())
+        update_facet_counts(Counter({
+            (FacetCount.GENRE, genre_id): -count for genre_id, count in unlinked.items()
+        }))
+
+
+@receiver(post_save, sender=Author)
+def facet_renamed_author(sender, instance, created, **kwargs):
+    old_initial = author_initial(getattr(instance, '_loaded_last_name', None))
+    new_initial = author_initial(instance.last_name)
+    if not created and hasattr(instance, '_loaded_last_name') and old_initial != new_initial:
+        books = instance.book_set.count()
+        update_facet_counts(Counter({
+            (FacetCount.INITIAL, old_initial): -books,
+            (FacetCount.INITIAL, new_initial): books,
+        }))
+    instance._loaded_last_name = instance.last_name
+
+
+@receiver(pre_delete, sender=Author)
+def remember_author_books(sender, instance, **kwargs):
+    instance._facet_books = instance.book_set.count()
+
+
+@receiver(post_delete, sender=Author)
+def facet_deleted_author(sender, instance, **kwargs):
+    update_facet_counts(Counter({
+        (FacetCount.INITIAL, author_initial(instance.last_name)): -getattr(instance, '_facet_books', 0),
+    }))
+
+
+@receiver(post_delete, sender=Genre)
+def facet_deleted_genre(sender, instance, **kwargs):
+    delete_facet(FacetCount.GENRE, instance.pk)
+
+
+@receiver(post_delete, sender=Language)
+def facet_deleted_language(sender, instance, **kwargs):
+    delete_facet(FacetCount.LANGUAGE, instance.pk)
@@ -0,0 +1,133 @@
+"""
+The similar books, computed offline by compute_similar_books.
+
+Every book is a sparse row of features, one block per kind: its genres,
+its author, its language and the readers who borrowed it (the checkouts
+of the loan history). The rows of each block are L2-normalized and scaled
+by the square root of the block weight, so the dot product of two books is
+the weighted mean of the cosine similarities of the blocks. The products
+are computed with SciPy, a batch of rows against the whole matrix at a
+time, and NumPy picks the top neighbours of the batch in one argpartition.
+The results go to the SimilarBook table, the detail page reads the
+neighbours of a book in one indexed query.
+
+NumPy and SciPy are pinned in requirements.txt, only this module imports
+them, lazily, so the site runs without them.
+"""
+from django.db import transaction
+
+from .fragments import invalidate_all_fragments
+from .models import Book, LoanEvent, SimilarBook
+
+# the feature block -> its weight in the similarity
+WEIGHTS = {
+    'genre': 1.0,
+    'author': 1.0,
+    'language': 0.5,
+    'readers': 1.5,
+}
+
+NEIGHBOURS = 10
+
+# the most similarity cells a batch holds in memory, 8 bytes each
+BATCH_CELLS = 10_000_000
+
+INSERT_BATCH_SIZE = 2000
+
+
+def feature_pairs():
+    """the block -> the (book id, feature) pairs of the block"""
+    return {
+        'genre': Book.genre.through.objects.values_list('book_id', 'genre_id'),
+        'author': Book.objects.filter(author__isnull=False).values_list('pk', 'author_id'),
+        'language': Book.objects.filter(language__isnull=False).values_list('pk', 'language_id'),
+        'readers': (
+            LoanEvent.objects.filter(kind=LoanEvent.CHECKOUT, book__isnull=False, borrower__isnull=False)
+            .values_list('book_id', 'borrower_id').order_by().distinct()
+        ),
+    }
+
+
+def feature_matrix(book_ids, pairs, weights=WEIGHTS):
+    """The (books x features) CSR matrix, the blocks weighted and normalized."""
+    import numpy as np
+    from scipy import sparse
+
+    row_of = {pk: row for row, pk in enumerate(book_ids)}
+    total = sum(weights.values())
+    blocks = []
+    for name, weight in weights.items():
+        books, features = [], []
+        for book_id, feature in pairs[name]:
+            if book_id in row_of:
+                books.append(row_of[book_id])
+                features.append(feature)
+        columns, codes = np.unique(np.asarray(features, dtype=np.int64), return_inverse=True)
+        block = sparse.csr_matrix(
+            (np.ones(len(books)), (np.asarray(books, dtype=np.int64), codes.reshape(-1))),
+            shape=(len(book_ids), len(columns)),
+        )
+        # duplicated pairs count once
+        block.data[:] = 1
+        norms = np.sqrt(np.asarray(block.multiply(block).sum(axis=1)).ravel())
+        norms[norms == 0] = 1
+        blocks.append(sparse.diags(np.sqrt(weight / total) / norms) @ block)
+    return sparse.hstack(blocks, format='csr')
+
+
+def nearest(matrix, neighbours=NEIGHBOURS, batch_size=None):
+    """
+    Yields (row, [(neighbour row, score)]) with the best neighbours first,
+    the books without any shared feature are left out.
+    """
+    import numpy as np
+
+    count = matrix.shape[0]
+    neighbours = min(neighbours, count - 1)
+    if neighbours <= 0:
+        return
+    batch_size = batch_size or max(1, min(count, BATCH_CELLS // count))
+    transposed = matrix.T.tocsc()
+    for start in range(0, count, batch_size):
+        stop = min(start + batch_size, count)
+        scores = (matrix[start:stop] @ transposed).toarray()
+        # a book is not its own neighbour
+        scores[np.arange(stop - start), np.arange(start, stop)] = 0
+        top = np.argpartition(-scores, neighbours - 1, axis=1)[:, :neighbours]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1, kind='stable')
+        top = np.take_along_axis(top, order, axis=1)
+        top_scores = np.take_along_axis(top_scores, order, axis=1)
+        for offset in range(stop - start):
+            found = [
+                (int(column), float(score))
+                for column, score in zip(top[offset], top_scores[offset]) if score > 0
+            ]
+            if found:
+                yield start + offset, found
+
+
+def compute_similar_books(neighbours=NEIGHBOURS, batch_size=None):
+    """Refills the SimilarBook table, returns the number of the rows."""
+    book_ids = list(Book.objects.order_by('pk').values_list('pk', flat=True))
+    if not book_ids:
+        return 0
+    matrix = feature_matrix(book_ids, feature_pairs())
+
+    stored = 0
+    rows = []
+    with transaction.atomic():
+        SimilarBook.objects.all().delete()
+        for row, found in nearest(matrix, neighbours, batch_size):
+            rows.extend(
+                SimilarBook(book_id=book_ids[row], similar_id=book_ids[column], rank=rank, score=score)
+                for rank, (column, score) in enumerate(found, 1)
+            )
+            if len(rows) >= INSERT_BATCH_SIZE:
+                SimilarBook.objects.bulk_create(rows)
+                stored += len(rows)
+                rows = []
+        SimilarBook.objects.bulk_create(rows)
+        # the similar books are a part of the cached book pages
+        invalidate_all_fragments()
+    return stored + len(rows)
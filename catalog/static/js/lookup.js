@@ -0,0 +1,74 @@
+// The selects with a data-lookup-url get a search box: the options are
+// fetched from the JSON lookup as the user types, a page at a time. The
+// chosen options stay, the others are replaced by every new search.
+(function () {
+  'use strict';
+
+  function attach(select) {
+    var search = document.createElement('input');
+    var more = document.createElement('button');
+    var query = '';
+    var page = 1;
+    var timer = null;
+
+    search.type = 'search';
+    search.placeholder = 'Type to search';
+    more.type = 'button';
+    more.textContent = 'More';
+    more.hidden = true;
+    select.parentNode.insertBefore(search, select);
+    select.parentNode.insertBefore(more, select.nextSibling);
+    if (select.multiple) {
+      select.size = 8;
+    }
+
+    function load(append) {
+      var url = select.dataset.lookupUrl + '?q=' + encodeURIComponent(query) + '&page=' + page;
+      fetch(url, {credentials: 'same-origin'})
+        .then(function (response) { return response.json(); })
+        .then(function (data) {
+          if (!append) {
+            Array.prototype.slice.call(select.options).forEach(function (option) {
+              if (!option.selected && option.value !== '') {
+                option.remove();
+              }
+            });
+          }
+          var present = {};
+          Array.prototype.forEach.call(select.options, function (option) {
+            present[option.value] = true;
+          });
+          data.results.forEach(function (result) {
+            if (!present[result.id]) {
+              select.add(new Option(result.text, result.id));
+            }
+          });
+          more.hidden = !data.more;
+        });
+    }
+
+    search.addEventListener('input', function () {
+      clearTimeout(timer);
+      timer = setTimeout(function () {
+        query = search.value;
+        page = 1;
+        load(false);
+      }, 250);
+    });
+    more.addEventListener('click', function () {
+      page += 1;
+      load(true);
+    });
+    // the first page, so the select is usable before any typing
+    search.addEventListener('focus', function () {
+      if (page === 1 && !query && !search.dataset.loaded) {
+        search.dataset.loaded = 'yes';
+        load(false);
+      }
+    });
+  }
+
+  document.addEventListener('DOMContentLoaded', function () {
+    Array.prototype.forEach.call(document.querySelectorAll('select[data-lookup-url]'), attach);
+  });
+})();
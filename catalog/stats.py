@@ -0,0 +1,106 @@
+from django.core.cache import cache
+from django.db import IntegrityError, connection, transaction
+from django.db.models import F
+
+from .computed import get_or_compute
+from .models import Author, Book, BookInstance, CatalogStats, Genre
+
+# the key under which the homepage counters live in the shared cache
+STATS_CACHE_KEY = 'catalog:stats'
+# signals drop the key on every change, the timeout is only a safety net
+# for the writes that bypass the signals (queryset.update(), bulk_create())
+STATS_CACHE_TIMEOUT = 60
+
+# the only row of the CatalogStats table
+STATS_PK = 1
+
+
+def stats_querysets():
+    """The querysets behind the homepage counters, by the context name."""
+    return {
+        'num_books': Book.objects.all(),
+        'num_instances': BookInstance.objects.all(),
+        'num_instances_available': BookInstance.objects.filter(status__exact='a'),
+        'num_authors': Author.objects.all(),
+        'num_genres': Genre.objects.all(),
+        'num_books_with_and': Book.objects.filter(title__contains='and'),
+    }
+
+
+def title_has_and(title):
+    """
+    Python twin of the title__contains='and' lookup.
+    SQLite LIKE ignores the case of ASCII letters, so mirror it there.
+    """
+    if not title:
+        return False
+    if connection.vendor == 'sqlite':
+        return 'and' in title.lower()
+    return 'and' in title
+
+
+def count_catalog_stats():
+    """
+    Recount everything in a single round-trip:
+    SELECT (SELECT COUNT(*) FROM (...)), (SELECT COUNT(*) FROM (...)), ...
+    The inner queries are compiled by the ORM, so the lookups keep
+    the same semantics as the .count() calls they replace.
+    This is a full scan, keep it away from the request path.
+    """
+    querysets = stats_querysets()
+    columns, params = [], []
+    for name, queryset in querysets.items():
+        sql, query_params = queryset.order_by().values('pk').query.sql_with_params()
+        columns.append('(SELECT COUNT(*) FROM ({}) counted) AS {}'.format(
+            sql, connection.ops.quote_name(name)
+        ))
+        params.extend(query_params)
+
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT ' + ', '.join(columns), params)
+        row = cursor.fetchone()
+    return dict(zip(querysets, row))
+
+
+def _create_stats_row():
+    """Creates the counters row from a full recount, once per database."""
+    try:
+        with transaction.atomic():
+            return CatalogStats.objects.create(pk=STATS_PK, **count_catalog_stats()), True
+    except IntegrityError:
+        # somebody else has just created it
+        return CatalogStats.objects.get(pk=STATS_PK), False
+
+
+def update_catalog_stats(**deltas):
+    """
+    Applies the deltas to the counters in O(1): one UPDATE ... SET x = x + 1,
+    so the concurrent writers never lose each other's increments.
+    """
+    deltas = {name: delta for name, delta in deltas.items() if delta}
+    if not deltas:
+        return
+    updated = CatalogStats.objects.filter(pk=STATS_PK).update(
+        **{name: F(name) + delta for name, delta in deltas.items()}
+    )
+    if not updated:
+        _, created = _create_stats_row()
+        if not created:
+            update_catalog_stats(**deltas)
+
+
+def read_catalog_stats():
+    """Reads the counters row by its primary key."""
+    stats = CatalogStats.objects.filter(pk=STATS_PK).first()
+    if stats is None:
+        stats, _ = _create_stats_row()
+    return stats.as_dict()
+
+
+def get_catalog_stats():
+    """Returns the homepage counters, from the cache when it is warm."""
+    return get_or_compute(STATS_CACHE_KEY, read_catalog_stats, STATS_CACHE_TIMEOUT)
+
+
+def invalidate_catalog_stats():
+    cache.delete(STATS_CACHE_KEY)
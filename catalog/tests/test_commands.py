@@ -0,0 +1,356 @@
+import csv
+import datetime
+import gzip
+import importlib.util
+import io
+import json
+import os
+import tempfile
+import unittest
+from io import StringIO
+
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import F
+from django.test import TestCase
+from django.urls import reverse
+
+from ..loans import checkout, reserve
+from ..management.commands.seed_data import isbn13
+from ..models import (
+    Author, Book, BookInstance, CatalogStats, Genre, Language, LoanEvent, ReminderLog, Reservation, SimilarBook,
+)
+
+
+class ReconcileCatalogStatsCommandTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        author = Author.objects.create(first_name='John', last_name='Smith')
+        Book.objects.create(title='Sand and Stone', isbn='1', author=author)
+
+    def test_reports_no_drift_for_correct_counters(self):
+        out = StringIO()
+        call_command('reconcile_catalog_stats', stdout=out)
+        self.assertIn('no drift', out.getvalue())
+
+    def test_fixes_the_drift(self):
+        # bulk writes bypass the signals, emulate it
+        CatalogStats.objects.update(num_books=42, num_authors=0)
+
+        out = StringIO()
+        call_command('reconcile_catalog_stats', '--dry-run', stdout=out)
+        self.assertIn('num_books: stored 42, counted 1 (-41)', out.getvalue())
+        self.assertEqual(CatalogStats.objects.get().num_books, 42)
+
+        call_command('reconcile_catalog_stats', stdout=StringIO())
+        stats = CatalogStats.objects.get()
+        self.assertEqual(stats.num_books, 1)
+        self.assertEqual(stats.num_authors, 1)
+
+    def test_repairs_the_book_copies(self):
+        book = Book.objects.get()
+        BookInstance.objects.bulk_create([
+            BookInstance(book=book, imprint='Ace', status=status) for status in ('a', 'a', 'o', 'm')
+        ])
+
+        out = StringIO()
+        call_command('reconcile_catalog_stats', stdout=out)
+        self.assertIn(f'book {book.pk}: copies_total: stored 0, counted 4', out.getvalue())
+        self.assertEqual(Book.objects.values_list(*Book.COPIES).get(), (4, 2, 1))
+
+
+class SeedDataCommandTest(TestCase):
+    def seed(self, *args):
+        call_command(
+            'seed_data', '-na', '5', '-ng', '3', '-nl', '2', '-nb', '30', '-nbi', '40',
+            '--batch-size', '7', '--workers', '1', *args, stdout=StringIO(),
+        )
+
+    def test_seeds_the_requested_numbers(self):
+        self.seed()
+        self.assertEqual(Author.objects.count(), 5)
+        self.assertEqual(Genre.objects.count(), 3)
+        self.assertEqual(Language.objects.count(), 2)
+        self.assertEqual(Book.objects.count(), 30)
+        self.assertEqual(BookInstance.objects.count(), 40)
+        self.assertEqual(Book.genre.through.objects.count(), 30)
+        # the bulk inserts bypass the signals, the counters are recounted
+        self.assertEqual(CatalogStats.objects.get().num_instances, 40)
+
+    def test_seed_makes_the_output_reproducible(self):
+        self.seed('--seed', '7')
+        first = list(Book.objects.order_by('isbn').values_list('isbn', 'title', 'author__last_name'))
+        self.seed('--mode', 'refresh', '--seed', '7')
+        second = list(Book.objects.order_by('isbn').values_list('isbn', 'title', 'author__last_name'))
+        self.assertEqual(first, second)
+        self.assertEqual(Book.objects.count(), 30)
+
+    def test_seeding_again_adds_new_isbns(self):
+        self.seed('--seed', '7')
+        unlent = Book.objects.filter(bookinstance__isnull=True).order_by('-pk').values_list('pk', flat=True)
+        Book.objects.filter(pk__in=list(unlent[:5])).delete()
+        imported = Book.objects.create(title='Imported', isbn=isbn13(40))
+
+        out = StringIO()
+        call_command(
+            'seed_data', '-nb', '30', '--batch-size', '7', '--workers', '1', '--seed', '7', stdout=out,
+        )
+        self.assertIn('books: 30/30', out.getvalue())
+        self.assertNotIn('skipped', out.getvalue())
+        self.assertEqual(Book.objects.count(), 56)
+        # the genres are linked to the new books only
+        self.assertFalse(imported.genre.exists())
+        self.assertEqual(Book.genre.through.objects.count(), 55)
+
+    def test_refresh_deletes_the_holds_and_the_history(self):
+        self.seed('--seed', '7')
+        book = Book.objects.filter(copies_available__gt=0).first()
+        reader = User.objects.create_user(username='reader', password='1X<ISRUkw+tuK')
+        checkout(book.pk, reader)
+        reserve(Book.objects.exclude(pk=book.pk).first().pk, reader)
+
+        self.seed('--mode', 'refresh', '--seed', '7')
+        self.assertFalse(Reservation.objects.exists())
+        self.assertFalse(LoanEvent.objects.exists())
+        # the foreign keys are deferred in the test transaction, check them now
+        connection.check_constraints()
+
+
+class ExportCatalogCommandTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        author = Author.objects.create(first_name='Frank', last_name='Herbert')
+        genre = Genre.objects.create(name='Science Fiction')
+        for number in range(3):
+            book = Book.objects.create(
+                title=f'Dune {number}', summary='Desert, "spice"', isbn=f'978000000000{number}', author=author,
+            )
+            book.genre.add(genre)
+
+    def export(self, *args):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'export')
+            call_command('export_catalog', *args, '--output', path, '--chunk-size', '2')
+            with open(path, 'rb') as output:
+                return output.read()
+
+    def test_exports_csv_with_a_header(self):
+        rows = list(csv.reader(io.StringIO(self.export('books').decode())))
+        self.assertEqual(rows[0], ['id', 'title', 'author_id', 'summary', 'isbn', 'language_id'])
+        self.assertEqual([row[1] for row in rows[1:]], ['Dune 0', 'Dune 1', 'Dune 2'])
+        self.assertEqual(rows[1][3], 'Desert, "spice"')
+
+    def test_exports_gzipped_jsonl(self):
+        lines = gzip.decompress(self.export('book_genres', '--format', 'jsonl', '--gzip')).splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(set(json.loads(lines[0])), {'book_id', 'genre_id'})
+
+
+class ImportCatalogCommandTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def write(self, name, content):
+        path = os.path.join(self.directory.name, name)
+        opener = gzip.open if name.endswith('.gz') else open
+        with opener(path, 'wt', encoding='utf-8') as output:
+            output.write(content)
+        return path
+
+    def run_import(self, path, *args):
+        out = StringIO()
+        call_command('import_catalog', path, '--chunk-size', '2', *args, stdout=out)
+        return out.getvalue()
+
+    def test_imports_csv(self):
+        Genre.objects.create(name='Science Fiction')
+        path = self.write('books.csv', (
+            'isbn,title,summary,author,genres,language\n'
+            '978-0-441-17271-9,Dune,Spice,"Herbert, Frank",science fiction|Classics,English\n'
+            '9780441013593,Dune Messiah,,Frank Herbert,Science Fiction,English\n'
+            'not-an-isbn,Broken,,,,\n'
+        ))
+        output = self.run_import(path)
+
+        self.assertEqual(Book.objects.count(), 2)
+        self.assertEqual(Author.objects.count(), 1)
+        self.assertEqual(Genre.objects.count(), 2)
+        self.assertEqual(Language.objects.count(), 1)
+        dune = Book.objects.get(isbn='9780441172719')
+        self.assertEqual(str(dune.author), 'Herbert, Frank')
+        self.assertEqual(sorted(dune.genre.values_list('name', flat=True)), ['Classics', 'Science Fiction'])
+        self.assertIn('created 2', output)
+        self.assertIn('invalid 1', output)
+        self.assertEqual(CatalogStats.objects.get().num_books, 2)
+        self.assertFalse(os.path.exists(path + '.checkpoint'))
+
+    def test_skips_or_updates_the_existing_isbns(self):
+        Book.objects.create(title='Old', summary='', isbn='9780441172719')
+        path = self.write('books.jsonl.gz', (
+            '{"isbn": "9780441172719", "title": "Dune", "genres": ["Science Fiction"]}\n'
+            '{"isbn": "9780441172719", "title": "Dune (duplicate)"}\n'
+        ))
+        self.run_import(path)
+        self.assertEqual(Book.objects.get().title, 'Old')
+
+        self.run_import(path, '--update')
+        book = Book.objects.get()
+        self.assertEqual(book.title, 'Dune (duplicate)')
+        self.assertFalse(book.genre.exists())
+
+    def test_jsonl_values_keep_their_json_types(self):
+        path = self.write('books.jsonl', (
+            '{"isbn": 9780441013593, "title": "Dune Messiah", "author_last_name": "Herbert", "genres": [1984]}\n'
+            '{"isbn": "9780441172719", "title": 1984, "language": null}\n'
+            '["not", "an", "object"]\n'
+            '{broken\n'
+        ))
+        output = self.run_import(path)
+
+        self.assertEqual(Book.objects.get(isbn='9780441013593').author.last_name, 'Herbert')
+        self.assertEqual(Book.objects.get(isbn='9780441172719').title, '1984')
+        self.assertEqual(list(Genre.objects.values_list('name', flat=True)), ['1984'])
+        self.assertIn('created 2', output)
+        self.assertIn('invalid 2', output)
+
+    def test_imports_marc(self):
+        path = self.write('books.mrk', (
+            '=LDR  00000nam  2200000   4500\n'
+            '=020  \\\\$a9780441172719 (pbk.)\n'
+            '=100  1\\$aHerbert, Frank,\n'
+            '=245  10$aDune /$cFrank Herbert.\n'
+            '=520  \\\\$aSpice.\n'
+            '=546  \\\\$aEnglish.\n'
+            '=650  \\0$aScience fiction.\n'
+            '\n'
+            '=LDR  00000nam  2200000   4500\n'
+            '=020  \\\\$a9780441013593\n'
+            '=245  10$aDune messiah\n'
+        ))
+        self.run_import(path)
+        dune = Book.objects.get(isbn='9780441172719')
+        self.assertEqual(dune.title, 'Dune')
+        self.assertEqual(dune.language.name, 'English')
+        self.assertEqual(dune.author.first_name, 'Frank')
+        self.assertEqual(list(dune.genre.values_list('name', flat=True)), ['Science fiction'])
+        self.assertIsNone(Book.objects.get(isbn='9780441013593').author)
+
+    def test_resumes_from_the_checkpoint(self):
+        path = self.write('books.jsonl', ''.join(
+            f'{{"isbn": "97800000000{number:02d}", "title": "Book {number}"}}\n' for number in range(6)
+        ))
+        with open(path + '.checkpoint', 'w') as checkpoint:
+            json.dump({'position': 4, 'totals': {'created': 4}}, checkpoint)
+
+        output = self.run_import(path)
+
+        self.assertEqual(sorted(Book.objects.values_list('title', flat=True)), ['Book 4', 'Book 5'])
+        self.assertIn('resuming after record 4', output)
+        self.assertIn('created 6', output)
+
+
+class OverdueReportCommandTest(TestCase):
+    def test_reports_the_buckets(self):
+        book = Book.objects.create(title='Dune', summary='', isbn='9780441172719')
+        BookInstance.objects.create(book=book, imprint='Ace', status='o', due_back=datetime.date(2024, 1, 1))
+
+        out = StringIO()
+        call_command('overdue_report', '--today', '2024-01-11', stdout=out)
+        self.assertIn('1 overdue loan(s) on 2024-01-11', out.getvalue())
+        self.assertRegex(out.getvalue(), r'8-14 days\s+1\s+0\s+10')
+
+
+class SendRemindersCommandTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.today = datetime.date(2024, 3, 1)
+        book = Book.objects.create(title='Dune', summary='', isbn='9780441172719')
+        messiah = Book.objects.create(title='Dune Messiah', summary='', isbn='9780441013593')
+        alice = User.objects.create_user(username='alice', email='alice@example.com', first_name='Alice')
+        bob = User.objects.create_user(username='bob', email='bob@example.com')
+        nobody = User.objects.create_user(username='nobody')
+        for title, borrower, days in (
+            (book, alice, 1), (messiah, alice, 1), (book, alice, -5), (messiah, bob, -1), (book, nobody, -1),
+        ):
+            BookInstance.objects.create(
+                book=title, imprint='Ace', status='o', borrower=borrower,
+                due_back=cls.today + datetime.timedelta(days=days),
+            )
+
+    def send(self):
+        out = StringIO()
+        call_command('send_reminders', '--today', self.today.isoformat(), '--batch-size', '1', stdout=out)
+        return out.getvalue()
+
+    def test_sends_one_message_per_reader_and_kind(self):
+        output = self.send()
+
+        self.assertIn('Due tomorrow: 1 message(s) sent', output)
+        self.assertIn('Overdue: 2 message(s) sent', output)
+        due = next(message for message in mail.outbox if message.subject.endswith('tomorrow'))
+        self.assertEqual(due.to, ['alice@example.com'])
+        self.assertIn('Dear Alice', due.body)
+        self.assertIn('- Dune\n', due.body)
+        self.assertIn('- Dune Messiah', due.body)
+        self.assertEqual(
+            sorted(message.to[0] for message in mail.outbox if message.subject.endswith('overdue')),
+            ['alice@example.com', 'bob@example.com'],
+        )
+        self.assertEqual(ReminderLog.objects.get(kind=ReminderLog.DUE).loans, 2)
+
+    def test_rerun_is_idempotent(self):
+        self.send()
+        mail.outbox.clear()
+
+        output = self.send()
+        self.assertEqual(mail.outbox, [])
+        self.assertIn('Overdue: 0 message(s) sent', output)
+
+
+@unittest.skipUnless(
+    all(importlib.util.find_spec(name) for name in ('numpy', 'scipy')), 'numpy and scipy are not installed'
+)
+class ComputeSimilarBooksCommandTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        herbert = Author.objects.create(first_name='Frank', last_name='Herbert')
+        austen = Author.objects.create(first_name='Jane', last_name='Austen')
+        science_fiction = Genre.objects.create(name='Science Fiction')
+        romance = Genre.objects.create(name='Romance')
+        cls.dune = Book.objects.create(title='Dune', summary='', isbn='1', author=herbert)
+        cls.messiah = Book.objects.create(title='Dune Messiah', summary='', isbn='2', author=herbert)
+        cls.foundation = Book.objects.create(title='Foundation', summary='', isbn='3')
+        cls.emma = Book.objects.create(title='Emma', summary='', isbn='4', author=austen)
+        cls.lonely = Book.objects.create(title='Lonely', summary='', isbn='5')
+        for book in (cls.dune, cls.messiah, cls.foundation):
+            book.genre.add(science_fiction)
+        cls.emma.genre.add(romance)
+        # a reader of Dune has borrowed Emma too
+        reader = User.objects.create_user(username='reader', password='1X<ISRUkw+tuK')
+        for book in (cls.dune, cls.emma):
+            LoanEvent.objects.create(kind=LoanEvent.CHECKOUT, book=book, borrower=reader)
+
+    def test_neighbours_by_shared_features(self):
+        out = StringIO()
+        call_command('compute_similar_books', neighbours=3, batch_size=2, stdout=out)
+
+        self.assertIn('similar book(s) stored', out.getvalue())
+        # the genre and the author, then the reader (weighs more than a genre), then the genre
+        self.assertEqual(
+            list(SimilarBook.objects.filter(book=self.dune).values_list('similar__title', flat=True)),
+            ['Dune Messiah', 'Emma', 'Foundation'],
+        )
+        scores = list(SimilarBook.objects.filter(book=self.dune).values_list('score', flat=True))
+        self.assertEqual(scores, sorted(scores, reverse=True))
+        self.assertFalse(SimilarBook.objects.filter(book=self.lonely).exists())
+        self.assertFalse(SimilarBook.objects.filter(book=F('similar')).exists())
+
+    def test_detail_page_shows_the_neighbours(self):
+        call_command('compute_similar_books', stdout=StringIO())
+
+        response = self.client.get(reverse('book-detail', args=[self.dune.pk]))
+        self.assertContains(response, 'Similar books')
+        self.assertContains(response, 'Dune Messiah')
@@ -0,0 +1,418 @@
+import datetime
+import gzip
+import json
+import os
+import tempfile
+from io import StringIO
+
+from django.contrib.auth.models import Permission, User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import TestCase
+from django.urls import reverse
+from django.utils import timezone
+
+from ..loans import (
+    HOLD_PERIOD, LoanError, NoCopyAvailable, cancel_reservation, checkout, expire_reservations, renew, reserve,
+    return_copy,
+)
+from ..history import MonthArchived, month_start, rollup_month
+from ..models import (
+    Book, BookCirculation, BookInstance, BookLoanDay, BookPopularity, BorrowerCirculation, CatalogStats, Genre,
+    LoanEvent, Reservation,
+)
+from ..popularity import count_loan, get_popular_books, rebuild_loan_days, top_books, update_popular_books
+from ..reports import circulation_report
+
+
+class LoanServiceTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.reader = User.objects.create_user(username='reader', password='1X<ISRUkw+tuK')
+        cls.book = Book.objects.create(title='Dune', summary='', isbn='9780441172719')
+        cls.copies = [
+            BookInstance.objects.create(book=cls.book, imprint='Ace', status='a') for _ in range(2)
+        ]
+
+    def test_checkout_lends_every_copy_once(self):
+        lent = {checkout(self.book.pk, self.reader), checkout(self.book.pk, self.reader)}
+
+        self.assertEqual(lent, {copy.pk for copy in self.copies})
+        with self.assertRaises(NoCopyAvailable):
+            checkout(self.book.pk, self.reader)
+        copy = BookInstance.objects.get(pk=lent.pop())
+        self.assertEqual((copy.status, copy.borrower), ('o', self.reader))
+        self.assertEqual(copy.due_back, datetime.date.today() + datetime.timedelta(weeks=3))
+        self.assertEqual(CatalogStats.objects.get().num_instances_available, 0)
+        self.assertEqual(Book.objects.values_list(*Book.COPIES).get(), (2, 0, 2))
+
+    def test_return_only_once(self):
+        copy_id = checkout(self.book.pk, self.reader)
+        return_copy(copy_id)
+
+        with self.assertRaises(LoanError):
+            return_copy(copy_id)
+        copy = BookInstance.objects.get(pk=copy_id)
+        self.assertEqual((copy.status, copy.borrower, copy.due_back), ('a', None, None))
+        self.assertEqual(CatalogStats.objects.get().num_instances_available, 2)
+        self.assertEqual(Book.objects.values_list(*Book.COPIES).get(), (2, 2, 0))
+
+    def test_renew(self):
+        copy_id = checkout(self.book.pk, self.reader)
+        due_back = datetime.date.today() + datetime.timedelta(weeks=4)
+        renew(copy_id, due_back)
+        self.assertEqual(BookInstance.objects.get(pk=copy_id).due_back, due_back)
+
+        with self.assertRaises(LoanError):
+            renew(copy_id, due_back + datetime.timedelta(days=1))
+        with self.assertRaises(LoanError):
+            renew(self.copies[0].pk if self.copies[0].pk != copy_id else self.copies[1].pk, due_back)
+
+    def test_benchmark_finds_no_double_loans(self):
+        out = StringIO()
+        call_command('benchmark_loans', '--threads', '1', '--operations', '5', '--hold', '0', stdout=out)
+        self.assertIn('no double loans', out.getvalue())
+        self.assertFalse(Book.objects.filter(title='Loan benchmark').exists())
+        self.assertFalse(LoanEvent.objects.exists())
+
+
+class LoanViewsTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.librarian = User.objects.create_user(username='librarian', password='1X<ISRUkw+tuK')
+        cls.librarian.user_permissions.add(
+            *Permission.objects.filter(codename__in=['can_mark_returned', 'view_all_borrowed'])
+        )
+        cls.reader = User.objects.create_user(username='reader', password='1X<ISRUkw+tuK')
+        cls.book = Book.objects.create(title='Dune', summary='', isbn='9780441172719')
+        cls.copy = BookInstance.objects.create(book=cls.book, imprint='Ace', status='a')
+
+    def setUp(self):
+        self.client.login(username='librarian', password='1X<ISRUkw+tuK')
+
+    def test_checkout_requires_the_permission(self):
+        self.client.login(username='reader', password='1X<ISRUkw+tuK')
+        response = self.client.get(reverse('checkout-book-librarian', args=[self.book.pk]))
+        self.assertEqual(response.status_code, 403)
+
+    def test_checkout_and_return(self):
+        due_back = datetime.date.today() + datetime.timedelta(weeks=2)
+        response = self.client.post(
+            reverse('checkout-book-librarian', args=[self.book.pk]),
+            {'borrower': 'reader', 'due_back': due_back},
+        )
+        self.assertRedirects(response, reverse('all-borrowed'))
+        self.copy.refresh_from_db()
+        self.assertEqual((self.copy.status, self.copy.borrower, self.copy.due_back), ('o', self.reader, due_back))
+
+        response = self.client.post(reverse('return-book-librarian', args=[self.copy.pk]), follow=True)
+        self.assertContains(response, 'The copy is returned.')
+        self.copy.refresh_from_db()
+        self.assertEqual(self.copy.status, 'a')
+
+    def test_checkout_without_copies(self):
+        BookInstance.objects.filter(pk=self.copy.pk).update(status='m')
+        response = self.client.post(
+            reverse('checkout-book-librarian', args=[self.book.pk]),
+            {'borrower': 'reader', 'due_back': datetime.date.today()},
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'is available')
+
+    def test_return_needs_post(self):
+        response = self.client.get(reverse('return-book-librarian', args=[self.copy.pk]))
+        self.assertEqual(response.status_code, 405)
+
+
+class ReservationTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.readers = [
+            User.objects.create_user(username=f'reader{number}', password='1X<ISRUkw+tuK') for number in range(3)
+        ]
+        cls.book = Book.objects.create(title='Dune', summary='', isbn='9780441172719')
+        cls.copy = BookInstance.objects.create(book=cls.book, imprint='Ace', status='a')
+
+    def hold(self, pk):
+        return Reservation.objects.get(pk=pk)
+
+    def copies(self):
+        return Book.objects.values_list(*Book.COPIES).get(pk=self.book.pk)
+
+    def test_the_queue_is_served_first_come_first_served(self):
+        first, second, third = self.readers
+        checkout(self.book.pk, first)
+        second_hold = reserve(self.book.pk, second)
+        third_hold = reserve(self.book.pk, third)
+        self.assertEqual(self.hold(second_hold).state, Reservation.WAITING)
+
+        return_copy(self.copy.pk)
+        self.copy.refresh_from_db()
+        self.assertEqual((self.copy.status, self.copy.borrower), ('r', second))
+        self.assertEqual(self.hold(second_hold).state, Reservation.READY)
+        self.assertEqual(self.hold(third_hold).state, Reservation.WAITING)
+        self.assertEqual(self.copies(), (1, 0, 0))
+
+        # nobody else gets the copy set aside
+        with self.assertRaises(NoCopyAvailable):
+            checkout(self.book.pk, third)
+        self.assertEqual(checkout(self.book.pk, second), self.copy.pk)
+        self.assertEqual(self.hold(second_hold).state, Reservation.FULFILLED)
+        self.assertEqual(self.copies(), (1, 0, 1))
+
+    def test_a_copy_on_the_shelf_is_set_aside_at_once(self):
+        hold = reserve(self.book.pk, self.readers[0])
+        self.assertEqual(self.hold(hold).state, Reservation.READY)
+        self.assertEqual(self.copies(), (1, 0, 0))
+        with self.assertRaises(LoanError):
+            reserve(self.book.pk, self.readers[0])
+
+    def test_a_checkout_fulfils_the_waiting_hold(self):
+        first, second, _ = self.readers
+        reserve(self.book.pk, first)
+        hold = reserve(self.book.pk, second)
+        BookInstance.objects.create(book=self.book, imprint='Chilton', status='a')
+
+        copy_id = checkout(self.book.pk, second)
+        self.assertEqual(self.hold(hold).state, Reservation.FULFILLED)
+        with self.assertRaisesMessage(LoanError, f'reader1 already has the book {self.book.pk} on loan.'):
+            reserve(self.book.pk, second)
+        return_copy(copy_id)
+        # back on the shelf, nobody is waiting any more
+        self.assertEqual(self.copies(), (2, 1, 0))
+
+    def test_cancel_passes_the_copy_on(self):
+        first_hold = reserve(self.book.pk, self.readers[0])
+        second_hold = reserve(self.book.pk, self.readers[1])
+
+        cancel_reservation(first_hold, self.readers[0])
+        self.assertEqual(self.hold(first_hold).state, Reservation.CANCELLED)
+        self.assertEqual(self.hold(second_hold).state, Reservation.READY)
+        cancel_reservation(second_hold, self.readers[1])
+        self.assertEqual(self.copies(), (1, 1, 0))
+        with self.assertRaises(LoanError):
+            cancel_reservation(second_hold, self.readers[1])
+
+    def test_expired_holds_go_to_the_next_reader(self):
+        first_hold = reserve(self.book.pk, self.readers[0])
+        second_hold = reserve(self.book.pk, self.readers[1])
+
+        self.assertEqual(expire_reservations(), (0, 0))
+        expired, served = expire_reservations(now=timezone.now() + HOLD_PERIOD)
+
+        self.assertEqual((expired, served), (1, 1))
+        self.assertEqual(self.hold(first_hold).state, Reservation.EXPIRED)
+        self.assertEqual(self.hold(second_hold).state, Reservation.READY)
+        self.copy.refresh_from_db()
+        self.assertEqual((self.copy.status, self.copy.borrower), ('r', self.readers[1]))
+        self.assertEqual(self.copies(), (1, 0, 0))
+        self.assertEqual(CatalogStats.objects.get().num_instances_available, 0)
+
+    def test_expiry_handles_many_holds_in_bulk(self):
+        books = Book.objects.bulk_create([
+            Book(title=f'Book {number}', summary='', isbn=f'97800000{number:05d}') for number in range(300)
+        ])
+        BookInstance.objects.bulk_create([BookInstance(book=book, imprint='Ace', status='r') for book in books])
+        copies = BookInstance.objects.filter(book__in=books)
+        expired = timezone.now() - datetime.timedelta(hours=1)
+        Reservation.objects.bulk_create(
+            [Reservation(book_id=copy.book_id, patron=self.readers[0], copy=copy, state=Reservation.READY,
+                         expires_at=expired) for copy in copies]
+            + [Reservation(book=book, patron=self.readers[1]) for book in books]
+        )
+
+        # a fixed number of statements, whatever the number of the holds
+        with self.assertNumQueries(12):
+            self.assertEqual(expire_reservations(), (300, 300))
+        self.assertEqual(
+            BookInstance.objects.filter(book__in=books, status='r', borrower=self.readers[1]).count(), 300
+        )
+        self.assertEqual(Reservation.objects.filter(state=Reservation.READY, patron=self.readers[1]).count(), 300)
+
+    def test_views(self):
+        self.client.login(username='reader0', password='1X<ISRUkw+tuK')
+        response = self.client.post(reverse('reserve-book', args=[self.book.pk]), follow=True)
+        self.assertContains(response, 'Ready for pickup')
+        hold = Reservation.objects.get()
+        # the reason of the refusal comes from the reservation service
+        response = self.client.post(reverse('reserve-book', args=[self.book.pk]), follow=True)
+        self.assertContains(response, f'reader0 already holds the book {self.book.pk}.')
+
+        response = self.client.post(reverse('cancel-reservation', args=[hold.pk]), follow=True)
+        self.assertContains(response, 'The hold is cancelled.')
+        self.assertEqual(self.hold(hold.pk).state, Reservation.CANCELLED)
+
+
+class LoanHistoryTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.reader = User.objects.create_user(username='reader', password='1X<ISRUkw+tuK')
+        cls.book = Book.objects.create(title='Dune', summary='', isbn='9780441172719')
+        cls.book.genre.add(Genre.objects.create(name='Science Fiction'))
+        cls.copy = BookInstance.objects.create(book=cls.book, imprint='Ace', status='a')
+
+    def circulate(self):
+        copy_id = checkout(self.book.pk, self.reader)
+        renew(copy_id, datetime.date.today() + datetime.timedelta(weeks=4))
+        return_copy(copy_id)
+        checkout(self.book.pk, self.reader)
+
+    def test_loan_service_logs_events(self):
+        self.circulate()
+
+        self.assertEqual(
+            list(LoanEvent.objects.order_by('pk').values_list('kind', 'copy_id', 'book_id', 'borrower_id')),
+            [(kind, self.copy.pk, self.book.pk, self.reader.pk) for kind in 'cnrc'],
+        )
+
+    def test_saving_a_copy_logs_events(self):
+        self.copy.status, self.copy.borrower = 'o', self.reader
+        self.copy.due_back = datetime.date.today()
+        self.copy.save()
+        copy = BookInstance.objects.get(pk=self.copy.pk)
+        copy.status, copy.borrower, copy.due_back = 'a', None, None
+        copy.save()
+
+        self.assertEqual(
+            list(LoanEvent.objects.order_by('pk').values_list('kind', 'borrower_id', 'due_back')),
+            [('c', self.reader.pk, datetime.date.today()), ('r', self.reader.pk, datetime.date.today())],
+        )
+
+    def test_rollup_and_report(self):
+        self.circulate()
+        month = month_start(timezone.localdate())
+
+        self.assertEqual(rollup_month(month), 4)
+        # a second rollup replaces the first
+        self.assertEqual(rollup_month(month), 4)
+        self.assertEqual(
+            list(BookCirculation.objects.values_list('month', 'book', 'checkouts', 'returns', 'renewals')),
+            [(month, self.book.pk, 2, 1, 1)],
+        )
+        self.assertEqual(list(BorrowerCirculation.objects.values_list('borrower', 'checkouts')), [(self.reader.pk, 2)])
+
+        # the report reads the rollups only
+        LoanEvent.objects.all().delete()
+        with self.assertNumQueries(4):
+            report = circulation_report(months=3)
+        self.assertEqual(report['total'], 2)
+        self.assertEqual(report['by_month'][0]['month'], month)
+        self.assertEqual(report['top_books'][0]['book__title'], 'Dune')
+        self.assertEqual(report['by_genre'], [{'book__genre__name': 'Science Fiction', 'checkouts': 2}])
+        self.assertEqual(report['top_borrowers'][0]['borrower__username'], 'reader')
+
+    def test_archive_moves_old_months_out(self):
+        self.circulate()
+        old = timezone.now() - datetime.timedelta(days=120)
+        LoanEvent.objects.filter(kind=LoanEvent.CHECKOUT).update(occurred_at=old)
+        old_month = month_start(timezone.localtime(old).date())
+
+        with tempfile.TemporaryDirectory() as directory:
+            out = StringIO()
+            call_command('archive_loan_events', keep_months=3, output_dir=directory, stdout=out)
+            with gzip.open(os.path.join(directory, f'loan-events-{old_month:%Y-%m}.jsonl.gz'), 'rt') as archive:
+                archived = [json.loads(line) for line in archive]
+
+        self.assertIn('2 archived', out.getvalue())
+        self.assertEqual([event['kind'] for event in archived], ['c', 'c'])
+        self.assertEqual(set(LoanEvent.objects.values_list('kind', flat=True)), {'n', 'r'})
+        self.assertEqual(BookCirculation.objects.get(month=old_month).checkouts, 2)
+
+    def test_rollup_keeps_the_archived_months(self):
+        self.circulate()
+        old = timezone.now() - datetime.timedelta(days=120)
+        LoanEvent.objects.filter(kind=LoanEvent.CHECKOUT).update(occurred_at=old)
+        old_month = month_start(timezone.localtime(old).date())
+        with tempfile.TemporaryDirectory() as directory:
+            call_command('archive_loan_events', keep_months=3, output_dir=directory, stdout=StringIO())
+
+        out = StringIO()
+        call_command('rollup_circulation', months=7, stdout=out)
+        self.assertIn(f'{old_month:%Y-%m}: archived', out.getvalue())
+        self.assertEqual(BookCirculation.objects.get(month=old_month).checkouts, 2)
+        self.assertEqual(circulation_report(months=7)['total'], 2)
+        with self.assertRaises(MonthArchived):
+            rollup_month(old_month)
+
+    def test_report_view(self):
+        self.circulate()
+        call_command('rollup_circulation', stdout=StringIO())
+        url = reverse('circulation-report')
+        self.client.force_login(self.reader)
+        self.assertEqual(self.client.get(url).status_code, 403)
+
+        self.reader.user_permissions.add(Permission.objects.get(codename='view_all_borrowed'))
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'Science Fiction')
+
+
+class PopularBooksTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.reader = User.objects.create_user(username='reader', password='1X<ISRUkw+tuK')
+        cls.dune = Book.objects.create(title='Dune', summary='', isbn='9780441172719')
+        cls.emma = Book.objects.create(title='Emma', summary='', isbn='9780141439587')
+        BookInstance.objects.create(book=cls.dune, imprint='Ace', status='a')
+
+    def setUp(self):
+        cache.clear()
+
+    def test_checkout_is_counted_in_every_window(self):
+        return_copy(checkout(self.dune.pk, self.reader))
+        checkout(self.dune.pk, self.reader)
+
+        self.assertEqual(BookLoanDay.objects.get().loans, 2)
+        self.assertEqual(
+            BookPopularity.objects.values_list('loans_week', 'loans_month', 'loans_year').get(book=self.dune),
+            (2, 2, 2),
+        )
+        with self.assertNumQueries(1):
+            self.assertEqual(top_books('week'), [(self.dune.pk, 'Dune', 2)])
+
+    def test_old_days_fall_out_of_the_windows(self):
+        today = timezone.localdate()
+        count_loan(self.dune.pk, today - datetime.timedelta(days=10))
+        count_loan(self.dune.pk, today - datetime.timedelta(days=400))
+        for _ in range(3):
+            count_loan(self.emma.pk, today)
+
+        self.assertEqual(update_popular_books(today), 2)
+        self.assertEqual(BookLoanDay.objects.count(), 2)
+        self.assertEqual(top_books('week'), [(self.emma.pk, 'Emma', 3)])
+        self.assertEqual(top_books('month'), [(self.emma.pk, 'Emma', 3), (self.dune.pk, 'Dune', 1)])
+
+    def test_update_keeps_the_rows_in_place(self):
+        today = timezone.localdate()
+        count_loan(self.dune.pk, today)
+        count_loan(self.emma.pk, today - datetime.timedelta(days=360))
+        self.assertEqual(update_popular_books(today), 2)
+        BookPopularity.objects.filter(book=self.dune).update(loans_year=7)
+
+        # ten days later: the rows are updated, the book without a bucket dropped
+        self.assertEqual(update_popular_books(today + datetime.timedelta(days=10)), 1)
+        self.assertEqual(
+            list(BookPopularity.objects.values_list('book', 'loans_week', 'loans_year')), [(self.dune.pk, 0, 1)],
+        )
+
+    def test_windows_start_off_from_the_history(self):
+        checkout(self.dune.pk, self.reader)
+        BookLoanDay.objects.all().delete()
+        BookPopularity.objects.all().delete()
+
+        rebuild_loan_days()
+        update_popular_books()
+        self.assertEqual(get_popular_books()['year'], [(self.dune.pk, 'Dune', 1)])
+
+    def test_pages_show_the_popular_books(self):
+        checkout(self.dune.pk, self.reader)
+
+        self.assertContains(self.client.get(reverse('index')), 'Popular books')
+        self.assertContains(self.client.get(reverse('books')), 'Popular this month')
+
+    def test_benchmark(self):
+        out = StringIO()
+        call_command('benchmark_popularity', books=20, events=200, stdout=out)
+
+        self.assertIn('µs per checkout', out.getvalue())
+        self.assertFalse(Book.objects.filter(title__startswith='Popularity benchmark').exists())
@@ -1,6 +1,9 @@
+import datetime
+
 from django.test import TestCase
-from django.db import models
-from ..models import Author, Book, Language
+from django.db import connection, models, transaction
+from ..models import Author, Book, BookInstance, CatalogStats, Genre, Language
+from ..pagination import KeysetPaginator
 
 
 class AuthorBooksModelTest(TestCase):
@@ -64,3 +67,169 @@ class AuthorBooksModelTest(TestCase):
             continue
             print(i_book.language)
             self.assertIsNotNone(i_book.language)
+
+
+class CatalogStatsModelTest(TestCase):
+    @staticmethod
+    def stats():
+        return CatalogStats.objects.get().as_dict()
+
+    def test_counters_follow_creation_and_deletion(self):
+        author = Author.objects.create(first_name='Big', last_name='Bob')
+        genre = Genre.objects.create(name='Fantasy')
+        book = Book.objects.create(title='Land and Sea', isbn='1', author=author)
+        self.assertEqual(
+            self.stats(),
+            {
+                'num_books': 1,
+                'num_instances': 0,
+                'num_instances_available': 0,
+                'num_authors': 1,
+                'num_genres': 1,
+                'num_books_with_and': 1,
+            }
+        )
+
+        book.delete()
+        genre.delete()
+        author.delete()
+        self.assertTrue(all(value == 0 for value in self.stats().values()))
+
+    def test_title_change_moves_the_and_counter(self):
+        book = Book.objects.create(title='Dune', isbn='1')
+        self.assertEqual(self.stats()['num_books_with_and'], 0)
+        book = Book.objects.get(pk=book.pk)
+        book.title = 'Dune and Sand'
+        book.save()
+        self.assertEqual(self.stats()['num_books_with_and'], 1)
+        # saving without a change doesn't count twice
+        book.save()
+        self.assertEqual(self.stats()['num_books_with_and'], 1)
+
+    def test_status_transitions_into_and_out_of_available(self):
+        book = Book.objects.create(title='Dune', isbn='1')
+        copy = BookInstance.objects.create(book=book, imprint='Imprint', status='m')
+        self.assertEqual(self.stats()['num_instances'], 1)
+        self.assertEqual(self.stats()['num_instances_available'], 0)
+
+        copy = BookInstance.objects.get(pk=copy.pk)
+        copy.status = 'a'
+        copy.save()
+        self.assertEqual(self.stats()['num_instances_available'], 1)
+
+        copy.status = 'o'
+        copy.save()
+        self.assertEqual(self.stats()['num_instances_available'], 0)
+
+        copy.status = 'a'
+        copy.save()
+        copy.delete()
+        self.assertEqual(self.stats()['num_instances'], 0)
+        self.assertEqual(self.stats()['num_instances_available'], 0)
+
+
+class BookCopiesModelTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.dune = Book.objects.create(title='Dune', summary='', isbn='9780441172719')
+        cls.messiah = Book.objects.create(title='Dune Messiah', summary='', isbn='9780441013593')
+
+    def copies(self, book):
+        return Book.objects.values_list(*Book.COPIES).get(pk=book.pk)
+
+    def test_counts_the_created_changed_and_deleted_copies(self):
+        copy = BookInstance.objects.create(book=self.dune, imprint='Ace', status='a')
+        BookInstance.objects.create(book=self.dune, imprint='Ace', status='m')
+        self.assertEqual(self.copies(self.dune), (2, 1, 0))
+
+        copy = BookInstance.objects.get(pk=copy.pk)
+        copy.status = 'o'
+        copy.save()
+        self.assertEqual(self.copies(self.dune), (2, 0, 1))
+
+        # moved to another book
+        copy.book = self.messiah
+        copy.save()
+        self.assertEqual(self.copies(self.dune), (1, 0, 0))
+        self.assertEqual(self.copies(self.messiah), (1, 0, 1))
+
+        copy.delete()
+        self.assertEqual(self.copies(self.messiah), (0, 0, 0))
+
+    def test_book_save_keeps_the_concurrent_counts(self):
+        book = Book.objects.get(pk=self.dune.pk)
+        BookInstance.objects.create(book=self.dune, imprint='Ace', status='a')
+
+        # the loaded counters are stale now, they must not be written back
+        book.title = 'Dune (1965)'
+        book.save()
+        self.assertEqual(self.copies(self.dune), (1, 1, 0))
+
+
+class OverdueModelTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        book = Book.objects.create(title='Dune', summary='', isbn='9780441172719')
+        cls.today = datetime.date(2024, 3, 1)
+        for days, status in ((-3, 'o'), (0, 'o'), (10, 'o'), (10, 'a')):
+            BookInstance.objects.create(
+                book=book, imprint='Ace', status=status, due_back=cls.today - datetime.timedelta(days=days),
+            )
+
+    def test_overdue_and_days_overdue_in_sql(self):
+        copies = BookInstance.objects.with_days_overdue(self.today).order_by('due_back', 'status')
+        self.assertEqual([copy.days_overdue for copy in copies], [10, 10, 0, -3])
+        self.assertEqual(
+            list(BookInstance.objects.overdue(self.today).with_days_overdue(self.today)
+                 .values_list('status', 'days_overdue')),
+            [('o', 10)],
+        )
+        self.assertEqual([copy.is_overdue() for copy in copies], [True, True, False, False])
+
+
+class QueryPlanTest(TestCase):
+    """The hot list queries have to be served by the indexes, not by full scans."""
+
+    def assertUsesIndex(self, queryset, index_name):
+        if connection.vendor == 'postgresql':
+            # tiny test tables are always cheaper to scan, forbid it
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute('SET LOCAL enable_seqscan = off')
+                plan = queryset.explain()
+            self.assertNotIn('Seq Scan', plan)
+        elif connection.vendor == 'sqlite':
+            plan = queryset.explain()
+            self.assertNotIn('USE TEMP B-TREE', plan)
+        else:
+            self.skipTest(f'no plan expectations for {connection.vendor}')
+        self.assertIn(index_name, plan)
+
+    def test_all_borrowed_books(self):
+        self.assertUsesIndex(
+            BookInstance.objects.filter(status__exact='o').order_by('due_back'),
+            'bookinst_status_due_idx',
+        )
+
+    def test_overdue_books(self):
+        self.assertUsesIndex(BookInstance.objects.overdue().order_by('due_back'), 'bookinst_status_due_idx')
+
+    def test_books_borrowed_by_user(self):
+        self.assertUsesIndex(
+            BookInstance.objects.filter(borrower=1).filter(status__exact='o').order_by('due_back'),
+            'bookinst_borrower_due_idx',
+        )
+
+    def test_book_list_pages(self):
+        self.assertUsesIndex(Book.objects.order_by('title', 'pk')[:11], 'book_title_idx')
+        # the pages after and before a cursor, as the book list asks for them
+        paginator = KeysetPaginator(Book.objects.select_related('author'), 10, ['title'])
+        for forward in (True, False):
+            for inclusive in (False, True):
+                with self.subTest(forward=forward, inclusive=inclusive):
+                    cursor = paginator.encode_key(['M', 5], forward, inclusive)
+                    self.assertUsesIndex(paginator.cursor_queryset(cursor), 'book_title_idx')
+
+    def test_author_list_pages(self):
+        self.assertUsesIndex(
+            Author.objects.order_by('last_name', 'first_name', 'pk')[:11], 'author_name_idx'
+        )
@@ -1,9 +1,28 @@
-from django.test import TestCase
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.contrib.auth.models import AnonymousUser
+from django.http import HttpResponse, HttpResponseNotFound, HttpResponseRedirect, StreamingHttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
 from django.urls import reverse
 import datetime
+import gzip
+import json
+import multiprocessing
+import shutil
+import tempfile
+import threading
+import time
 from django.utils import timezone
 from django.contrib.auth.models import User  # Required to assign User as a borrower
-from ..models import BookInstance, Book, Genre, Language, Author
+from ..models import BookInstance, Book, Genre, Language, Author, Reservation, SimilarBook
+from ..autocomplete import BOOK, CatalogAutocomplete, book_entry, pack
+from ..computed import get_or_compute
+from ..pagecache import cache_anonymous_page
+from ..pagination import KeysetPaginator
+from ..loans import checkout, return_copy
+from ..lookups import MAX_LOOKUP_PAGE, lookup
 from ..views import AuthorCreate
 import uuid
 from django.contrib.auth.models import Permission  # Required to grant the permission needed to set a book as returned.
@@ -21,6 +40,10 @@ class AuthorListViewTest(TestCase):
                 last_name=f'Surname {author_id}',
             )
 
+    def setUp(self):
+        # the anonymous pages are cached
+        cache.clear()
+
     def test_view_url_exists_at_desired_location(self):
         response = self.client.get('/catalog/authors/')
         self.assertEqual(response.status_code, 200)
@@ -49,6 +72,55 @@ class AuthorListViewTest(TestCase):
         self.assertTrue(response.context['is_paginated'] == True)
         self.assertEqual(len(response.context['author_list']), 3)
 
+    def test_next_cursor_follows_the_ordering(self):
+        # Walk from the first page to the second one by the opaque cursor
+        response = self.client.get(reverse('authors'))
+        first_page = list(response.context['author_list'])
+        cursor = response.context['page_obj'].next_cursor
+        self.assertIsNotNone(cursor)
+
+        response = self.client.get(reverse('authors') + f'?cursor={cursor}')
+        self.assertEqual(response.status_code, 200)
+        second_page = list(response.context['author_list'])
+        self.assertEqual(len(second_page), 3)
+        self.assertFalse(response.context['page_obj'].has_next())
+        self.assertEqual(
+            first_page + second_page,
+            list(Author.objects.order_by('last_name', 'pk'))
+        )
+
+        # and back to the first page again
+        cursor = response.context['page_obj'].previous_cursor
+        response = self.client.get(reverse('authors') + f'?cursor={cursor}')
+        self.assertEqual(list(response.context['author_list']), first_page)
+        self.assertFalse(response.context['page_obj'].has_previous())
+
+    def test_past_the_end_cursor_links_back(self):
+        last = Author.objects.order_by('last_name', 'first_name', 'pk').last()
+        cursor = KeysetPaginator.encode_key([last.last_name, last.first_name, last.pk], forward=True)
+        response = self.client.get(reverse('authors') + f'?cursor={cursor}')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(response.context['author_list']), [])
+        self.assertNotContains(response, '?page=')
+
+        # the previous page ends at the boundary of the cursor
+        previous = response.context['page_obj'].previous_cursor
+        response = self.client.get(reverse('authors') + f'?cursor={previous}')
+        self.assertEqual(response.context['author_list'][-1], last)
+
+    def test_cursor_page_does_not_count_rows(self):
+        response = self.client.get(reverse('authors'))
+        cursor = response.context['page_obj'].next_cursor
+        # session + user lookups are absent for anonymous, only the seek query is left
+        with self.assertNumQueries(1):
+            self.client.get(reverse('authors') + f'?cursor={cursor}')
+
+    def test_invalid_cursor_and_deep_page_give_404(self):
+        response = self.client.get(reverse('authors') + '?cursor=garbage')
+        self.assertEqual(response.status_code, 404)
+        response = self.client.get(reverse('authors') + '?page=5000')
+        self.assertEqual(response.status_code, 404)
+
 
 class LoanedBookInstancesByUserListViewTest(TestCase):
     def setUp(self):
@@ -545,3 +617,967 @@ class AuthorCreateTest(TestCase):
         response = self.client.get(reverse('author-create'))
 
         self.assertEqual(response.status_code, 200)
+
+
+class IndexViewTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        test_author = Author.objects.create(first_name='John', last_name='Smith')
+        Genre.objects.create(name='Fantasy')
+        for number, title in enumerate(['Sand and Stone', 'Dune', 'Band of Brothers']):
+            book = Book.objects.create(
+                title=title,
+                summary='My book summary',
+                isbn=f'ISBN{number}',
+                author=test_author,
+            )
+            BookInstance.objects.create(book=book, imprint='Imprint', status='a' if number else 'o')
+
+    def setUp(self):
+        cache.clear()
+
+    def test_counts_come_from_the_counters_row(self):
+        # the counters row, then the top of each popular books window
+        with self.assertNumQueries(4):
+            response = self.client.get(reverse('index'))
+        self.assertEqual(response.context['num_books'], 3)
+        self.assertEqual(response.context['num_instances'], 3)
+        self.assertEqual(response.context['num_instances_available'], 2)
+        self.assertEqual(response.context['num_authors'], 1)
+        self.assertEqual(response.context['num_genres'], 1)
+        self.assertEqual(response.context['num_books_with_and'], 2)
+
+    def test_warm_cache_needs_no_queries(self):
+        self.client.get(reverse('index'))
+        with self.assertNumQueries(0):
+            self.client.get(reverse('index'))
+
+    def test_saving_a_model_invalidates_the_counters(self):
+        self.client.get(reverse('index'))
+        Genre.objects.create(name='Horror')
+        response = self.client.get(reverse('index'))
+        self.assertEqual(response.context['num_genres'], 2)
+
+    def test_visits_are_counted_without_a_session(self):
+        self.client.get(reverse('index'))
+        response = self.client.get(reverse('index'))
+        self.assertEqual(response.context['num_visits'], 1)
+        self.assertNotIn(settings.SESSION_COOKIE_NAME, response.cookies)
+
+
+class QueryBudgetTest(TestCase):
+    """
+    Every catalog page has to run a fixed number of queries,
+    no matter how many rows (and related rows) it shows.
+    """
+    password = '1X<ISRUkw+tuK'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.librarian = User.objects.create_user(username='librarian', password=cls.password)
+        cls.librarian.user_permissions.add(*Permission.objects.filter(codename__in=[
+            'view_all_borrowed', 'can_mark_returned', 'can_affect_books', 'can_affect_authors',
+        ]))
+        language = Language.objects.create(name='English')
+        genres = [Genre.objects.create(name=f'Genre {number}') for number in range(3)]
+        cls.authors = [
+            Author.objects.create(first_name=f'First {number}', last_name=f'Last {number}')
+            for number in range(4)
+        ]
+        for number in range(12):
+            book = Book.objects.create(
+                title=f'Title {number}',
+                summary='Summary',
+                isbn=f'ISBN{number}',
+                author=cls.authors[number % 4],
+                language=language,
+            )
+            book.genre.set(genres)
+            for copy in range(3):
+                BookInstance.objects.create(
+                    book=book,
+                    imprint='Imprint',
+                    status='o',
+                    borrower=cls.librarian,
+                    due_back=datetime.date.today() + datetime.timedelta(days=copy - 1),
+                )
+        cls.book = Book.objects.first()
+        cls.copy = BookInstance.objects.first()
+
+    def setUp(self):
+        cache.clear()
+
+    def assertPageQueries(self, budget, url):
+        with self.assertNumQueries(budget):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+
+    def test_anonymous_pages(self):
+        # the counters row and the popular books windows (cold cache)
+        self.assertPageQueries(4, reverse('index'))
+        # the page, plus the facet counts with the genre and language names (cold cache),
+        # the popular books are cached by the homepage
+        self.assertPageQueries(4, reverse('books'))
+        self.assertPageQueries(1, reverse('authors'))
+        # the updated_at of the page, the object, then one query per
+        # prefetched relation (the similar books included)
+        self.assertPageQueries(5, reverse('book-detail', args=[self.book.pk]))
+        self.assertPageQueries(3, reverse('author-detail', args=[self.authors[0].pk]))
+        # the cached pages, the details check the updated_at only
+        self.assertPageQueries(0, reverse('books'))
+        self.assertPageQueries(0, reverse('authors'))
+        self.assertPageQueries(1, reverse('book-detail', args=[self.book.pk]))
+        self.assertPageQueries(1, reverse('author-detail', args=[self.authors[0].pk]))
+
+    def test_librarian_pages(self):
+        self.client.login(username='librarian', password=self.password)
+        # session + user, then user + group permissions when they are checked,
+        # paginated lists add a COUNT, edit forms one query per choice field
+        # plus the reader's holds
+        self.assertPageQueries(7, reverse('my-borrowed'))
+        self.assertPageQueries(6, reverse('all-borrowed'))
+        self.assertPageQueries(5, reverse('renew-book-librarian', args=[self.copy.pk]))
+        self.assertPageQueries(4, reverse('author-create'))
+        self.assertPageQueries(5, reverse('author-update', args=[self.authors[0].pk]))
+        self.assertPageQueries(5, reverse('author-delete', args=[self.authors[0].pk]))
+        # the book form lists no choices, the update reads the chosen ones
+        # only: one IN query per field, however big the tables
+        self.assertPageQueries(4, reverse('book-create'))
+        self.assertPageQueries(9, reverse('book-update', args=[self.book.pk]))
+        self.assertPageQueries(5, reverse('book-delete', args=[self.book.pk]))
+
+    def anonymous_urls(self):
+        return [
+            reverse('index'),
+            reverse('books'),
+            reverse('authors'),
+            reverse('book-detail', args=[self.book.pk]),
+            reverse('author-detail', args=[self.authors[0].pk]),
+        ]
+
+    def librarian_urls(self):
+        return [
+            reverse('my-borrowed'),
+            reverse('all-borrowed'),
+            reverse('renew-book-librarian', args=[self.copy.pk]),
+            reverse('author-update', args=[self.authors[0].pk]),
+            reverse('author-delete', args=[self.authors[0].pk]),
+            reverse('book-update', args=[self.book.pk]),
+            reverse('book-delete', args=[self.book.pk]),
+        ]
+
+    def queries_per_page(self, urls):
+        """url -> the queries of its cold rendering"""
+        counts = {}
+        for url in urls:
+            cache.clear()
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            counts[url] = len(queries)
+        return counts
+
+    def add_rows(self):
+        """many more rows of every kind the pages show: books, genres, copies, loans, holds, neighbours"""
+        genres = [Genre.objects.create(name=f'More genre {number}') for number in range(5)]
+        self.book.genre.add(*genres)
+        for number in range(20):
+            book = Book.objects.create(
+                title=f'More {number}',
+                summary='Summary',
+                isbn=f'MORE{number}',
+                author=self.authors[0],
+                language_id=self.book.language_id,
+            )
+            book.genre.set(genres)
+            BookInstance.objects.create(
+                book=book, imprint='Imprint', status='o', borrower=self.librarian,
+                due_back=datetime.date.today() + datetime.timedelta(days=number - 10),
+            )
+            BookInstance.objects.create(book=self.book, imprint='Imprint', status='a')
+            Reservation.objects.create(book=book, patron=self.librarian)
+            SimilarBook.objects.create(book=self.book, similar=book, rank=number + 1, score=1.0)
+
+    def test_anonymous_pages_do_not_grow_with_the_data(self):
+        before = self.queries_per_page(self.anonymous_urls())
+        self.add_rows()
+        self.assertEqual(self.queries_per_page(self.anonymous_urls()), before)
+
+    def test_librarian_pages_do_not_grow_with_the_data(self):
+        self.client.login(username='librarian', password=self.password)
+        before = self.queries_per_page(self.librarian_urls())
+        self.add_rows()
+        self.assertEqual(self.queries_per_page(self.librarian_urls()), before)
+
+
+class SearchViewTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = Author.objects.create(first_name='Frank', last_name='Herbert')
+        cls.genre = Genre.objects.create(name='Fantasy')
+        cls.dune = Book.objects.create(
+            title='Dune', summary='Spice and sand worms', isbn='1', author=cls.author,
+        )
+        cls.other = Book.objects.create(
+            title='Children of Dune', summary='Dune is mentioned once', isbn='2',
+        )
+        cls.other.genre.add(cls.genre)
+
+    def search(self, query):
+        response = self.client.get(reverse('search'), {'q': query})
+        self.assertEqual(response.status_code, 200)
+        return list(response.context['book_list'])
+
+    def test_uses_correct_template(self):
+        response = self.client.get(reverse('search'), {'q': 'dune'})
+        self.assertTemplateUsed(response, 'catalog/book_search.html')
+
+    def test_results_are_ranked_and_prefixed(self):
+        self.assertEqual(self.search('dune'), [self.dune, self.other])
+        self.assertEqual(self.search('wor'), [self.dune])
+        self.assertEqual(self.search('herbert spice'), [self.dune])
+        self.assertEqual(self.search('fantasy'), [self.other])
+
+    def test_operators_in_the_query_are_ignored(self):
+        self.assertEqual(self.search('"dune" (*:'), [self.dune, self.other])
+        self.assertEqual(self.search('***'), [])
+
+    def test_index_follows_the_changes(self):
+        self.author.last_name = 'Atreides'
+        self.author.save()
+        self.assertEqual(self.search('atreides'), [self.dune])
+
+        self.dune.genre.add(self.genre)
+        self.assertEqual(self.search('fantasy'), [self.dune, self.other])
+        self.genre.delete()
+        self.assertEqual(self.search('fantasy'), [])
+
+        self.dune.title = 'Arrakis'
+        self.dune.save()
+        self.assertEqual(self.search('arrakis'), [self.dune])
+        self.dune.delete()
+        self.assertEqual(self.search('arrakis'), [])
+
+    def test_pages_are_not_counted(self):
+        for number in range(12):
+            Book.objects.create(title=f'Sandworm {number}', isbn=f'S{number}')
+        response = self.client.get(reverse('search'), {'q': 'sandworm'})
+        self.assertTrue(response.context['has_next'])
+        response = self.client.get(reverse('search'), {'q': 'sandworm', 'page': 2})
+        self.assertEqual(len(response.context['book_list']), 2)
+        self.assertFalse(response.context['has_next'])
+
+
+class AutocompleteViewTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = Author.objects.create(first_name='Frank', last_name='Herbert')
+        cls.dune = Book.objects.create(title='Dune', isbn='1', author=cls.author)
+        cls.messiah = Book.objects.create(title='Dune Messiah', isbn='2', author=cls.author)
+
+    def setUp(self):
+        # a fresh version stamp makes every worker copy stale
+        cache.clear()
+
+    def suggest(self, query):
+        response = self.client.get(reverse('autocomplete'), {'q': query})
+        self.assertEqual(response.status_code, 200)
+        return [result['label'] for result in response.json()['results']]
+
+    def test_titles_and_author_names(self):
+        self.assertEqual(self.suggest('du'), ['Dune', 'Dune Messiah'])
+        self.assertEqual(self.suggest('DUNE  m'), ['Dune Messiah'])
+        self.assertEqual(self.suggest('herb'), ['Herbert, Frank'])
+        self.assertEqual(self.suggest('frank h'), ['Herbert, Frank'])
+        self.assertEqual(self.suggest(''), [])
+
+    def test_keystrokes_do_not_query_the_database(self):
+        self.suggest('d')
+        with self.assertNumQueries(0):
+            self.suggest('du')
+            self.suggest('dun')
+
+    def test_index_is_patched_by_the_signals(self):
+        self.suggest('d')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.dune.title = 'Arrakis'
+            self.dune.save()
+            Book.objects.create(title='Dune Children', isbn='3')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.messiah.delete()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.suggest('d'), ['Dune Children'])
+            self.assertEqual(self.suggest('arr'), ['Arrakis'])
+
+    def test_changes_of_another_worker_are_replayed(self):
+        self.suggest('d')
+        # the signals of another worker publish the deltas, no rebuild here
+        other_worker = CatalogAutocomplete()
+        other_worker.update(book_entry(self.dune.pk, 'Arrakis'))
+        other_worker.remove(pack(BOOK, self.messiah.pk))
+        with self.assertNumQueries(0):
+            self.assertEqual(self.suggest('d'), [])
+            self.assertEqual(self.suggest('arr'), ['Arrakis'])
+
+        # the bulk writes ask for a rebuild
+        other_worker.invalidate()
+        with self.assertNumQueries(2):
+            self.assertEqual(self.suggest('d'), ['Dune', 'Dune Messiah'])
+
+    def test_version_bump_of_another_worker_forces_a_rebuild(self):
+        self.suggest('d')
+        cache.incr('catalog:autocomplete:version')
+        with self.assertNumQueries(2):
+            self.suggest('d')
+
+
+class BookListFacetsTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.english = Language.objects.create(name='English')
+        cls.french = Language.objects.create(name='French')
+        cls.fantasy = Genre.objects.create(name='Fantasy')
+        cls.horror = Genre.objects.create(name='Horror')
+        herbert = Author.objects.create(first_name='Frank', last_name='Herbert')
+        king = Author.objects.create(first_name='Stephen', last_name='King')
+        for number in range(12):
+            book = Book.objects.create(
+                title=f'Title {number:02}',
+                isbn=f'ISBN{number}',
+                author=herbert if number % 2 else king,
+                language=cls.english if number % 3 else cls.french,
+            )
+            book.genre.add(cls.fantasy if number % 4 else cls.horror)
+
+    def setUp(self):
+        cache.clear()
+
+    def facet(self, response, name):
+        return {link['label']: link['count'] for link in dict(response.context['facets'])[name]}
+
+    def test_facet_counts(self):
+        response = self.client.get(reverse('books'))
+        self.assertEqual(self.facet(response, 'genre'), {'Fantasy': 9, 'Horror': 3})
+        self.assertEqual(self.facet(response, 'language'), {'English': 8, 'French': 4})
+        self.assertEqual(self.facet(response, 'initial'), {'H': 6, 'K': 6})
+
+    def test_combined_filters(self):
+        response = self.client.get(reverse('books'), {
+            'genre': self.fantasy.pk, 'language': self.english.pk, 'initial': 'h',
+        })
+        books = response.context['book_list']
+        self.assertEqual([book.title for book in books], ['Title 01', 'Title 05', 'Title 07', 'Title 11'])
+
+    def test_page_links_keep_the_filters(self):
+        for number in range(5):
+            Book.objects.create(title=f'Extra {number}', isbn=f'EXTRA{number}', language=self.english)
+        response = self.client.get(reverse('books'), {'language': self.english.pk})
+        self.assertContains(response, f'?language={self.english.pk}&amp;cursor=')
+
+        cursor = response.context['page_obj'].next_cursor
+        response = self.client.get(reverse('books'), {'language': self.english.pk, 'cursor': cursor})
+        self.assertEqual(len(response.context['book_list']), 3)
+
+    def test_counts_follow_the_changes(self):
+        book = Book.objects.get(title='Title 00')
+        book.genre.remove(self.horror)
+        book.genre.remove(self.horror)
+        book.genre.add(self.fantasy)
+        book = Book.objects.get(pk=book.pk)
+        book.language = self.english
+        book.save()
+        Author.objects.filter(last_name='King').get().delete()
+
+        response = self.client.get(reverse('books'))
+        self.assertEqual(self.facet(response, 'genre'), {'Fantasy': 10, 'Horror': 2})
+        self.assertEqual(self.facet(response, 'language'), {'English': 9, 'French': 3})
+        self.assertEqual(self.facet(response, 'initial'), {'H': 6})
+
+        self.horror.delete()
+        response = self.client.get(reverse('books'))
+        self.assertEqual(self.facet(response, 'genre'), {'Fantasy': 10})
+
+
+class ExportViewTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        User.objects.create_user(username='reader', password='1X<ISRUkw+tuK')
+        User.objects.create_user(username='staff', password='1X<ISRUkw+tuK', is_staff=True)
+        author = Author.objects.create(first_name='Frank', last_name='Herbert')
+        Book.objects.create(title='Dune', summary='Desert', isbn='9780000000001', author=author)
+
+    def test_requires_staff(self):
+        self.client.login(username='reader', password='1X<ISRUkw+tuK')
+        response = self.client.get(reverse('export'))
+        self.assertEqual(response.status_code, 302)
+
+    def test_streams_csv(self):
+        self.client.login(username='staff', password='1X<ISRUkw+tuK')
+        response = self.client.get(reverse('export'), {'dataset': 'authors'})
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0], 'id,first_name,last_name,date_of_birth,date_of_death,biography')
+        self.assertIn('Frank,Herbert', lines[1])
+
+    def test_streams_gzipped_jsonl(self):
+        self.client.login(username='staff', password='1X<ISRUkw+tuK')
+        response = self.client.get(reverse('export'), {'dataset': 'books', 'format': 'jsonl', 'gzip': '1'})
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="books.jsonl.gz"')
+        content = gzip.decompress(b''.join(response.streaming_content))
+        self.assertEqual(json.loads(content)['title'], 'Dune')
+
+    def test_unknown_dataset(self):
+        self.client.login(username='staff', password='1X<ISRUkw+tuK')
+        response = self.client.get(reverse('export'), {'dataset': 'users'})
+        self.assertEqual(response.status_code, 404)
+
+
+class BookListSortTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        for number, available in enumerate((1, 3, 0, 3)):
+            book = Book.objects.create(title=f'Title {number}', isbn=f'ISBN{number}')
+            for _ in range(available):
+                BookInstance.objects.create(book=book, imprint='Ace', status='a')
+            BookInstance.objects.create(book=book, imprint='Ace', status='o')
+
+    def setUp(self):
+        cache.clear()
+
+    def test_sorts_by_availability(self):
+        response = self.client.get(reverse('books'), {'sort': 'available'})
+        self.assertEqual(
+            [book.title for book in response.context['book_list']],
+            ['Title 1', 'Title 3', 'Title 0', 'Title 2'],
+        )
+        self.assertContains(response, '3 of 4 available')
+
+    def test_unknown_sort_falls_back_to_title(self):
+        response = self.client.get(reverse('books'), {'sort': 'isbn'})
+        self.assertEqual(response.context['sort'], 'title')
+        self.assertEqual(response.context['book_list'][0].title, 'Title 0')
+
+
+class OverdueReportViewTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.librarian = User.objects.create_user(username='librarian', password='1X<ISRUkw+tuK')
+        cls.librarian.user_permissions.add(Permission.objects.get(codename='view_all_borrowed'))
+        reader = User.objects.create_user(username='reader', password='1X<ISRUkw+tuK')
+        book = Book.objects.create(title='Dune', summary='', isbn='9780441172719')
+        today = timezone.localdate()
+        for days, borrower in ((3, reader), (5, reader), (20, reader), (100, None), (-2, reader)):
+            BookInstance.objects.create(
+                book=book, imprint='Ace', status='o', borrower=borrower,
+                due_back=today - datetime.timedelta(days=days),
+            )
+
+    def test_requires_the_permission(self):
+        self.client.login(username='reader', password='1X<ISRUkw+tuK')
+        self.assertEqual(self.client.get(reverse('overdue-report')).status_code, 403)
+
+    def test_buckets_and_borrowers(self):
+        self.client.login(username='librarian', password='1X<ISRUkw+tuK')
+        response = self.client.get(reverse('overdue-report'))
+
+        self.assertEqual(response.context['total'], 4)
+        self.assertEqual(
+            [(label, loans) for label, loans, _, _ in response.context['by_age']],
+            [('1-7 days', 2), ('8-14 days', 0), ('15-30 days', 1), ('31-90 days', 0), ('over 90 days', 1)],
+        )
+        by_borrower = response.context['by_borrower']
+        self.assertEqual(
+            [(row['borrower__username'], row['loans'], row['oldest']) for row in by_borrower],
+            [('reader', 3, 20), (None, 1, 100)],
+        )
+
+
+class AdminQueryBudgetTest(TestCase):
+    """The admin changelists run a fixed number of queries for a page of 100 rows."""
+    password = '1X<ISRUkw+tuK'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser(username='admin', password=cls.password)
+        reader = User.objects.create_user(username='reader', password=cls.password)
+        language = Language.objects.create(name='English')
+        genres = [Genre.objects.create(name=f'Genre {number}') for number in range(4)]
+        for number in range(100):
+            book = Book.objects.create(
+                title=f'Title {number}',
+                summary='Summary',
+                isbn=f'ISBN{number}',
+                author=Author.objects.create(first_name='First', last_name=f'Last {number}'),
+                language=language,
+            )
+            book.genre.set(genres)
+            BookInstance.objects.create(
+                book=book, imprint='Imprint', status='o', borrower=reader, due_back=datetime.date.today(),
+            )
+
+    def setUp(self):
+        self.client.login(username='admin', password=self.password)
+
+    def assertChangelistQueries(self, budget, url, rows):
+        with self.assertNumQueries(budget):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['cl'].result_list), rows)
+
+    def test_book_changelist(self):
+        # session + user, two counts, the page with the author and the language,
+        # the genres of the page
+        self.assertChangelistQueries(6, reverse('admin:catalog_book_changelist'), 100)
+        self.assertContains(self.client.get(reverse('admin:catalog_book_changelist')), 'Genre 0, Genre 1, Genre 2')
+
+    def test_bookinstance_changelist(self):
+        # session + user, two counts, the page with the book and the borrower
+        self.assertChangelistQueries(5, reverse('admin:catalog_bookinstance_changelist'), 100)
+
+    def test_change_forms_do_not_list_every_row(self):
+        copy = BookInstance.objects.first()
+        book = Book.objects.get(title='Title 0')
+        BookInstance.objects.bulk_create(
+            [BookInstance(book=book, imprint=f'Extra {number}', status='a') for number in range(50)]
+        )
+
+        # the book and the borrower are picked with the autocomplete, the
+        # copies of the book and the books of the author are loaded later
+        self.assertChangelistForm(reverse('admin:catalog_bookinstance_change', args=[copy.pk]), 'Title 1')
+        self.assertChangelistForm(reverse('admin:catalog_book_change', args=[book.pk]), 'Extra 0')
+        response = self.assertChangelistForm(reverse('admin:catalog_author_change', args=[book.author_id]), 'ISBN0')
+        self.assertContains(response, reverse('admin:catalog_author_related', args=[book.author_id]))
+
+    def assertChangelistForm(self, url, absent):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotContains(response, absent)
+        return response
+
+    def test_related_rows_come_a_page_at_a_time(self):
+        book = Book.objects.get(title='Title 0')
+        BookInstance.objects.bulk_create(
+            [BookInstance(book=book, imprint=f'Extra {number}', status='a') for number in range(30)]
+        )
+        url = reverse('admin:catalog_book_related', args=[book.pk])
+
+        # session + user, the book (with its genres, as the admin loads it),
+        # the page of copies with their borrowers
+        with self.assertNumQueries(5):
+            response = self.client.get(url)
+        self.assertEqual(len(response.context['rows']), 20)
+        self.assertContains(response, 'page=2')
+        response = self.client.get(url, {'page': 2})
+        self.assertEqual(len(response.context['rows']), 11)
+        self.assertFalse(response.context['has_next'])
+
+        response = self.client.get(reverse('admin:catalog_author_related', args=[book.author_id]))
+        self.assertContains(response, 'Title 0')
+        self.assertContains(response, f'?author={book.author_id}')
+
+    def test_related_rows_need_the_view_permission_of_their_model(self):
+        book = Book.objects.get(title='Title 0')
+        staff = User.objects.create_user(username='staff', password=self.password, is_staff=True)
+        staff.user_permissions.add(Permission.objects.get(codename='view_book'))
+        self.client.force_login(staff)
+
+        # the copies name their borrowers
+        self.assertEqual(self.client.get(reverse('admin:catalog_book_related', args=[book.pk])).status_code, 403)
+        self.assertNotContains(self.client.get(reverse('admin:catalog_book_change', args=[book.pk])), 'related-list')
+
+        staff.user_permissions.add(Permission.objects.get(codename='view_bookinstance'))
+        self.assertEqual(self.client.get(reverse('admin:catalog_book_related', args=[book.pk])).status_code, 200)
+        self.assertContains(self.client.get(reverse('admin:catalog_book_change', args=[book.pk])), 'related-list')
+
+    def autocomplete(self, model_name, field_name, term):
+        response = self.client.get(reverse('admin:autocomplete'), {
+            'app_label': 'catalog', 'model_name': model_name, 'field_name': field_name, 'term': term,
+        })
+        self.assertEqual(response.status_code, 200)
+        return [result['text'] for result in response.json()['results']]
+
+    def test_autocomplete_uses_the_indexes(self):
+        self.assertEqual(self.autocomplete('bookinstance', 'book', 'title 42'), ['Title 42'])
+        self.assertEqual(self.autocomplete('bookinstance', 'borrower', 'rea'), ['reader'])
+        self.assertEqual(self.autocomplete('book', 'author', 'last 42'), ['Last 42, First'])
+
+    def test_book_autocomplete_keeps_the_rank(self):
+        Book.objects.create(title='Arrakis', summary='The spice must flow.', isbn='SPICE0')
+        Book.objects.create(title='Spice', summary='', isbn='SPICE1')
+        # the title weighs more than the summary
+        self.assertEqual(self.autocomplete('bookinstance', 'book', 'spice'), ['Spice', 'Arrakis'])
+        # no term, the books a page at a time in their order
+        self.assertEqual(len(self.autocomplete('bookinstance', 'book', '')), 20)
+
+
+class LookupTest(TestCase):
+    password = '1X<ISRUkw+tuK'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.librarian = User.objects.create_user(username='librarian', password=cls.password)
+        cls.librarian.user_permissions.add(Permission.objects.get(codename='can_affect_books'))
+        cls.genres = Genre.objects.bulk_create([Genre(name=f'Genre {number:02}') for number in range(30)])
+        cls.author = Author.objects.create(first_name='Frank', last_name='Herbert')
+        Author.objects.create(first_name='Jane', last_name='Austen')
+        cls.language = Language.objects.create(name='English')
+
+    def lookup(self, name, **params):
+        response = self.client.get(reverse('lookup', args=[name]), params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_lookup_by_prefix_a_page_at_a_time(self):
+        self.assertEqual(self.lookup('authors', q='her')['results'], [{'id': self.author.pk, 'text': 'Herbert, Frank'}])
+
+        first = self.lookup('genres', q='genre')
+        self.assertEqual(len(first['results']), 20)
+        self.assertTrue(first['more'])
+        second = self.lookup('genres', q='genre', page=2)
+        self.assertEqual([result['text'] for result in second['results']], [f'Genre {n}' for n in range(20, 30)])
+        self.assertFalse(second['more'])
+        self.assertEqual(self.client.get(reverse('lookup', args=['users'])).status_code, 404)
+
+    def test_deep_pages_are_empty(self):
+        with self.assertNumQueries(0):
+            self.assertEqual(self.lookup('genres', page=10 ** 12), {'results': [], 'more': False})
+        # the last page does not offer more
+        results, more = lookup('genres', '', MAX_LOOKUP_PAGE, page_size=0)
+        self.assertEqual((results, more), ([], False))
+
+    def test_book_form_renders_the_chosen_options_only(self):
+        book = Book.objects.create(title='Dune', summary='', isbn='1', author=self.author, language=self.language)
+        book.genre.add(self.genres[3])
+        self.client.login(username='librarian', password=self.password)
+
+        response = self.client.get(reverse('book-update', args=[book.pk]))
+        self.assertContains(response, 'data-lookup-url="%s"' % reverse('lookup', args=['genres']))
+        self.assertContains(response, 'Genre 03')
+        self.assertNotContains(response, 'Genre 04')
+        self.assertNotContains(response, 'Austen')
+        self.assertContains(response, 'js/lookup')
+
+    def test_book_form_checks_the_submitted_keys(self):
+        self.client.login(username='librarian', password=self.password)
+        data = {
+            'title': 'Dune', 'summary': 'Spice', 'isbn': '9780441172719',
+            'author': self.author.pk, 'language': self.language.pk,
+            'genre': [self.genres[0].pk, self.genres[1].pk],
+        }
+        response = self.client.post(reverse('book-create'), data)
+        self.assertEqual(response.status_code, 302)
+        book = Book.objects.get(isbn='9780441172719')
+        self.assertEqual(set(book.genre.all()), set(self.genres[:2]))
+
+        response = self.client.post(reverse('book-create'), dict(data, isbn='1', genre=[self.genres[0].pk, 0]))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('genre', response.context['form'].errors)
+
+
+class FragmentCacheTest(TestCase):
+    """A warm book or author page reads the object only, every change shows up."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.reader = User.objects.create_user(username='reader', password='1X<ISRUkw+tuK')
+        cls.author = Author.objects.create(first_name='Frank', last_name='Herbert')
+        cls.genre = Genre.objects.create(name='Science Fiction')
+        cls.book = Book.objects.create(title='Dune', summary='', isbn='1', author=cls.author)
+        cls.book.genre.add(cls.genre)
+        cls.copy = BookInstance.objects.create(book=cls.book, imprint='Ace', status='a')
+
+    def setUp(self):
+        cache.clear()
+
+    def book_page(self):
+        return self.client.get(reverse('book-detail', args=[self.book.pk]))
+
+    def test_warm_pages_read_the_object_only(self):
+        self.book_page()
+        with self.assertNumQueries(1):
+            self.assertContains(self.book_page(), 'Science Fiction')
+
+        url = reverse('author-detail', args=[self.author.pk])
+        self.client.get(url)
+        with self.assertNumQueries(1):
+            self.assertContains(self.client.get(url), 'Dune')
+
+    def test_loans_change_the_copies(self):
+        self.assertContains(self.book_page(), '1 of 1 available')
+
+        copy_id = checkout(self.book.pk, self.reader)
+        self.assertContains(self.book_page(), 'On loan')
+        return_copy(copy_id)
+        self.assertContains(self.book_page(), '1 of 1 available')
+
+    def test_saved_copies_and_genres(self):
+        self.book_page()
+        copy = BookInstance.objects.get(pk=self.copy.pk)
+        copy.status = 'm'
+        copy.save()
+        self.assertContains(self.book_page(), 'Maintenance')
+
+        self.book.genre.add(Genre.objects.create(name='Classics'))
+        self.assertContains(self.book_page(), 'Classics')
+        self.genre.name = 'Space Opera'
+        self.genre.save()
+        self.assertContains(self.book_page(), 'Space Opera')
+        self.genre.book_set.clear()
+        self.assertNotContains(self.book_page(), 'Space Opera')
+
+    def test_copy_moved_to_another_book(self):
+        other = Book.objects.create(title='Emma', summary='', isbn='2')
+        self.client.get(reverse('book-detail', args=[other.pk]))
+        self.book_page()
+
+        copy = BookInstance.objects.get(pk=self.copy.pk)
+        copy.book = other
+        copy.save()
+        self.assertContains(self.client.get(reverse('book-detail', args=[other.pk])), str(self.copy.pk))
+        self.assertNotContains(self.book_page(), str(self.copy.pk))
+
+    def test_renamed_and_deleted_similar_books(self):
+        neighbour = Book.objects.create(title='Hyperion', summary='', isbn='2')
+        SimilarBook.objects.create(book=self.book, similar=neighbour, rank=1, score=1.0)
+        self.assertContains(self.book_page(), 'Hyperion')
+
+        neighbour = Book.objects.get(pk=neighbour.pk)
+        neighbour.title = 'The Fall of Hyperion'
+        neighbour.save()
+        self.assertContains(self.book_page(), 'The Fall of Hyperion')
+        neighbour.delete()
+        self.assertNotContains(self.book_page(), 'Hyperion')
+
+    def test_renamed_and_moved_books_on_the_author_pages(self):
+        other = Author.objects.create(first_name='Jane', last_name='Austen')
+        url = reverse('author-detail', args=[self.author.pk])
+        self.client.get(url)
+
+        book = Book.objects.get(pk=self.book.pk)
+        book.title = 'Dune Messiah'
+        book.save()
+        self.assertContains(self.client.get(url), 'Dune Messiah')
+
+        self.client.get(reverse('author-detail', args=[other.pk]))
+        book.author = other
+        book.save()
+        self.assertNotContains(self.client.get(url), 'Dune Messiah')
+        self.assertContains(self.client.get(reverse('author-detail', args=[other.pk])), 'Dune Messiah')
+
+
+class PageCacheTest(TestCase):
+    """The anonymous read pages are cached and revalidated, never out of date."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.reader = User.objects.create_user(username='reader', password='1X<ISRUkw+tuK')
+        cls.author = Author.objects.create(first_name='Frank', last_name='Herbert')
+        cls.book = Book.objects.create(title='Dune', summary='', isbn='1', author=cls.author)
+        BookInstance.objects.create(book=cls.book, imprint='Ace', status='a')
+
+    def setUp(self):
+        cache.clear()
+
+    def book_url(self):
+        return reverse('book-detail', args=[self.book.pk])
+
+    def test_repeated_visits_get_304(self):
+        # the lists check the catalog version in the cache, the details read updated_at
+        pages = [
+            (reverse('books'), 0),
+            (reverse('authors'), 0),
+            (self.book_url(), 1),
+            (reverse('author-detail', args=[self.author.pk]), 1),
+        ]
+        for url, queries in pages:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('public', response['Cache-Control'])
+
+            with self.assertNumQueries(queries):
+                response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.content, b'')
+
+            response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+            self.assertEqual(response.status_code, 304)
+
+    def test_cached_pages_skip_the_rendering(self):
+        self.client.get(reverse('books'))
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('books'))
+        self.assertContains(response, 'Dune')
+        self.assertIsNone(response.context)
+
+        self.client.get(self.book_url())
+        # the updated_at of the book only
+        with self.assertNumQueries(1):
+            self.assertContains(self.client.get(self.book_url()), 'Ace')
+
+    def test_changes_make_new_versions(self):
+        response = self.client.get(self.book_url())
+        etag = response['ETag']
+
+        copy_id = checkout(self.book.pk, self.reader)
+        response = self.client.get(self.book_url(), HTTP_IF_NONE_MATCH=etag)
+        self.assertContains(response, 'On loan')
+        self.assertNotEqual(response['ETag'], etag)
+        return_copy(copy_id)
+
+        etag = self.client.get(reverse('books'))['ETag']
+        self.author.last_name = 'Asimov'
+        self.author.save()
+        response = self.client.get(reverse('books'), HTTP_IF_NONE_MATCH=etag)
+        self.assertContains(response, 'Asimov')
+        # the author is shown on the book page too
+        self.assertContains(self.client.get(self.book_url()), 'Asimov')
+
+        etag = self.client.get(reverse('books'))['ETag']
+        Genre.objects.create(name='Science Fiction')
+        response = self.client.get(reverse('books'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_similar_books_renamed_or_deleted(self):
+        neighbour = Book.objects.create(title='Hyperion', summary='', isbn='2')
+        SimilarBook.objects.create(book=self.book, similar=neighbour, rank=1, score=1.0)
+        etag = self.client.get(self.book_url())['ETag']
+
+        neighbour = Book.objects.get(pk=neighbour.pk)
+        neighbour.title = 'The Fall of Hyperion'
+        neighbour.save()
+        response = self.client.get(self.book_url(), HTTP_IF_NONE_MATCH=etag)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertContains(response, 'The Fall of Hyperion')
+
+        etag = response['ETag']
+        neighbour.delete()
+        response = self.client.get(self.book_url(), HTTP_IF_NONE_MATCH=etag)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertNotContains(response, 'Hyperion')
+
+    def test_logged_in_readers_get_fresh_pages(self):
+        self.client.login(username='reader', password='1X<ISRUkw+tuK')
+        self.client.get(self.book_url())
+        response = self.client.get(self.book_url())
+        self.assertFalse(response.has_header('ETag'))
+        self.assertContains(response, 'Reserve')
+
+    def test_missing_objects_are_not_found(self):
+        self.assertEqual(self.client.get(reverse('book-detail', args=[self.book.pk + 1])).status_code, 404)
+
+    def test_only_complete_pages_are_cached(self):
+        calls = []
+
+        def view(request, response_class, *args):
+            calls.append(response_class)
+            return response_class(*args)
+
+        cached = cache_anonymous_page(lambda request, *args: ('v1', timezone.now()))(view)
+        for response_class, args in (
+            (HttpResponseRedirect, ['/elsewhere/']),
+            (HttpResponseNotFound, []),
+            (StreamingHttpResponse, [iter([b'page'])]),
+            (HttpResponse, [b'page']),
+        ):
+            for _ in range(2):
+                request = RequestFactory().get(f'/{response_class.__name__}/')
+                request.user = AnonymousUser()
+                cached(request, response_class, *args)
+        # the complete page is rendered once, the others every time
+        self.assertEqual(calls.count(HttpResponse), 1)
+        self.assertEqual(len(calls), 7)
+
+
+def _stampede(key, protected, barrier, computations, stale, threads):
+    """One gunicorn worker of the stampede: its threads ask for the key at once."""
+    def compute():
+        with computations.get_lock():
+            computations.value += 1
+        # the costly query
+        time.sleep(0.2)
+        return 'new'
+
+    def request():
+        barrier.wait()
+        if protected:
+            value = get_or_compute(key, compute, 60)
+        else:
+            value = cache.get(key)
+            if value is None:
+                value = compute()
+                cache.set(key, value, 60)
+        if value == 'old':
+            with stale.get_lock():
+                stale.value += 1
+
+    workers = [threading.Thread(target=request) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+class StampedeTest(SimpleTestCase):
+    """
+    200 requests of 4 worker processes ask for an expired value at once.
+    The processes share a file based cache, whose add() is not atomic
+    like the one of Redis: a few more recomputations may slip through.
+    """
+    PROCESSES = 4
+    THREADS = 50
+
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.settings = override_settings(CACHES={'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': self.location,
+        }})
+        self.settings.enable()
+
+    def tearDown(self):
+        self.settings.disable()
+        shutil.rmtree(self.location)
+
+    def stampede(self, protected=True):
+        """Returns the number of the recomputations and of the stale values served."""
+        context = multiprocessing.get_context('fork')
+        barrier = context.Barrier(self.PROCESSES * self.THREADS)
+        computations, stale = context.Value('i', 0), context.Value('i', 0)
+        processes = [
+            context.Process(
+                target=_stampede, args=('stampede', protected, barrier, computations, stale, self.THREADS),
+            )
+            for _ in range(self.PROCESSES)
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+            self.assertEqual(process.exitcode, 0)
+        return computations.value, stale.value
+
+    def test_missing_value_is_computed_once(self):
+        unprotected, _ = self.stampede(protected=False)
+        cache.clear()
+        computations, _ = self.stampede()
+        self.assertGreater(unprotected, 50)
+        self.assertLessEqual(computations, 3, f'{computations} recomputations, {unprotected} without the lock')
+        self.assertEqual(cache.get('stampede')[0], 'new')
+
+    def test_stale_value_is_served_while_recomputed(self):
+        # expired a second ago, its computation took 0.2 seconds
+        cache.set('stampede', ('old', time.time() - 1, 0.2), 60)
+        computations, stale = self.stampede()
+        self.assertLessEqual(computations, 3)
+        # nobody has waited for the recomputation
+        self.assertGreaterEqual(stale, self.PROCESSES * self.THREADS - computations)
+        self.assertEqual(cache.get('stampede')[0], 'new')
+
+    def test_early_recomputation(self):
+        cache.set('stampede', ('old', time.time() + 1, 0.2), 60)
+        # far from its expiry for the computation time
+        self.assertEqual(get_or_compute('stampede', lambda: 'new', 60, beta=0), 'old')
+        # the larger the beta, the earlier
+        self.assertEqual(get_or_compute('stampede', lambda: 'new', 60, beta=1000), 'new')
+        self.assertEqual(get_or_compute('stampede', lambda: 'newer', 60, beta=0), 'new')
@@ -5,11 +5,21 @@ urlpatterns = [
     path('', views.index, name='index'),
     path('books/', views.BookListView.as_view(), name='books'),
     path('book/<int:pk>', views.BookDetailView.as_view(), name='book-detail'),
+    path('search/', views.search, name='search'),
+    path('autocomplete/', views.autocomplete, name='autocomplete'),
+    path('lookup/<str:name>/', views.lookup_view, name='lookup'),
+    path('export/', views.export_catalog, name='export'),
     path('authors/', views.AuthorListView.as_view(), name='authors'),
     path('author/<int:pk>', views.AuthorDetailView.as_view(), name='author-detail'),
     path('mybooks/', views.LoanedBooksByUserListView.as_view(), name='my-borrowed'),
     path('allborrowed', views.AllBorrowedBooksListView.as_view(), name='all-borrowed'),
+    path('overdue/', views.overdue_report_view, name='overdue-report'),
+    path('circulation/', views.circulation_report_view, name='circulation-report'),
     path('book/<uuid:pk>/renew/', views.renew_book_librarian, name='renew-book-librarian'),
+    path('book/<uuid:pk>/return/', views.return_book_librarian, name='return-book-librarian'),
+    path('book/<int:pk>/checkout/', views.checkout_book_librarian, name='checkout-book-librarian'),
+    path('book/<int:pk>/reserve/', views.reserve_book, name='reserve-book'),
+    path('reservation/<int:pk>/cancel/', views.cancel_reservation_view, name='cancel-reservation'),
     path('author/create/', views.AuthorCreate.as_view(), name='author-create'),
     path('author/<int:pk>/update/', views.AuthorUpdate.as_view(), name='author-update'),
     path('author/<int:pk>/delete/', views.AuthorDelete.as_view(), name='author-delete'),
@@ -1,33 +1,142 @@
 from django.contrib.auth.decorators import permission_required, login_required
 from django.shortcuts import render, get_object_or_404
-from django.http import HttpResponseRedirect
+from django.http import HttpResponseRedirect, Http404, JsonResponse, StreamingHttpResponse
+from django.contrib.admin.views.decorators import staff_member_required
+from django.contrib import messages
+from django.views.decorators.http import require_POST
+from django.utils.translation import gettext as _
 from django.urls import reverse
 from django.urls import reverse_lazy
-from .models import Book, Author, BookInstance, Genre
+from django.utils.decorators import method_decorator
+from .models import Book, Author, BookInstance, Genre, Reservation, SimilarBook
 from django.views import generic
 import datetime
+from urllib.parse import urlencode
 from django.contrib.auth.mixins import LoginRequiredMixin, PermissionRequiredMixin
-from .forms import RenewBookForm
+from .forms import BookForm, CheckoutForm, RenewBookForm
+from .autocomplete import catalog_autocomplete
+from .export import CONTENT_TYPES, DATASETS, FORMATS, export_stream
+from .facets import get_facets
+from .fragments import AUTHOR as AUTHOR_FRAGMENTS, BOOK as BOOK_FRAGMENTS, FRAGMENT_TIMEOUT, fragment_version
+from .lookups import LOOKUPS, lookup
+from .loans import LoanError, cancel_reservation, checkout, renew, reserve, return_copy
+from .pagecache import author_validators, book_validators, cache_anonymous_page, catalog_validators
+from .pagination import KeysetPaginationMixin
+from .popularity import get_popular_books
+from .reports import circulation_report, overdue_report
+from .search import search_books
+from .stats import get_catalog_stats
 from django.views.generic.edit import CreateView, UpdateView, DeleteView
 
+# the visits counter of the homepage is kept in a signed cookie
+VISITS_SALT = 'catalog.index.visits'
+VISITS_MAX_AGE = 60 * 60 * 24 * 365
 
-class BookListView(generic.ListView):
+
+@method_decorator(cache_anonymous_page(catalog_validators), name='dispatch')
+class BookListView(KeysetPaginationMixin, generic.ListView):
     """View function for returning a list of all books"""
     model = Book
     ordering = ['title']
     paginate_by = 10
+    # the author is shown next to every title
+    queryset = Book.objects.select_related('author')
+    # the sort parameter -> the ordering of the list, both have an index
+    sorts = {
+        'title': ['title'],
+        'available': ['-copies_available', 'title'],
+    }
+    # the facet name -> the lookup it filters the books by
+    facet_lookups = {
+        'genre': 'genre',
+        'language': 'language',
+        'initial': 'author__last_name__istartswith',
+    }
 
+    def get_filters(self):
+        """the valid facet filters of the request, unknown values are ignored"""
+        filters = {}
+        for name in self.facet_lookups:
+            value = self.request.GET.get(name, '').strip()
+            if name == 'initial':
+                if len(value) == 1:
+                    filters[name] = value.upper()
+            elif value.isdigit():
+                filters[name] = value
+        return filters
+
+    def get_sort(self):
+        sort = self.request.GET.get('sort')
+        return sort if sort in self.sorts else 'title'
+
+    def get_ordering(self):
+        return self.sorts[self.get_sort()]
 
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        for name, value in self.get_filters().items():
+            queryset = queryset.filter(**{self.facet_lookups[name]: value})
+        return queryset
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        filters = self.get_filters()
+        sort = self.get_sort()
+        # the facet links keep the sort order
+        base = dict(filters, sort=sort) if sort != 'title' else filters
+        facets = []
+        for name, options in get_facets().items():
+            links = []
+            for label, value, count in options:
+                # a click on the active option drops the filter
+                params = dict(base, **{name: value})
+                if filters.get(name) == value:
+                    del params[name]
+                links.append({
+                    'label': label,
+                    'count': count,
+                    'active': filters.get(name) == value,
+                    'query': urlencode(params),
+                })
+            facets.append((name, links))
+        context['facets'] = facets
+        context['filters'] = filters
+        context['sort'] = sort
+        context['popular_books'] = get_popular_books()['month']
+        context['sort_links'] = [
+            (name, urlencode(dict(filters, sort=name) if name != 'title' else filters), name == sort)
+            for name in self.sorts
+        ]
+        return context
+
+
+@method_decorator(cache_anonymous_page(book_validators), name='dispatch')
 class BookDetailView(generic.DetailView):
     """View function for returning a specific book detail"""
     model = Book
+    # the rest is read inside the cached fragments, only when they are rendered
+    queryset = Book.objects.select_related('author', 'language')
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        book = self.object
+        # unevaluated querysets, a cache hit runs none of them
+        context.update({
+            'genres': book.genre.all(),
+            'copies': book.bookinstance_set.all(),
+            'similar_books': SimilarBook.objects.filter(book=book).select_related('similar'),
+            'fragment_version': fragment_version(BOOK_FRAGMENTS, book.pk),
+            'fragment_timeout': FRAGMENT_TIMEOUT,
+        })
+        return context
 
 
-class AuthorListView(generic.ListView):
+@method_decorator(cache_anonymous_page(catalog_validators), name='dispatch')
+class AuthorListView(KeysetPaginationMixin, generic.ListView):
     """view function for returning a list of all authors"""
     model = Author
     paginate_by = 10
-    ordering = ['last_name']
+    ordering = ['last_name', 'first_name']
 
     # did it in frames of views expansion training
     def get_context_data(self, **kwargs):
@@ -36,11 +145,20 @@ class AuthorListView(generic.ListView):
         return context
 
 
+@method_decorator(cache_anonymous_page(author_validators), name='dispatch')
 class AuthorDetailView(generic.DetailView):
     """view function for returning a specific author detail.
     produces rendering given the model below and passes variables"""
     model = Author
 
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        # read inside the cached fragment, only when it is rendered
+        context['books'] = self.object.book_set.order_by('title')
+        context['fragment_version'] = fragment_version(AUTHOR_FRAGMENTS, self.object.pk)
+        context['fragment_timeout'] = FRAGMENT_TIMEOUT
+        return context
+
 
 class AllBorrowedBooksListView(PermissionRequiredMixin, generic.ListView):
     """
@@ -53,10 +171,11 @@ class AllBorrowedBooksListView(PermissionRequiredMixin, generic.ListView):
     permission_required = "catalog.view_all_borrowed"
 
     def get_queryset(self):
-        print(self.request.user.user_permissions.all())
         return (
             BookInstance.objects
-            .filter(status__exact='o')
+            .select_related('book', 'borrower')
+            .on_loan()
+            .with_days_overdue()
             .order_by('due_back')
         )
 
@@ -72,58 +191,152 @@ class LoanedBooksByUserListView(LoginRequiredMixin, generic.ListView):
 
     def get_queryset(self):
         return (
-            BookInstance.objects.filter(borrower=self.request.user)
-            .filter(status__exact='o')
+            BookInstance.objects.select_related('book')
+            .filter(borrower=self.request.user)
+            .on_loan()
+            .with_days_overdue()
             .order_by('due_back')
         )
 
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        # the active holds of the reader, waiting or ready for pickup
+        context['reservations'] = (
+            Reservation.objects.select_related('book')
+            .filter(patron=self.request.user, state__in=[Reservation.WAITING, Reservation.READY])
+            .order_by('created_at', 'id')
+        )
+        return context
+
 
 def index(request):
     """view function for home page of the site"""
 
-    # Generate counts of some of the main objects
-    num_books = Book.objects.all().count()
-    num_instances = BookInstance.objects.all().count()
+    # Generate counts of some of the main objects. All of them come from
+    # a single aggregate query which is kept in the shared cache
+    context = dict(get_catalog_stats())
 
-    # Available books (status = 'a')
-    num_instances_available = \
-        BookInstance.objects.filter(status__exact='a').count()
+    # add number of visits to the main page counter. It lives in a signed
+    # cookie, so the homepage doesn't write the session on every hit
+    num_visits = request.get_signed_cookie('num_visits', default=0, salt=VISITS_SALT)
+    try:
+        num_visits = int(num_visits)
+    except ValueError:
+        num_visits = 0
 
-    # The 'all()' is implied by default.
-    num_authors = Author.objects.all().count()
+    # context regarding thematic content
+    context.update({
+        'num_visits': num_visits,  # add visit count
+        'is_logged_in': request.user.is_authenticated,  # add is logged in status
+        # the most borrowed books of the last week, month and year
+        'popular_books': get_popular_books(),
+    })
 
-    # add counts for books' genres
-    num_genres = Genre.objects.all().count()
+    # render the HTML template base_generic.html with the data in the context variable
+    response = render(
+        request,
+        'index.html',
+        context
+    )
+    response.set_signed_cookie(
+        'num_visits', num_visits + 1, salt=VISITS_SALT, max_age=VISITS_MAX_AGE
+    )
+    return response
 
-    # add counts for books with special filter:
-    # The ones with name containing "and"
-    num_books_with_and = Book.objects.filter(title__contains='and').count()
 
-    # add number of visits to the main page counter
-    num_visits = request.session.get('num_visits', 0)
-    request.session['num_visits'] = num_visits + 1
+def search(request):
+    """view function for the full-text search over the books, the best matches first"""
+    query = request.GET.get('q', '').strip()
+    per_page = 10
 
-    # add info about is logged in
-    is_logged_in = request.user.is_authenticated
+    # the results are paged without counting them, just like the book list
+    try:
+        page_number = int(request.GET.get('page', 1))
+    except ValueError:
+        raise Http404(_('Invalid page.'))
+    if not 1 <= page_number <= KeysetPaginationMixin.max_offset_page:
+        raise Http404(_('Invalid page.'))
+
+    books = search_books(query, offset=(page_number - 1) * per_page, limit=per_page + 1)
 
-    # context regarding thematic content
     context = {
-        'num_books': num_books,
-        'num_instances': num_instances,
-        'num_instances_available': num_instances_available,
-        'num_authors': num_authors,
-        'num_genres': num_genres,
-        'num_books_with_and': num_books_with_and,
-        'num_visits': num_visits,  # add visit count
-        'is_logged_in': is_logged_in,  # add is logged in status
+        'query': query,
+        'book_list': books[:per_page],
+        'page_number': page_number,
+        'has_next': len(books) > per_page,
+        'has_previous': page_number > 1,
     }
 
-    # render the HTML template base_generic.html with the data in the context variable
-    return render(
-        request,
-        'index.html',
-        context
+    return render(request, 'catalog/book_search.html', context)
+
+
+def autocomplete(request):
+    """
+    JSON suggestions for the book titles and the author names.
+    Served from the in-memory prefix index, the keystrokes never hit the database
+    """
+    query = request.GET.get('q', '')
+    try:
+        limit = min(max(int(request.GET.get('limit', 10)), 1), 50)
+    except ValueError:
+        limit = 10
+
+    results = catalog_autocomplete.lookup(query, limit) if query.strip() else []
+    return JsonResponse({'results': results})
+
+
+def lookup_view(request, name):
+    """
+    JSON lookup of the authors, genres or languages starting with the text,
+    a page at a time, for the select widgets of the edit forms
+    """
+    if name not in LOOKUPS:
+        raise Http404(_('Unknown lookup.'))
+    try:
+        page = max(int(request.GET.get('page', 1)), 1)
+    except ValueError:
+        page = 1
+    results, more = lookup(name, request.GET.get('q', ''), page)
+    return JsonResponse({'results': results, 'more': more})
+
+
+@login_required()
+@permission_required("catalog.view_all_borrowed", raise_exception=True)
+def overdue_report_view(request):
+    """the overdue loans by their age and by the borrower, counted in the database"""
+    return render(request, 'catalog/overdue_report.html', overdue_report())
+
+
+@login_required()
+@permission_required("catalog.view_all_borrowed", raise_exception=True)
+def circulation_report_view(request):
+    """the loans per month, book, genre and borrower, summed from the monthly rollups"""
+    try:
+        months = min(max(int(request.GET.get('months', 12)), 1), 120)
+    except ValueError:
+        months = 12
+    return render(request, 'catalog/circulation_report.html', circulation_report(months))
+
+
+@staff_member_required
+def export_catalog(request):
+    """
+    Streams a catalog table as CSV or JSONL (optionally gzipped) to the staff.
+    The response is produced row by row, nothing is built in memory
+    """
+    dataset = request.GET.get('dataset', 'books')
+    export_format = request.GET.get('format', 'csv')
+    if dataset not in DATASETS or export_format not in FORMATS:
+        raise Http404(_('Unknown dataset or format.'))
+    compress = request.GET.get('gzip') in ('1', 'true', 'yes')
+
+    filename = f'{dataset}.{export_format}' + ('.gz' if compress else '')
+    response = StreamingHttpResponse(
+        export_stream(dataset, export_format, compress=compress),
+        content_type='application/gzip' if compress else CONTENT_TYPES[export_format],
     )
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
 
 
 @login_required()
@@ -133,7 +346,9 @@ def renew_book_librarian(request, pk):
     renew the book instance due back date. Requires special permissions.
     Need to be a librarian logged-in user
     """
-    book_instance = get_object_or_404(BookInstance, pk=pk)
+    book_instance = get_object_or_404(
+        BookInstance.objects.select_related('book', 'borrower'), pk=pk
+    )
 
     # If this is a POST request then process the Form data
     if request.method == 'POST':
@@ -143,12 +358,14 @@ def renew_book_librarian(request, pk):
 
         # Check if the form is valid:
         if form.is_valid():
-            # process the data in form.cleaned_data as required (here we just write it to the model due_back field)
-            book_instance.due_back = form.cleaned_data['renewal_date']
-            book_instance.save()
-
-            # redirect to a new URL:
-            return HttpResponseRedirect(reverse('all-borrowed'))
+            # the loan service moves the due date only while the copy is on loan
+            try:
+                renew(book_instance.pk, form.cleaned_data['renewal_date'])
+            except LoanError as error:
+                form.add_error(None, str(error))
+            else:
+                # redirect to a new URL:
+                return HttpResponseRedirect(reverse('all-borrowed'))
 
     # If this is a GET (or any other method) create the default form.
     else:
@@ -185,21 +402,15 @@ class AuthorDelete(PermissionRequiredMixin, DeleteView):
 
 class BookCreate(PermissionRequiredMixin, CreateView):
     model = Book
-    fields = [
-        'title',
-        'author',
-        'summary',
-        'isbn',
-        'genre',
-        'language'
-    ]
+    # the author, the genres and the language are looked up, not listed
+    form_class = BookForm
     initial = {'title': 'Some title', 'author': 'Some author'}
     permission_required = "catalog.can_affect_books"
 
 
 class BookUpdate(PermissionRequiredMixin, UpdateView):
     model = Book
-    fields = '__all__'  # Not recommended (potential security issue if more fields added)
+    form_class = BookForm
     permission_required = "catalog.can_affect_books"
 
 
@@ -207,3 +418,71 @@ class BookDelete(PermissionRequiredMixin, DeleteView):
     model = Book
     success_url = reverse_lazy('books')
     permission_required = "catalog.can_affect_books"
+
+
+@login_required()
+@permission_required("catalog.can_mark_returned", raise_exception=True)
+def checkout_book_librarian(request, pk):
+    """
+    lend an available copy of the book to a reader. Requires special permissions.
+    Need to be a librarian logged-in user
+    """
+    book = get_object_or_404(Book, pk=pk)
+
+    if request.method == 'POST':
+        form = CheckoutForm(request.POST)
+        if form.is_valid():
+            try:
+                checkout(book.pk, form.cleaned_data['borrower'], form.cleaned_data['due_back'])
+            except LoanError as error:
+                form.add_error(None, str(error))
+            else:
+                messages.success(request, _('%(book)s is lent to %(reader)s.') % {
+                    'book': book.title, 'reader': form.cleaned_data['borrower'].username,
+                })
+                return HttpResponseRedirect(reverse('all-borrowed'))
+    else:
+        form = CheckoutForm(initial={'due_back': datetime.date.today() + datetime.timedelta(weeks=3)})
+
+    return render(request, 'catalog/book_checkout_librarian.html', {'form': form, 'book': book})
+
+
+@require_POST
+@login_required()
+@permission_required("catalog.can_mark_returned", raise_exception=True)
+def return_book_librarian(request, pk):
+    """mark the copy of a book as returned. Requires special permissions."""
+    try:
+        return_copy(pk)
+    except LoanError as error:
+        messages.error(request, str(error))
+    else:
+        messages.success(request, _('The copy is returned.'))
+    return HttpResponseRedirect(reverse('all-borrowed'))
+
+
+@require_POST
+@login_required()
+def reserve_book(request, pk):
+    """put the logged-in reader in the hold queue of the book"""
+    book = get_object_or_404(Book, pk=pk)
+    try:
+        reserve(book.pk, request.user)
+    except LoanError as error:
+        messages.error(request, str(error))
+    else:
+        messages.success(request, _('%(book)s is reserved for you.') % {'book': book.title})
+    return HttpResponseRedirect(reverse('my-borrowed'))
+
+
+@require_POST
+@login_required()
+def cancel_reservation_view(request, pk):
+    """drop a hold of the logged-in reader"""
+    try:
+        cancel_reservation(pk, request.user)
+    except LoanError as error:
+        messages.error(request, str(error))
+    else:
+        messages.success(request, _('The hold is cancelled.'))
+    return HttpResponseRedirect(reverse('my-borrowed'))
@@ -27,7 +27,6 @@ urlpatterns = [
 ]
 # add URL maps to debug the requests and responses
 urlpatterns += [path("debugger/", include("debug_toolbar.urls"))]
-print(urlpatterns)
 
 # add the catalog app urls
 urlpatterns += [